@@ -14,11 +14,17 @@ class Settings(BaseSettings):
     ml_models_path: str = "./ml_models"
     min_training_samples: int = 50
     retrain_interval_hours: int = 24
+    # Upper bound of the random delay before a worker's first retraining check
+    retrain_startup_jitter_seconds: int = 60
     
     # Business Rules
     business_hours_start: int = 9
     business_hours_end: int = 17
     slot_interval_minutes: int = 30
+
+    # Real-time queue updates: "memory" (single worker) or "redis" (multiple workers)
+    broadcast_backend: str = "memory"
+    redis_url: str = "redis://localhost:6379/0"
     
     class Config:
         env_file = ".env"
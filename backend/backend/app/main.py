@@ -1,7 +1,47 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routes import auth, users, providers, services, appointments, recommendations, analytics, websockets
+from app.database.db import AsyncSessionLocal, engine
+from app.services.queue_state import queue_engine
+from app.services.broadcast import create_broadcast_backend, InMemoryBroadcast
+from app.ml import training
+from app.ml.wait_time_predictor import wait_time_predictor
+from app.ml.recommendation_engine import recommendation_engine
+from app.ml.scheduler import retrain_scheduler
 
-app = FastAPI(title="Appointment System API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Rebuild in-memory queue state from the database before serving traffic
+    try:
+        async with AsyncSessionLocal() as db:
+            await queue_engine.rebuild(db)
+    except Exception as e:
+        # Tables may not exist yet; the engine loads lazily on first queue request
+        print(f"Queue state rebuild skipped: {e}")
+
+    # Serve the last trained models instead of retraining in every worker
+    for name, model in (("Wait time predictor", wait_time_predictor), ("Recommendation engine", recommendation_engine)):
+        try:
+            if model.load():
+                print(f"{name} loaded model version {model.version}")
+        except Exception as e:
+            print(f"{name} could not load its saved model: {e}")
+    # Retrains now and every retrain_interval_hours, if enough new visits completed
+    retrain_scheduler.start(engine)
+
+    # Share queue pushes across workers when a Redis backend is configured
+    try:
+        websockets.manager.use_backend(create_broadcast_backend())
+        await websockets.manager.backend.start()
+    except Exception as e:
+        print(f"Broadcast backend unavailable, pushing to local sockets only: {e}")
+        websockets.manager.use_backend(InMemoryBroadcast())
+    yield
+    await websockets.manager.backend.stop()
+    await retrain_scheduler.stop()
+    training.shutdown_pool()
+
+app = FastAPI(title="Appointment System API", lifespan=lifespan)
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -11,6 +51,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 app.include_router(auth.router)
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+import numpy as np
+from app.config import settings
+
+# Bumped when the on-disk layout changes; older artifacts are then ignored
+ARTIFACT_FORMAT = 3
+# Versions kept per model, newest first; workers may still map an older one
+KEEP_VERSIONS = 3
+
+# Layout under settings.ml_models_path:
+#   <model>/CURRENT                    name of the version to load
+#   <model>/<version>/metadata.json    version, trained_at, samples, arrays, ...
+#   <model>/<version>/<array>.npy      plain .npy, loaded memory-mapped
+#
+# A version directory is complete before CURRENT points at it, so a worker
+# starting mid-write loads the previous version.
+
+def model_dir(model: str) -> str:
+    return os.path.join(settings.ml_models_path, model)
+
+def save(model: str, arrays: Dict[str, np.ndarray], metadata: dict) -> dict:
+    """Write a new version of a model's arrays and make it current; returns its metadata."""
+    now = datetime.now(timezone.utc)
+    # Sorts by time, so pruning keeps the newest
+    version = f"{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:6]}"
+    metadata = {
+        **metadata,
+        "model": model,
+        "version": version,
+        "format": ARTIFACT_FORMAT,
+        "trained_at": now.isoformat(),
+        "arrays": {name: {"shape": list(a.shape), "dtype": str(a.dtype)} for name, a in arrays.items()},
+    }
+
+    path = os.path.join(model_dir(model), version)
+    os.makedirs(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(path, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    current = os.path.join(model_dir(model), "CURRENT")
+    with open(f"{current}.tmp", "w") as f:
+        f.write(version)
+    os.replace(f"{current}.tmp", current)
+
+    _prune(model)
+    return metadata
+
+def current_version(model: str) -> Optional[str]:
+    try:
+        with open(os.path.join(model_dir(model), "CURRENT")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def load(model: str) -> Optional[Tuple[Dict[str, np.ndarray], dict]]:
+    """Arrays (memory-mapped, read-only) and metadata of a model's current version."""
+    version = current_version(model)
+    if version is None:
+        return None
+    path = os.path.join(model_dir(model), version)
+    try:
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    if metadata.get("format") != ARTIFACT_FORMAT:
+        print(f"Ignoring {model} artifact in format {metadata.get('format')}")
+        return None
+
+    # Mapped, not read: workers loading the same version share its pages
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in metadata["arrays"]
+    }
+    return arrays, metadata
+
+def _prune(model: str):
+    versions = sorted(
+        (entry for entry in os.listdir(model_dir(model))
+         if os.path.isdir(os.path.join(model_dir(model), entry))),
+        reverse=True
+    )
+    for version in versions[KEEP_VERSIONS:]:
+        # Mappings already open in other workers survive the unlink
+        shutil.rmtree(os.path.join(model_dir(model), version), ignore_errors=True)
@@ -0,0 +1,79 @@
+import numpy as np
+from typing import Optional, Tuple
+from sqlalchemy import extract, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models import Appointment, AppointmentStatus
+
+# Rows fetched per round trip while streaming training data; also bounds how
+# long the event loop goes without a turn while a chunk is copied in
+CHUNK_SIZE = 10_000
+
+async def load_columns(db: AsyncSession, query, chunk_size: Optional[int] = None) -> np.ndarray:
+    """
+    Run a column-only select and return its rows as one float matrix.
+
+    The result is counted first so the matrix is allocated once, then read
+    through a server-side cursor in chunks straight into it; no ORM objects or
+    per-row dicts are built, and no more than one chunk of rows is held as
+    tuples. Every fetch awaits the driver, so other tasks run between chunks.
+    NULLs come back as NaN.
+    """
+    total = (await db.execute(select(func.count()).select_from(query.subquery()))).scalar_one()
+    data = np.empty((total, len(query.selected_columns)), dtype=float)
+    connection = await db.connection()
+    filled = await connection.run_sync(_fill, query, data, chunk_size or CHUNK_SIZE)
+    return data[:filled]
+
+def _fill(connection, query, data: np.ndarray, chunk_size: int) -> int:
+    # Plain DBAPI tuples: building a Row per record costs more than the read itself
+    compiled = query.compile(connection)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = [params[name] for name in compiled.positiontup]
+    # Server-side: the plain async adapter cursor buffers the whole result on execute
+    cursor = connection.connection.cursor(server_side=True)
+    try:
+        cursor.execute(compiled.string, params)
+        filled = 0
+        # Rows inserted after the count wait for the next training run
+        while filled < len(data):
+            rows = cursor.fetchmany(min(chunk_size, len(data) - filled))
+            if not rows:
+                break
+            data[filled:filled + len(rows)] = rows
+            filled += len(rows)
+        return filled
+    finally:
+        cursor.close()
+
+async def wait_time_training_data(db: AsyncSession) -> Tuple[np.ndarray, np.ndarray]:
+    """Features (hour, day_of_week, tokens_ahead) and actual_duration of completed visits."""
+    query = select(
+        extract("hour", Appointment.date_time),
+        # SQL counts weekdays from Sunday, Python's weekday() from Monday
+        (extract("dow", Appointment.date_time) + 6) % 7,
+        # Approximation of tokens ahead: token_number as proxy
+        Appointment.token_number - 1,
+        Appointment.actual_duration,
+    ).where(
+        Appointment.status == AppointmentStatus.COMPLETED,
+        Appointment.actual_duration.isnot(None),
+        Appointment.started_at.isnot(None)
+    )
+    data = await load_columns(db, query)
+    return data[:, :3], data[:, 3]
+
+async def rating_data(db: AsyncSession) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """user_id, provider_id and rating (NaN if unrated) of completed visits."""
+    query = select(
+        Appointment.user_id, Appointment.provider_id, Appointment.user_rating
+    ).where(Appointment.status == AppointmentStatus.COMPLETED)
+    data = await load_columns(db, query)
+    return data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2]
+
+async def completed_count(db: AsyncSession) -> int:
+    """Completed appointments so far; retraining compares it with the count at the last run."""
+    return (await db.execute(
+        select(func.count()).select_from(Appointment).where(Appointment.status == AppointmentStatus.COMPLETED)
+    )).scalar_one()
@@ -1,92 +1,331 @@
-import pandas as pd
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import numpy as np
+from scipy import sparse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from sklearn.metrics.pairwise import cosine_similarity
-from app.models import Appointment, User, Provider, Service
-from typing import List, Dict
+from app.ml import artifacts
+from app.ml.features import completed_count, rating_data
+from app.ml.training import run_in_pool
+from app.services.provider_catalog import provider_catalog
+from typing import List, Dict, Optional, Set, Tuple
+
+# Most similar providers kept per provider in the neighbour index
+NEIGHBOURS = 20
+# Providers whose similarities are computed together; bounds the dense block to CHUNK x providers
+CHUNK = 256
+
+class RatingMatrix:
+    """
+    Mean rating per (user, provider) as float32 CSR, with sorted id arrays
+    mapping users to rows and providers to columns, plus an item-item index:
+    the NEIGHBOURS most cosine-similar providers of every provider.
+
+    A recommendation reads only the user's own row and the index rows of the
+    providers in it.
+    """
+
+    def __init__(self, ratings: sparse.csr_matrix, neighbours: np.ndarray, similarities: np.ndarray,
+                 user_ids: np.ndarray, provider_ids: np.ndarray):
+        self.ratings = ratings
+        # Column numbers of similar providers, -1 past the last one
+        self.neighbours = neighbours
+        self.similarities = similarities
+        self.user_ids = user_ids
+        self.provider_ids = provider_ids
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "RatingMatrix":
+        # copy=False keeps the matrix on the (possibly memory-mapped) arrays
+        ratings = sparse.csr_matrix(
+            (arrays["ratings_data"], arrays["ratings_indices"], arrays["ratings_indptr"]),
+            shape=(len(arrays["user_ids"]), len(arrays["provider_ids"])), copy=False
+        )
+        return cls(ratings, arrays["neighbours"], arrays["similarities"], arrays["user_ids"], arrays["provider_ids"])
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            "ratings_data": self.ratings.data, "ratings_indices": self.ratings.indices,
+            "ratings_indptr": self.ratings.indptr, "neighbours": self.neighbours,
+            "similarities": self.similarities, "user_ids": self.user_ids, "provider_ids": self.provider_ids,
+        }
+
+    def row(self, user_id: int) -> Optional[int]:
+        row = int(np.searchsorted(self.user_ids, user_id))
+        if row < len(self.user_ids) and self.user_ids[row] == user_id:
+            return row
+        return None
+
+    def recommend(self, user_id: int) -> Optional[List[int]]:
+        """
+        Provider ids by similarity-weighted sum of the user's ratings over the
+        index rows of the providers they rated; None for an unknown user.
+        """
+        row = self.row(user_id)
+        if row is None:
+            return None
+        start, end = self.ratings.indptr[row], self.ratings.indptr[row + 1]
+        cols, values = self.ratings.indices[start:end], self.ratings.data[start:end]
+
+        neighbours = self.neighbours[cols]
+        weights = self.similarities[cols] * values[:, None]
+        known = neighbours >= 0
+        candidates, inverse = np.unique(neighbours[known], return_inverse=True)
+        scores = np.bincount(inverse, weights=weights[known], minlength=len(candidates))
+        # Ties go to the lower provider id
+        order = np.lexsort((candidates, -scores))
+        return self.provider_ids[candidates[order]].tolist()
+
+def neighbour_index(ratings: sparse.csr_matrix, k: int = NEIGHBOURS, workers: Optional[int] = None):
+    """
+    Top-k cosine-similar providers of every provider, as (neighbours, similarities),
+    each of shape (providers, k) and padded with -1 / 0.
+
+    Providers are processed in chunks of CHUNK rows of ratings.T @ ratings, so
+    the work is linear in the number of ratings and spread over threads
+    (scipy's sparse product and NumPy's partition run without the GIL).
+    """
+    raters = ratings.T.tocsr()
+    norms = np.sqrt(raters.multiply(raters).sum(axis=1)).A1
+    # Unrated providers have no neighbours, and are nobody's
+    norms[norms == 0] = 1
+    providers = raters.shape[0]
+    k = min(k, providers - 1)
+    neighbours = np.full((providers, max(k, 0)), -1, dtype=np.int32)
+    similarities = np.zeros((providers, max(k, 0)), dtype=np.float32)
+    if k <= 0:
+        return neighbours, similarities
+
+    def build(start: int):
+        stop = min(start + CHUNK, providers)
+        block = (raters[start:stop] @ ratings).toarray()
+        block /= np.outer(norms[start:stop], norms)
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        values = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-values, axis=1, kind="stable")
+        top, values = np.take_along_axis(top, order, axis=1), np.take_along_axis(values, order, axis=1)
+        top[values <= 0] = -1
+        neighbours[start:stop], similarities[start:stop] = top, np.maximum(values, 0)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(build, range(0, providers, CHUNK)))
+    return neighbours, similarities
+
+def rating_matrix(users: np.ndarray, providers: np.ndarray, ratings: np.ndarray) -> RatingMatrix:
+    # Collaborative filtering matrix: mean rating per (user, provider);
+    # unrated visits do not count
+    rated = ~np.isnan(ratings)
+    user_ids, rows = np.unique(users[rated], return_inverse=True)
+    provider_ids, cols = np.unique(providers[rated], return_inverse=True)
+    cells, inverse = np.unique(rows.astype(np.int64) * len(provider_ids) + cols, return_inverse=True)
+    means = np.bincount(inverse, weights=ratings[rated]) / np.bincount(inverse)
+    matrix = sparse.csr_matrix(
+        (means.astype(np.float32), (cells // len(provider_ids), cells % len(provider_ids))),
+        shape=(len(user_ids), len(provider_ids))
+    )
+    return RatingMatrix(matrix, *neighbour_index(matrix), user_ids, provider_ids)
+
+# Artifact name under settings.ml_models_path
+ARTIFACT = "recommendations"
+# Cached recommendation lists per worker, and how long one may be served
+CACHE_SIZE = 10_000
+CACHE_TTL_SECONDS = 300.0
+
+CacheKey = Tuple[int, Optional[str], int]
+
+class ResultCache:
+    """
+    LRU of (user_id, profession, top_n) -> provider ids, each entry expiring
+    after CACHE_TTL_SECONDS.
+
+    Entries are dropped per user when they complete an appointment and all at
+    once when a new model is served. Completions handled by other workers only
+    reach this one through the TTL.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE, ttl: float = CACHE_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expires_at, provider ids), least recently used first
+        self.entries: "OrderedDict[CacheKey, Tuple[float, List[int]]]" = OrderedDict()
+        self.keys_by_user: Dict[int, Set[CacheKey]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+    def get(self, key: CacheKey) -> Optional[List[int]]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            self.expired += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(entry[1])
+
+    def put(self, key: CacheKey, provider_ids: List[int]):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        self.entries[key] = (time.monotonic() + self.ttl, list(provider_ids))
+        self.keys_by_user.setdefault(key[0], set()).add(key)
+        while len(self.entries) > self.size:
+            self._remove(next(iter(self.entries)))
+            self.evicted += 1
+
+    def invalidate_user(self, user_id: int):
+        for key in self.keys_by_user.pop(user_id, ()):
+            del self.entries[key]
+            self.invalidated += 1
+
+    def clear(self):
+        self.invalidated += len(self.entries)
+        self.entries.clear()
+        self.keys_by_user.clear()
+
+    def _remove(self, key: CacheKey):
+        del self.entries[key]
+        keys = self.keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_user[key[0]]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "invalidated": self.invalidated,
+        }
 
 class RecommendationEngine:
     def __init__(self):
-        self.user_provider_matrix = None
+        self.matrix: Optional[RatingMatrix] = None
         self.provider_features = None
         self.is_trained = False
+        # Version, trained_at, duration and sample counts of the model being served
+        self.metadata: dict = {}
+        self.training: Optional[asyncio.Task] = None
+        # "trained", "insufficient_data" or "failed" for the last training run
+        self.last_outcome: Optional[str] = None
+        # Results of the model being served; emptied whenever it is replaced
+        self.cache = ResultCache()
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.metadata.get("version")
+
+    def load(self) -> bool:
+        """Serve the current saved rating matrix, if there is one."""
+        artifact = artifacts.load(ARTIFACT)
+        if artifact is None:
+            return False
+        arrays, metadata = artifact
+        self.matrix = RatingMatrix.from_arrays(arrays)
+        self.metadata = metadata
+        self.is_trained = True
+        self.cache.clear()
+        return True
+
+    def start_training(self, db: AsyncSession) -> asyncio.Task:
+        """Start training in the background, or join the run already in progress."""
+        if self.training is None or self.training.done():
+            self.training = asyncio.create_task(self._train(db.bind))
+        return self.training
 
     async def train(self, db: AsyncSession):
-        # Fetch data
-        appointments_result = await db.execute(select(
-            Appointment.user_id, Appointment.provider_id, Appointment.user_rating
-        ).where(Appointment.status == "COMPLETED"))
-        appointments = appointments_result.all()
-        
-        if not appointments:
-            print("Not enough data to train recommendation engine.")
+        await asyncio.shield(self.start_training(db))
+
+    async def _train(self, bind):
+        try:
+            # Own session: the request that started the run may finish before it does
+            started = time.perf_counter()
+            async with AsyncSession(bind) as db:
+                completed = await completed_count(db)
+                # Fetch data
+                users, providers, ratings = await rating_data(db)
+
+            if users.size == 0:
+                print("Not enough data to train recommendation engine.")
+                self.last_outcome = "insufficient_data"
+                return
+
+            matrix = await run_in_pool(rating_matrix, users, providers, ratings)
+        except Exception as e:
+            print(f"Recommendation engine training failed: {e}")
+            self.last_outcome = "failed"
             return
 
-        df = pd.DataFrame(appointments, columns=['user_id', 'provider_id', 'rating'])
-        
-        # Collaborative filtering matrix
-        self.user_provider_matrix = df.pivot_table(
-            index='user_id', columns='provider_id', values='rating'
-        ).fillna(0)
-        
+        metadata = {"samples": len(users), "completed": completed, "duration_seconds": round(time.perf_counter() - started, 3)}
+        try:
+            metadata = await asyncio.to_thread(artifacts.save, ARTIFACT, matrix.to_arrays(), metadata)
+        except OSError as e:
+            print(f"Could not save recommendation model: {e}")
+            metadata["trained_at"] = datetime.now(timezone.utc).isoformat()
+
+        # Until here the previous matrix (or the popularity fallback) serves
+        self.matrix = matrix
+        self.metadata = metadata
         self.is_trained = True
+        self.last_outcome = "trained"
+        self.cache.clear()
         print("Recommendation engine trained.")
 
+    def invalidate_user(self, user_id: int):
+        """Forget cached results of a user whose history just changed."""
+        self.cache.invalidate_user(user_id)
+
     async def get_recommendations(self, db: AsyncSession, user_id: int, profession: str = None, top_n: int = 5) -> List[int]:
-        if not self.is_trained or self.user_provider_matrix is None:
-            # Fallback to popularity based
-            query = select(Provider).order_by(Provider.avg_rating.desc()).limit(top_n)
-            if profession:
-                query = query.where(Provider.profession == profession)
-            result = await db.execute(query)
-            return [p.id for p in result.scalars().all()]
-        
-        # Collaborative Filtering Logic (User-based)
-        if user_id not in self.user_provider_matrix.index:
+        key = (user_id, profession or None, top_n)
+        if self.is_trained:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        # Profession filter and popularity backfill both come from the in-memory catalog
+        await provider_catalog.ensure_loaded(db)
+
+        if not self.is_trained or self.matrix is None:
+            # Fallback to popularity based; not cached, a model is on its way
+            return provider_catalog.popular(profession, top_n)
+
+        # Nothing awaits from here on, so a retrain cannot clear the cache mid-computation
+        result = self._recommend(user_id, profession, top_n)
+        self.cache.put(key, result)
+        return result
+
+    def _recommend(self, user_id: int, profession: Optional[str], top_n: int) -> List[int]:
+        # Collaborative Filtering Logic (Item-based): providers similar to the
+        # ones this user rated, from the precomputed neighbour index
+        recommended_provider_ids = self.matrix.recommend(user_id)
+        if recommended_provider_ids is None:
              # New user -> Popularity fallback
             print("User not in matrix, falling back to popularity")
-            query = select(Provider).order_by(Provider.avg_rating.desc())
-            if profession:
-                query = query.where(Provider.profession == profession)
-            result = await db.execute(query)
-            return [p.id for p in result.scalars().all()[:top_n]]
-
-        # Find similar users
-        user_vector = self.user_provider_matrix.loc[user_id].values.reshape(1, -1)
-        similarities = cosine_similarity(self.user_provider_matrix, user_vector)
-        similar_users_indices = similarities.flatten().argsort()[::-1][1:6] # Top 5 similar users
-        
-        similar_users_ids = self.user_provider_matrix.index[similar_users_indices]
-        
-        # Aggregated ratings from similar users
-        relevant_ratings = self.user_provider_matrix.loc[similar_users_ids]
-        mean_ratings = relevant_ratings.mean(axis=0)
-        
-        # Sort providers by predicted rating
-        recommended_provider_ids = mean_ratings.sort_values(ascending=False).index.tolist()
+            return provider_catalog.popular(profession, top_n)
         
         # Filter by profession if needed
-        final_recommendations = []
-        for pid in recommended_provider_ids:
-            if len(final_recommendations) >= top_n:
-                break
-            # Verify profession
-            prov = await db.get(Provider, int(pid)) # pid might be numpy int
-            if prov and (not profession or prov.profession == profession):
-                final_recommendations.append(prov.id)
+        final_recommendations = provider_catalog.filter(recommended_provider_ids, profession)[:top_n]
                 
         # If we don't have enough, fill with popularity
         if len(final_recommendations) < top_n:
-            query = select(Provider).order_by(Provider.avg_rating.desc())
-            if profession:
-                query = query.where(Provider.profession == profession)
-            remaining = await db.execute(query)
-            for p in remaining.scalars().all():
-                if p.id not in final_recommendations:
-                    final_recommendations.append(p.id)
-                    if len(final_recommendations) >= top_n:
-                        break
+            final_recommendations += provider_catalog.popular(
+                profession, top_n - len(final_recommendations), exclude=final_recommendations
+            )
                         
         return final_recommendations
 
@@ -0,0 +1,97 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.ml import artifacts
+from app.ml.features import completed_count
+from app.ml.recommendation_engine import recommendation_engine, ARTIFACT as RECOMMENDATIONS
+from app.ml.wait_time_predictor import wait_time_predictor, ARTIFACT as WAIT_TIME
+
+class RetrainScheduler:
+    """
+    Retrains both models every settings.retrain_interval_hours, starting at
+    startup, when at least settings.min_training_samples appointments were
+    completed since the model being served was trained.
+
+    Workers start together, so each waits a random part of
+    settings.retrain_startup_jitter_seconds before its first check: the
+    first one trains and saves, the others find its artifact and load it.
+    """
+
+    def __init__(self):
+        self.models = {WAIT_TIME: wait_time_predictor, RECOMMENDATIONS: recommendation_engine}
+        self.task: Optional[asyncio.Task] = None
+        self.last_check: Optional[datetime] = None
+        self.next_check: Optional[datetime] = None
+        # Per model: "trained", "skipped", "insufficient_data" or "failed" at the last check
+        self.last_result = {}
+
+    def start(self, bind):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(bind))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self, bind):
+        await asyncio.sleep(random.uniform(0, settings.retrain_startup_jitter_seconds))
+        while True:
+            try:
+                await self.check(bind)
+            except Exception as e:
+                print(f"Retraining check failed: {e}")
+            interval = timedelta(hours=settings.retrain_interval_hours)
+            self.next_check = datetime.now(timezone.utc) + interval
+            await asyncio.sleep(interval.total_seconds())
+
+    async def check(self, bind):
+        self.last_check = datetime.now(timezone.utc)
+        async with AsyncSession(bind) as db:
+            completed = await completed_count(db)
+
+        for name, model in self.models.items():
+            # Another worker may have trained and saved a newer version already
+            current = artifacts.current_version(name)
+            if current is not None and current != model.version:
+                model.load()
+
+            new = completed - model.metadata.get("completed", 0)
+            if new < settings.min_training_samples:
+                print(f"Skipping {name} retraining: {new} new completed appointments")
+                self.last_result[name] = "skipped"
+                continue
+
+            async with AsyncSession(bind) as db:
+                await model.train(db)
+            self.last_result[name] = model.last_outcome
+
+    def status(self) -> dict:
+        return {
+            "retrain_interval_hours": settings.retrain_interval_hours,
+            "min_training_samples": settings.min_training_samples,
+            "last_check": self.last_check,
+            "next_check": self.next_check,
+            "models": {
+                name: {
+                    "is_trained": model.is_trained,
+                    "training": model.training is not None and not model.training.done(),
+                    "version": model.version,
+                    "trained_at": model.metadata.get("trained_at"),
+                    "duration_seconds": model.metadata.get("duration_seconds"),
+                    "samples": model.metadata.get("samples"),
+                    "completed_appointments": model.metadata.get("completed"),
+                    "last_result": self.last_result.get(name),
+                }
+                for name, model in self.models.items()
+            },
+        }
+
+retrain_scheduler = RetrainScheduler()
@@ -0,0 +1,25 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+# Model fitting is CPU-bound for seconds; it runs here instead of on the
+# event loop. One process is enough: runs are rare and already coalesced.
+_pool: Optional[ProcessPoolExecutor] = None
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawned, not forked: the parent holds an event loop and DB threads
+        _pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+async def run_in_pool(fn, *args):
+    """Run a picklable module-level function in the training process."""
+    return await asyncio.get_running_loop().run_in_executor(get_pool(), fn, *args)
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
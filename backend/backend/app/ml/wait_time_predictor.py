@@ -1,83 +1,132 @@
+import asyncio
+import time
+from datetime import datetime, timezone
 import pandas as pd
 import numpy as np
+from typing import Optional, Tuple
 from sklearn.ensemble import RandomForestRegressor
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from app.models import Appointment
+from app.ml import artifacts
+from app.ml.features import completed_count, wait_time_training_data
+from app.ml.training import run_in_pool
+
+FEATURES = ["hour", "day_of_week", "tokens_ahead"]
+
+# Fallback heuristic when the model is not trained
+DEFAULT_MINUTES_PER_PERSON = 15.0
+
+# The lookup table always covers at least this many people ahead
+MIN_TABLE_TOKENS_AHEAD = 100
+
+# Artifact name under settings.ml_models_path
+ARTIFACT = "wait_time"
+
+def lookup_table(model: RandomForestRegressor, max_tokens_ahead: int) -> np.ndarray:
+    """Materialize the model over its whole feature space: hour x weekday x tokens ahead."""
+    size = max(MIN_TABLE_TOKENS_AHEAD, max_tokens_ahead) + 1
+    hours, days, ahead = np.meshgrid(np.arange(24), np.arange(7), np.arange(size), indexing="ij")
+    grid = np.column_stack([hours.ravel(), days.ravel(), ahead.ravel()]).astype(float)
+    return model.predict(grid).reshape(24, 7, size)
+
+def fit_model(X: np.ndarray, y: np.ndarray) -> Tuple[RandomForestRegressor, np.ndarray]:
+    # Runs in the training process; returns a fresh model and its lookup table
+    model = RandomForestRegressor(n_estimators=100)
+    model.fit(X, y)
+    return model, lookup_table(model, int(X[:, 2].max()))
 
 class WaitTimePredictor:
     def __init__(self):
         self.model = RandomForestRegressor(n_estimators=100)
+        # Model output for every (hour, weekday, tokens_ahead); serves predictions after training
+        self.table: Optional[np.ndarray] = None
         self.is_trained = False
-        
+        # Version, trained_at, duration and sample counts of the model being served
+        self.metadata: dict = {}
+        self.training: Optional[asyncio.Task] = None
+        # "trained", "insufficient_data" or "failed" for the last training run
+        self.last_outcome: Optional[str] = None
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.metadata.get("version")
+
+    def load(self) -> bool:
+        """Serve the current saved lookup table, if there is one."""
+        artifact = artifacts.load(ARTIFACT)
+        if artifact is None:
+            return False
+        arrays, metadata = artifact
+        # Predictions only need the table, so the forest itself is not persisted
+        self.table, self.metadata, self.is_trained = arrays["table"], metadata, True
+        return True
+
+    def start_training(self, db: AsyncSession) -> asyncio.Task:
+        """Start training in the background, or join the run already in progress."""
+        if self.training is None or self.training.done():
+            self.training = asyncio.create_task(self._train(db.bind))
+        return self.training
+
     async def train(self, db: AsyncSession):
-        # Fetch completed appointments
-        result = await db.execute(select(Appointment).where(
-            Appointment.status == "COMPLETED",
-            Appointment.actual_duration.isnot(None),
-            Appointment.started_at.isnot(None)
-        ))
-        appointments = result.scalars().all()
-        
-        if len(appointments) < 10: # Min samples
-            print("Not enough data to train wait time predictor.")
-            return
+        await asyncio.shield(self.start_training(db))
+
+    async def _train(self, bind):
+        try:
+            # Own session: the request that started the run may finish before it does
+            started = time.perf_counter()
+            async with AsyncSession(bind) as db:
+                completed = await completed_count(db)
+                # Completed appointments, as arrays
+                X, y = await wait_time_training_data(db)
+
+            if len(y) < 10: # Min samples
+                print("Not enough data to train wait time predictor.")
+                self.last_outcome = "insufficient_data"
+                return
 
-        data = []
-        for apt in appointments:
-            if not apt.started_at:
-                continue
-                
-            # Feature engineering
-            hour = apt.date_time.hour
-            day_of_week = apt.date_time.weekday()
-            # Approximation of tokens ahead: for now using token_number as proxy
-            # In reality, we'd reconstruct the state at that time.
-            tokens_ahead = apt.token_number - 1 # Simple approximation
-            
-            data.append({
-                "hour": hour,
-                "day_of_week": day_of_week,
-                "tokens_ahead": tokens_ahead,
-                "actual_duration": apt.actual_duration
-            })
-            
-        df = pd.DataFrame(data)
-        if df.empty:
+            model, table = await run_in_pool(fit_model, X, y)
+        except Exception as e:
+            print(f"Wait time predictor training failed: {e}")
+            self.last_outcome = "failed"
             return
 
-        X = df[["hour", "day_of_week", "tokens_ahead"]]
-        y = df["actual_duration"]
-        
-        self.model.fit(X, y)
-        self.is_trained = True
+        metadata = {"samples": len(y), "completed": completed, "duration_seconds": round(time.perf_counter() - started, 3)}
+        try:
+            metadata = await asyncio.to_thread(artifacts.save, ARTIFACT, {"table": table}, metadata)
+        except OSError as e:
+            print(f"Could not save wait time model: {e}")
+            metadata["trained_at"] = datetime.now(timezone.utc).isoformat()
+
+        # Swapped in one step; until here the previous model (or the heuristic) serves
+        self.model, self.table, self.metadata, self.is_trained = model, table, metadata, True
+        self.last_outcome = "trained"
         print("Wait time predictor trained.")
 
+    def build_table(self, max_tokens_ahead: int):
+        self.table = lookup_table(self.model, max_tokens_ahead)
+
     def predict(self, current_token: int, user_token: int, appointment_time: pd.Timestamp):
-        if not self.is_trained:
-            # Fallback heuristic: 15 mins per person ahead
-            tokens_ahead = max(0, user_token - current_token)
-            return tokens_ahead * 15.0
-            
         tokens_ahead = max(0, user_token - current_token)
-        hour = appointment_time.hour
-        day_of_week = appointment_time.weekday()
-        
-        X_pred = pd.DataFrame([{
-            "hour": hour,
-            "day_of_week": day_of_week,
-            "tokens_ahead": tokens_ahead
-        }])
-        
-        predicted_duration = self.model.predict(X_pred)[0]
-        # Total wait = duration of serving current + (tokens_ahead * predicted_avg_duration)
-        # Simplified: predicted duration for the wait itself? 
-        # The model usually predicts *service duration* or *wait time* directly.
-        # If trained on actual wait time (started_at - scheduled_at/arrival), it predicts wait.
-        # If trained on service duration, we multiply.
-        # Implementation above uses 'actual_duration' which is service time.
+        return float(self.predict_batch(np.array([tokens_ahead]), appointment_time)[0])
+
+    def predict_batch(self, tokens_ahead: np.ndarray, appointment_time: pd.Timestamp) -> np.ndarray:
+        """Wait in minutes for each entry of `tokens_ahead`, using one model call for all of them."""
+        tokens_ahead = np.maximum(np.asarray(tokens_ahead, dtype=float), 0)
+        if not self.is_trained or tokens_ahead.size == 0:
+            return tokens_ahead * DEFAULT_MINUTES_PER_PERSON
+
+        if self.table is not None:
+            # Trees are flat beyond the largest tokens_ahead they were trained on,
+            # and the table reaches past it, so clamping to the last column is exact
+            index = np.minimum(tokens_ahead, self.table.shape[2] - 1).astype(np.intp)
+            predicted_duration = self.table[appointment_time.hour, appointment_time.weekday(), index]
+        else:
+            X_pred = np.empty((tokens_ahead.size, len(FEATURES)))
+            X_pred[:, 0] = appointment_time.hour
+            X_pred[:, 1] = appointment_time.weekday()
+            X_pred[:, 2] = tokens_ahead
+            predicted_duration = self.model.predict(X_pred)
+        # The model is trained on 'actual_duration', i.e. service time, not wait time.
         # So wait time ~= tokens_ahead * predicted_service_time
-        
         return tokens_ahead * predicted_duration
 
 wait_time_predictor = WaitTimePredictor()
@@ -3,3 +3,4 @@ from .user import User
 from .provider import Provider
 from .service import Service
 from .appointment import Appointment, AppointmentStatus
+from .token_sequence import TokenSequence
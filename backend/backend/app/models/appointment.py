@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, Enum, Index
 from sqlalchemy.sql import func
 import enum
 from app.database.db import Base
@@ -9,8 +9,19 @@ class AppointmentStatus(str, enum.Enum):
     COMPLETED = "COMPLETED"
     CANCELLED = "CANCELLED"
 
+def _service_date(context):
+    # Materialized day of date_time so queue queries can use equality instead of ranges
+    return context.get_current_parameters()["date_time"].date()
+
 class Appointment(Base):
     __tablename__ = "appointments"
+    __table_args__ = (
+        # Queue lookups: provider + day + status, ordered by token
+        Index("ix_appointments_queue", "provider_id", "service_date", "status", "token_number"),
+        # Keyset-paginated listings, newest first
+        Index("ix_appointments_user_listing", "user_id", "date_time", "id"),
+        Index("ix_appointments_provider_listing", "provider_id", "date_time", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
@@ -18,6 +29,7 @@ class Appointment(Base):
     service_name = Column(String, nullable=False)
     
     date_time = Column(DateTime(timezone=True), nullable=False)
+    service_date = Column(Date, nullable=False, default=_service_date)
     token_number = Column(Integer, nullable=False)
     status = Column(String, default=AppointmentStatus.SCHEDULED, nullable=False)
     
@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Integer, Date, ForeignKey
+from app.database.db import Base
+
+class TokenSequence(Base):
+    __tablename__ = "token_sequences"
+
+    # One row per provider per day; last_token is the highest token handed out
+    provider_id = Column(Integer, ForeignKey("providers.id"), primary_key=True)
+    service_date = Column(Date, primary_key=True)
+    last_token = Column(Integer, nullable=False, default=0)
@@ -2,8 +2,11 @@ from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.db import get_db
 from app.ml.wait_time_predictor import wait_time_predictor
+from app.ml.scheduler import retrain_scheduler
+from app.services import appointment_service
 from app.models import Appointment
 from datetime import datetime
+import numpy as np
 import pandas as pd
 
 router = APIRouter(prefix="/analytics", tags=["Analytics"])
@@ -15,8 +18,9 @@ async def predict_wait_time(
     user_token: int, 
     db: AsyncSession = Depends(get_db)
 ):
+    # Trains in the background; the heuristic answers until the model is ready
     if not wait_time_predictor.is_trained:
-        await wait_time_predictor.train(db)
+        wait_time_predictor.start_training(db)
         
     current_time = pd.Timestamp(datetime.now())
     estimated_minutes = wait_time_predictor.predict(current_token, user_token, current_time)
@@ -27,3 +31,37 @@ async def predict_wait_time(
         "your_token": user_token,
         "estimated_wait_minutes": round(estimated_minutes, 1)
     }
+
+@router.get("/wait-time/queue")
+async def predict_queue_wait_times(
+    provider_id: int,
+    db: AsyncSession = Depends(get_db)
+):
+    # Queue comes from server-side state, and every ETA from one model call
+    if not wait_time_predictor.is_trained:
+        wait_time_predictor.start_training(db)
+
+    current_token, waiting = await appointment_service.get_waiting_list(db, provider_id)
+    # Same notion of "ahead" as queue-position: waiting customers before you
+    people_ahead = np.arange(len(waiting))
+    estimates = wait_time_predictor.predict_batch(people_ahead, pd.Timestamp(datetime.now()))
+
+    return {
+        "provider_id": provider_id,
+        "current_token": current_token,
+        "predictions": [
+            {
+                "appointment_id": appointment_id,
+                "token": token,
+                "people_ahead": ahead,
+                "estimated_wait_minutes": round(minutes, 1)
+            }
+            for (token, appointment_id), ahead, minutes
+            in zip(waiting, people_ahead.tolist(), estimates.tolist())
+        ]
+    }
+
+@router.get("/models")
+async def model_status():
+    # Last training run of each model and the retraining schedule
+    return retrain_scheduler.status()
@@ -1,13 +1,24 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from typing import List, Literal, Optional
+from datetime import date
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.db import get_db
-from app.schemas.appointment import AppointmentResponse, AppointmentCreate, AppointmentUpdate
+from app.schemas.appointment import (
+    AppointmentResponse, AppointmentCreate, AppointmentUpdate,
+    AppointmentBatchCreate, AppointmentBatchResponse, QueuePositionResponse, AppointmentStatus
+)
 from app.services import appointment_service
+from app.services.queue_state import queue_engine
+from app.services.queue_streams import queue_streams, event_id, TERMINAL_STATUSES
+from app.routes.websockets import manager as websocket_manager
 from app.routes.deps import get_current_user, get_current_provider
 from app.schemas.user import UserResponse
 from app.schemas.provider import ProviderResponse
 
+# SSE streams are fed the same snapshots as WebSocket subscribers, local or from other workers
+websocket_manager.add_sink(queue_streams.deliver)
+
 router = APIRouter(prefix="/appointments", tags=["Appointments"])
 
 @router.post("/book", response_model=AppointmentResponse)
@@ -18,19 +29,74 @@ async def book_appointment(
 ):
     return await appointment_service.create_appointment(db, appointment, current_user.id)
 
+@router.post("/book/batch", response_model=AppointmentBatchResponse)
+async def book_appointments_batch(
+    batch: AppointmentBatchCreate,
+    current_user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    results = await appointment_service.create_appointments_batch(db, batch.appointments, current_user.id)
+    booked = sum(1 for r in results if r["appointment"] is not None)
+    return {"results": results, "booked": booked, "failed": len(results) - booked}
+
+# Listings are keyset-paginated newest first once a client passes limit or
+# cursor (pages of DEFAULT_PAGE_SIZE for a cursor alone); the next page's cursor
+# is returned in the X-Next-Cursor header so the body stays a plain list.
+# Without either, the full list is returned, as before pagination.
 @router.get("/user/me", response_model=List[AppointmentResponse])
 async def get_my_appointments(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    status: Optional[AppointmentStatus] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     current_user: UserResponse = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    return await appointment_service.get_user_appointments(db, current_user.id)
+    appointments, next_cursor = await appointment_service.get_user_appointments(
+        db, current_user.id, limit, cursor=cursor, status=status, date_from=date_from, date_to=date_to
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return appointments
 
 @router.get("/provider/me", response_model=List[AppointmentResponse])
 async def get_provider_appointments(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    status: Optional[AppointmentStatus] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    current_provider: ProviderResponse = Depends(get_current_provider),
+    db: AsyncSession = Depends(get_db)
+):
+    appointments, next_cursor = await appointment_service.get_provider_appointments(
+        db, current_provider.id, limit, cursor=cursor, status=status, date_from=date_from, date_to=date_to
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return appointments
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+@router.get("/provider/me/export")
+async def export_provider_appointments(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
     current_provider: ProviderResponse = Depends(get_current_provider),
     db: AsyncSession = Depends(get_db)
 ):
-    return await appointment_service.get_provider_appointments(db, current_provider.id)
+    chunks = appointment_service.export_provider_appointments(
+        db, current_provider.id, format, date_from=date_from, date_to=date_to
+    )
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="appointments.{format}"'}
+    )
 
 # Only providers should verify/update status?
 @router.patch("/{id}/status", response_model=AppointmentResponse)
@@ -49,15 +115,10 @@ async def call_next_customer(
     current_provider: ProviderResponse = Depends(get_current_provider),
     db: AsyncSession = Depends(get_db)
 ):
+    # The service publishes the new queue snapshot to WebSocket subscribers
     next_appt = await appointment_service.call_next_customer(db, current_provider.id)
     if not next_appt:
         raise HTTPException(status_code=404, detail="No waiting customers")
-    
-    # Broadcast update via WebSocket (Manager needs to be imported/used)
-    # We can rely on frontend polling or separate WS logic for now, 
-    # but ideally we broadcast. We'll skip broadcast implementation here 
-    # to keep it simple or assume service handles it if passed manager.
-    # For now, just return, frontend will re-fetch.
     return next_appt
 
 @router.post("/queue/finish", response_model=AppointmentResponse)
@@ -70,11 +131,64 @@ async def finish_current_customer(
         raise HTTPException(status_code=404, detail="No active appointment to finish")
     return appt
 
+@router.get("/queue-positions", response_model=List[QueuePositionResponse])
+async def get_queue_positions(
+    ids: List[int] = Query(..., max_length=500),
+    db: AsyncSession = Depends(get_db)
+):
+    # One call for kiosks and multi-appointment screens instead of one poll per appointment
+    positions = await appointment_service.get_queue_positions(db, ids)
+    return [{"appointment_id": appointment_id, **positions[appointment_id]} for appointment_id in ids]
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return any(tag.strip().removeprefix("W/") in (etag, "*") for tag in header.split(","))
+
 @router.get("/{id}/queue-position")
 async def get_queue_position(
     id: int,
+    request: Request,
+    response: Response,
     db: AsyncSession = Depends(get_db)
     # Allow unauthenticated access for now or user access? 
     # Usually user needs to check own. Let's make it public for simplicity or add user dep if needed.
 ):
+    # Queued appointments are tagged with their queue's version; an unchanged poll gets a 304
+    version = await appointment_service.get_queue_version(db, id)
+    if version is not None:
+        etag = f'"{version}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
     return await appointment_service.get_queue_position(db, id)
+
+@router.get("/{id}/queue-position/stream")
+async def stream_queue_position(
+    id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """Server-Sent Events alternative to polling queue-position (e.g. behind proxies that drop WebSockets)."""
+    entry = await appointment_service.get_queue_entry(db, id)
+    # The stream only reads in-memory queue state; hand the connection back to the pool now
+    # rather than when the dependency exits, after the stream ends
+    await db.close()
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Appointment not found")
+    provider_id, day, token, appointment_status = entry
+
+    last_event_id = request.headers.get("last-event-id")
+    if appointment_status in TERMINAL_STATUSES:
+        update = queue_engine.cached_snapshot(provider_id, day).update_for(id, token, appointment_status)
+        if event_id(update) == last_event_id:
+            # Client already has the final state; 204 stops EventSource from reconnecting
+            return Response(status_code=204)
+
+    return StreamingResponse(
+        queue_streams.events(id, provider_id, day, token, appointment_status, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
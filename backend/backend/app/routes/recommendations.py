@@ -4,7 +4,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.db import get_db
 from app.schemas.provider import ProviderResponse
 from app.ml.recommendation_engine import recommendation_engine
-from app.models import Provider
+from app.services import provider_service
 
 router = APIRouter(prefix="/recommendations", tags=["ML Recommendations"])
 
@@ -15,19 +15,16 @@ async def recommend_providers(
     top_n: int = 5, 
     db: AsyncSession = Depends(get_db)
 ):
-    # Trigger lightweight training check or just use current state
-    # In production, training happens in background.
-    # checking if trained purely for demo:
+    # Training runs in the background; popularity answers until it is done
     if not recommendation_engine.is_trained:
-        await recommendation_engine.train(db)
+        recommendation_engine.start_training(db)
         
     recommended_ids = await recommendation_engine.get_recommendations(db, user_id, profession, top_n)
     
     # Fetch provider details
-    providers = []
-    for pid in recommended_ids:
-        prov = await db.get(Provider, pid)
-        if prov:
-            providers.append(prov)
-            
-    return providers
+    return await provider_service.get_providers_by_ids(db, recommended_ids)
+
+@router.get("/stats")
+async def recommendation_stats():
+    """Result cache counters for this worker."""
+    return recommendation_engine.cache.stats()
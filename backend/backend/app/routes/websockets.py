@@ -1,86 +1,386 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
-from typing import List, Dict
-import json
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from typing import Callable, List, Dict, Optional, Set, Tuple, Union
+from datetime import date
 import asyncio
+import os
+import resource
 from app.services import appointment_service
+from app.services.queue_state import queue_engine, QueueSnapshot, QueueTransition
+from app.services.broadcast import InMemoryBroadcast
+from app.services import queue_protocol
+from app.services.queue_protocol import DeltaEncoder
 from app.database.db import get_db
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from app.models import Appointment
+from app.models import AppointmentStatus
 
 router = APIRouter(prefix="/ws", tags=["WebSockets"])
 
+# A send that takes longer than this marks the client as a slow consumer
+SEND_TIMEOUT_SECONDS = 5.0
+# Server pings idle connections this often; clients answer with "pong"
+HEARTBEAT_INTERVAL_SECONDS = 20.0
+# Connections that send nothing (not even a pong) for this long are reaped
+IDLE_TIMEOUT_SECONDS = 60.0
+# Close code for evicted clients ("try again later"); they reconnect and resync
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Close code for reaped half-open connections ("going away")
+IDLE_CLOSE_CODE = 1001
+
+PING = {"type": "ping"}
+
+# Registry memory per connection (outbox, its task, subscription entries) as traced
+# by tracemalloc in tests/test_broadcast.py, which keeps this figure honest
+REGISTRY_BYTES_PER_CONNECTION = 1800
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current RSS, but better than nothing off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class ConnectionOutbox:
+    """
+    Latest-wins send buffer for one socket, drained by its own task.
+
+    At most one message waits here. A newer snapshot replaces an unsent one,
+    so a slow reader only ever gets the freshest queue state and never holds
+    up the other subscribers. Kept lean (slots, futures created on demand)
+    since a worker holds one per connected client.
+    """
+
+    __slots__ = ("manager", "websocket", "appointment_id", "queue_entry", "encoder", "pending",
+                 "coalesced", "sending_since", "last_seen", "waiter", "drained", "task")
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, appointment_id: str,
+                 protocol: Optional[str] = None):
+        self.manager = manager
+        self.websocket = websocket
+        self.appointment_id = appointment_id
+        # (appointment id, token, fallback status) used to personalize queue snapshots
+        self.queue_entry: Optional[Tuple[int, int, Optional[AppointmentStatus]]] = None
+        # Only set for the delta subprotocols; plain clients get full JSON updates
+        self.encoder = DeltaEncoder(protocol) if protocol else None
+        self.pending: Union[dict, QueueSnapshot, None] = None
+        self.coalesced = 0
+        loop = asyncio.get_running_loop()
+        # Loop time the in-flight send started; checked by the manager's watchdog
+        self.sending_since: Optional[float] = None
+        # Loop time the client last sent anything
+        self.last_seen = loop.time()
+        self.waiter: Optional[asyncio.Future] = None
+        self.drained: Optional[asyncio.Future] = None
+        self.task = loop.create_task(self._run())
+
+    @property
+    def busy(self) -> bool:
+        return self.pending is not None or self.sending_since is not None
+
+    def put(self, item: Union[dict, QueueSnapshot]):
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = item
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def wait_drained(self) -> Optional[asyncio.Future]:
+        if not self.busy:
+            return None
+        if self.drained is None:
+            self.drained = asyncio.get_running_loop().create_future()
+        return self.drained
+
+    def close(self):
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        self._set_drained()
+
+    def _set_drained(self):
+        if self.drained is not None:
+            if not self.drained.done():
+                self.drained.set_result(None)
+            self.drained = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.pending is None:
+                self.waiter = loop.create_future()
+                await self.waiter
+                self.waiter = None
+            item, self.pending = self.pending, None
+            if isinstance(item, QueueSnapshot):
+                # Rendered here rather than at broadcast time, so coalesced snapshots cost nothing
+                item = item.update_for(*self.queue_entry)
+                if self.encoder is not None:
+                    item = self.encoder.encode_update(item)
+            elif self.encoder is not None:
+                item = self.encoder.encode(item)
+
+            if item is not None:
+                self.sending_since = loop.time()
+                try:
+                    if self.encoder is None:
+                        await self.websocket.send_json(item)
+                    elif isinstance(item, bytes):
+                        await self.websocket.send_bytes(item)
+                    else:
+                        await self.websocket.send_text(item)
+                except Exception as e:
+                    print(f"Error sending message: {e}")
+                    await self.evict()
+                    return
+                finally:
+                    self.sending_since = None
+            if self.pending is None:
+                self._set_drained()
+
+    async def evict(self, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        self.manager.disconnect(self.websocket, self.appointment_id)
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), self.manager.send_timeout)
+        except Exception:
+            pass
+
 class ConnectionManager:
     def __init__(self):
-        # Store active connections: appointment_id -> List[WebSocket]
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        # Store active connections: appointment_id -> set of sockets
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        # Every send goes through the socket's outbox
+        self.outboxes: Dict[WebSocket, ConnectionOutbox] = {}
+        # Queue subscribers: (provider_id, day) -> {websocket: outbox}
+        self.queue_subscribers: Dict[Tuple[int, date], Dict[WebSocket, ConnectionOutbox]] = {}
+        # websocket -> (provider_id, day), to unsubscribe on disconnect
+        self.subscriptions: Dict[WebSocket, Tuple[int, date]] = {}
+        self.send_timeout = SEND_TIMEOUT_SECONDS
+        self.heartbeat_interval = HEARTBEAT_INTERVAL_SECONDS
+        self.idle_timeout = IDLE_TIMEOUT_SECONDS
+        self.evicted_slow = 0
+        self.reaped_idle = 0
+        # One timer for all sockets instead of a timeout per send
+        self.watchdog: Optional[asyncio.Task] = None
+        # Closes in progress; held here because the loop only keeps weak references to tasks
+        self.evictions: Set[asyncio.Task] = set()
+        # Other local consumers of every snapshot this worker sees (SSE streams)
+        self.sinks: List[Callable[[QueueSnapshot], None]] = []
+        # Carries snapshots to this worker's sockets and, with Redis, to the other workers
+        self.use_backend(InMemoryBroadcast())
+
+    def use_backend(self, backend):
+        backend.attach(self.broadcast_queue, self.receive_remote)
+        self.backend = backend
+
+    async def connect(self, websocket: WebSocket, appointment_id: str, protocol: Optional[str] = None):
+        await websocket.accept(subprotocol=protocol)
+        self.active_connections.setdefault(appointment_id, set()).add(websocket)
+        self.outboxes[websocket] = ConnectionOutbox(self, websocket, appointment_id, protocol)
+        if self.watchdog is None or self.watchdog.done() or self.watchdog.get_loop() is not asyncio.get_running_loop():
+            self.watchdog = asyncio.create_task(self._watch_connections())
 
-    async def connect(self, websocket: WebSocket, appointment_id: str):
-        await websocket.accept()
-        if appointment_id not in self.active_connections:
-            self.active_connections[appointment_id] = []
-        self.active_connections[appointment_id].append(websocket)
+    def subscribe(self, websocket: WebSocket, appointment_id: int, provider_id: int, day: date, token: int,
+                  status: Optional[AppointmentStatus] = None):
+        outbox = self.outboxes[websocket]
+        outbox.queue_entry = (appointment_id, token, status)
+        key = (provider_id, day)
+        self.queue_subscribers.setdefault(key, {})[websocket] = outbox
+        self.subscriptions[websocket] = key
+
+    def touch(self, websocket: WebSocket):
+        """Record that the client is alive (any inbound message counts)."""
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            outbox.last_seen = asyncio.get_running_loop().time()
+
+    def resync(self, websocket: WebSocket):
+        """Start a delta client over from a full snapshot (after it saw a sequence gap)."""
+        outbox = self.outboxes.get(websocket)
+        key = self.subscriptions.get(websocket)
+        if outbox is None or outbox.encoder is None or key is None:
+            return
+        outbox.encoder.resync()
+        outbox.put(queue_engine.cached_snapshot(*key))
 
     def disconnect(self, websocket: WebSocket, appointment_id: str):
-        if appointment_id in self.active_connections:
-            if websocket in self.active_connections[appointment_id]:
-                self.active_connections[appointment_id].remove(websocket)
-            if not self.active_connections[appointment_id]:
+        connections = self.active_connections.get(appointment_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
                 del self.active_connections[appointment_id]
 
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.close()
+
+        key = self.subscriptions.pop(websocket, None)
+        if key is not None:
+            subscribers = self.queue_subscribers.get(key, {})
+            subscribers.pop(websocket, None)
+            if not subscribers:
+                self.queue_subscribers.pop(key, None)
+
+    def send(self, websocket: WebSocket, message: dict):
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            outbox.put(message)
+
     async def broadcast(self, message: dict, appointment_id: str):
-        if appointment_id in self.active_connections:
-            for connection in self.active_connections[appointment_id]:
-                try:
-                    await connection.send_json(message)
-                except Exception as e:
-                    print(f"Error sending message: {e}")
+        for connection in self.active_connections.get(appointment_id, ()):
+            self.send(connection, message)
+
+    def add_sink(self, sink: Callable[[QueueSnapshot], None]):
+        self.sinks.append(sink)
+
+    async def broadcast_queue(self, snapshot: QueueSnapshot):
+        for sink in self.sinks:
+            sink(snapshot)
+        # Hand the snapshot to every subscriber's outbox; nothing here waits on a socket
+        subscribers = self.queue_subscribers.get((snapshot.provider_id, snapshot.day))
+        if not subscribers:
+            return
+        for outbox in subscribers.values():
+            outbox.put(snapshot)
+
+    async def _watch_connections(self):
+        loop = asyncio.get_running_loop()
+        next_heartbeat = loop.time() + self.heartbeat_interval
+        while self.outboxes:
+            await asyncio.sleep(min(self.send_timeout, self.heartbeat_interval) / 4)
+            now = loop.time()
+            heartbeat = now >= next_heartbeat
+            if heartbeat:
+                next_heartbeat = now + self.heartbeat_interval
+
+            for outbox in list(self.outboxes.values()):
+                if outbox.sending_since is not None and now - outbox.sending_since > self.send_timeout:
+                    print(f"Evicting slow WebSocket consumer for appointment {outbox.appointment_id}")
+                    self.evicted_slow += 1
+                    # Cancelling the outbox task abandons the stuck send
+                    outbox.task.cancel()
+                    self._evict(outbox)
+                elif not heartbeat:
+                    continue
+                elif now - outbox.last_seen > self.idle_timeout:
+                    # Half-open connection: the client stopped answering pings
+                    self.reaped_idle += 1
+                    outbox.task.cancel()
+                    self._evict(outbox, IDLE_CLOSE_CODE)
+                elif not outbox.busy:
+                    # Queued only when idle so a ping never displaces a snapshot
+                    outbox.put(PING)
+
+    def _evict(self, outbox: ConnectionOutbox, code: int = SLOW_CONSUMER_CLOSE_CODE):
+        task = asyncio.create_task(outbox.evict(code))
+        self.evictions.add(task)
+        task.add_done_callback(self.evictions.discard)
+
+    async def flush(self):
+        """Wait until every outbox has sent (or dropped) what it holds."""
+        waiting = [outbox.wait_drained() for outbox in list(self.outboxes.values())]
+        await asyncio.gather(*(future for future in waiting if future is not None))
+
+    def stats(self) -> dict:
+        connections = len(self.outboxes)
+        return {
+            "connections": connections,
+            "queue_subscribers": len(self.subscriptions),
+            "queues": len(self.queue_subscribers),
+            "evicted_slow": self.evicted_slow,
+            "reaped_idle": self.reaped_idle,
+            # Whole process, so it includes far more than the connections
+            "rss_bytes": _rss_bytes(),
+            "registry_bytes_estimate": connections * REGISTRY_BYTES_PER_CONNECTION,
+        }
+
+    async def publish_queue(self, snapshot: QueueSnapshot, transitions: List[QueueTransition]):
+        await self.backend.publish(snapshot, transitions)
+
+    async def receive_remote(self, transitions: List[QueueTransition]):
+        # Another worker committed these; keep our queue state in step and push what it now says
+        changed = {(t.provider_id, t.service_date) for t in transitions if queue_engine.replay(t)}
+        for key in changed:
+            await self.broadcast_queue(queue_engine.cached_snapshot(*key))
 
 manager = ConnectionManager()
+queue_engine.add_listener(manager.publish_queue)
+
+@router.get("/stats")
+async def websocket_stats():
+    """Connection gauges for this worker."""
+    return manager.stats()
+
+# Connect-time lookup: (provider_id, day, token, status or None while queued)
+ConnectState = Tuple[int, date, int, Optional[AppointmentStatus]]
+
+# appointment id -> lookup in flight, shared by concurrent connects for it
+_pending_lookups: Dict[int, asyncio.Future] = {}
+
+async def _lookup_appointment(appointment_id: int) -> Optional[ConnectState]:
+    pending = _pending_lookups.get(appointment_id)
+    if pending is not None:
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            # The connect that led the lookup went away mid-query; look it up ourselves
+            return await _lookup_appointment(appointment_id)
+
+    future = asyncio.get_running_loop().create_future()
+    _pending_lookups[appointment_id] = future
+    try:
+        state = None
+        async for session in get_db():
+            state = await appointment_service.get_queue_entry(session, appointment_id)
+            break
+        future.set_result(state)
+        return state
+    except Exception as e:
+        future.set_exception(e)
+        # Mark retrieved so a lookup nobody else joined does not log a warning
+        future.exception()
+        raise
+    finally:
+        if not future.done():
+            # Cancelled (a BaseException): release the connects waiting on us
+            future.cancel()
+        del _pending_lookups[appointment_id]
+
+async def _connect_state(appointment_id: int) -> Optional[ConnectState]:
+    # Waiting and in-service appointments are answered from memory, no session needed
+    if queue_engine.is_loaded:
+        entry = queue_engine.active.get(appointment_id)
+        if entry is not None:
+            return (*entry, None)
+    return await _lookup_appointment(appointment_id)
 
 @router.websocket("/queue/{appointment_id}")
 async def websocket_endpoint(websocket: WebSocket, appointment_id: str):
     # Note: In a real app, we should validate the token passed in query params
     # token = websocket.query_params.get("token")
     
-    await manager.connect(websocket, appointment_id)
+    # Clients may opt into delta updates (JSON or MessagePack) via Sec-WebSocket-Protocol
+    protocol = queue_protocol.negotiate(websocket.scope.get("subprotocols", []))
+    await manager.connect(websocket, appointment_id, protocol)
     try:
-        # Send initial state
-        # In a real implementation, we would fetch the current queue position
-
-        # Get current appointment from DB
-        initial_update = None
-        async for session in get_db():
-             # In a real app we'd query the queue for this provider
-             # For now, just show the appointment status
-             stmt = select(Appointment).where(Appointment.id == int(appointment_id))
-             result = await session.execute(stmt)
-             appointment = result.scalars().first()
-             
-             if appointment:
-                 initial_update = {
-                    "type": "update",
-                    "queue": [
-                        {
-                            "position": appointment.token_number,
-                            "name": "You",
-                            "status": appointment.status,
-                            "eta": "Calculating...",
-                            "highlight": True
-                        }
-                    ]
-                 }
-             break
-        
-        if initial_update:
-            await websocket.send_json(initial_update)
+        # Send initial state from the provider-day snapshot the pushes are built from
+        state = await _connect_state(int(appointment_id))
+        if state:
+            provider_id, day, token, status = state
+            # Later queue transitions for this provider-day are pushed to us
+            manager.subscribe(websocket, int(appointment_id), provider_id, day, token, status)
+            manager.send(websocket, queue_engine.cached_snapshot(provider_id, day))
         else:
-            await websocket.send_json({"error": "Appointment not found"})
+            manager.send(websocket, {"error": "Appointment not found"})
         
-        # Keep connection alive
+        # Keep connection alive; pongs and any other client message count as liveness
         while True:
-            # Wait for any client messages (optional, mostly for keepalive)
-            data = await websocket.receive_text()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            manager.touch(websocket)
+            command = queue_protocol.decode(protocol, message)
+            if command and command.get("type") == "resync":
+                manager.resync(websocket)
             
     except WebSocketDisconnect:
         manager.disconnect(websocket, appointment_id)
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 from enum import Enum
 
 class AppointmentStatus(str, Enum):
@@ -31,3 +31,23 @@ class AppointmentResponse(AppointmentBase):
 class AppointmentUpdate(BaseModel):
     status: Optional[AppointmentStatus] = None
     user_rating: Optional[int] = None
+
+class AppointmentBatchCreate(BaseModel):
+    appointments: List[AppointmentCreate] = Field(..., min_length=1, max_length=100)
+
+class AppointmentBatchItem(BaseModel):
+    index: int
+    appointment: Optional[AppointmentResponse] = None
+    error: Optional[str] = None
+
+class AppointmentBatchResponse(BaseModel):
+    results: List[AppointmentBatchItem]
+    booked: int
+    failed: int
+
+class QueuePositionResponse(BaseModel):
+    appointment_id: int
+    position: int
+    wait_time: int
+    current_token: int
+    your_token: int
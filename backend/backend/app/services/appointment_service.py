@@ -1,62 +1,336 @@
+import asyncio
+import base64
+import csv
+import io
+import json
+import random
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import func
-from datetime import datetime
-from app.models import Appointment, AppointmentStatus, User
+from sqlalchemy import func, case, and_, update, insert, tuple_
+from sqlalchemy.exc import IntegrityError, OperationalError
+from datetime import datetime, date
+from typing import Dict, List, Optional, Tuple
+from app.models import Appointment, AppointmentStatus, User, Provider, TokenSequence
 from app.schemas.appointment import AppointmentCreate, AppointmentUpdate
+from app.services.queue_state import queue_engine
+from app.ml.recommendation_engine import recommendation_engine
 from fastapi import HTTPException
 
-async def get_next_token(db: AsyncSession, provider_id: int, date: datetime.date):
-    # Get max token for provider on this date
-    # Note: date_time is DateTime, we need to filter by date
-    # In SQLite, checking date(date_time) works, in Postgres same.
-    # However, for SQLAlchemy sync/async portability, let's filter by range.
-    start_of_day = datetime.combine(date, datetime.min.time())
-    end_of_day = datetime.combine(date, datetime.max.time())
-    
-    query = select(func.max(Appointment.token_number)).where(
-        Appointment.provider_id == provider_id,
-        Appointment.date_time >= start_of_day,
-        Appointment.date_time <= end_of_day
+# Bookings that lose a lock or uniqueness race are retried this many times
+TOKEN_ALLOCATION_RETRIES = 5
+
+# Page size of a listing that passes a cursor but no limit
+DEFAULT_PAGE_SIZE = 50
+
+def _sequence_insert(db: AsyncSession):
+    # INSERT ... ON CONFLICT, where the dialect has it; None selects the locking fallback
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
+
+async def allocate_tokens(db: AsyncSession, counts: Dict[Tuple[int, date], int]) -> Dict[Tuple[int, date], int]:
+    """
+    Reserve `count` consecutive tokens for each (provider_id, date) in one
+    upsert and return the last token of each block. Runs inside the caller's
+    transaction, so a rollback hands the tokens back and sequences stay gapless.
+    """
+    upsert = _sequence_insert(db)
+    if upsert is None:
+        return await _allocate_tokens_locked(db, counts)
+    # Same lock order in every transaction, or two batches can deadlock on PostgreSQL
+    stmt = upsert(TokenSequence).values([
+        {"provider_id": provider_id, "service_date": day, "last_token": counts[(provider_id, day)]}
+        for provider_id, day in sorted(counts)
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TokenSequence.provider_id, TokenSequence.service_date],
+        set_={"last_token": TokenSequence.last_token + stmt.excluded.last_token}
+    ).returning(TokenSequence.provider_id, TokenSequence.service_date, TokenSequence.last_token)
+
+    result = await db.execute(stmt)
+    return {(provider_id, day): last_token for provider_id, day, last_token in result.all()}
+
+async def _allocate_tokens_locked(db: AsyncSession, counts: Dict[Tuple[int, date], int]) -> Dict[Tuple[int, date], int]:
+    """
+    allocate_tokens for dialects without an upsert: read each sequence row
+    (locked, where SELECT ... FOR UPDATE is supported) and move it on only if
+    it still holds what was read, or insert it. Two first bookings of a day
+    racing on the insert end in an IntegrityError, which the booking retries.
+    """
+    allocated = {}
+    # Same lock order in every transaction
+    for provider_id, day in sorted(counts):
+        count = counts[(provider_id, day)]
+        match = (TokenSequence.provider_id == provider_id, TokenSequence.service_date == day)
+        while True:
+            last_token = (await db.execute(
+                select(TokenSequence.last_token).where(*match).with_for_update()
+            )).scalar_one_or_none()
+            if last_token is None:
+                await db.execute(insert(TokenSequence).values(provider_id=provider_id, service_date=day, last_token=count))
+                break
+            moved = await db.execute(update(TokenSequence).where(
+                *match, TokenSequence.last_token == last_token
+            ).values(last_token=last_token + count))
+            if moved.rowcount == 1:
+                break
+        allocated[(provider_id, day)] = (last_token or 0) + count
+    return allocated
+
+async def get_next_token(db: AsyncSession, provider_id: int, date: date):
+    allocated = await allocate_tokens(db, {(provider_id, date): 1})
+    return allocated[(provider_id, date)]
+
+def _lost_race(error: Exception) -> bool:
+    # Locks and duplicate keys clear up on a retry; other constraint failures never do
+    if isinstance(error, OperationalError):
+        return True
+    code = getattr(error.orig, "sqlstate", None) or getattr(error.orig, "pgcode", None)
+    if code is not None:
+        return code == "23505"
+    return "UNIQUE" in str(error.orig).upper()
+
+async def _commit_with_token_retries(db: AsyncSession, book):
+    """
+    Run `book()` (token allocation + inserts) and commit, starting over with
+    fresh tokens when the transaction loses a race (locked database or
+    duplicate key). Any other integrity error is the request's fault: 400.
+    """
+    for attempt in range(TOKEN_ALLOCATION_RETRIES):
+        try:
+            result = await book()
+            await db.commit()
+            return result
+        except (IntegrityError, OperationalError) as e:
+            await db.rollback()
+            if not _lost_race(e):
+                print(f"Booking rejected: {e}")
+                raise HTTPException(status_code=400, detail="Invalid appointment")
+            if attempt == TOKEN_ALLOCATION_RETRIES - 1:
+                print(f"Token allocation failed: {e}")
+                raise HTTPException(status_code=503, detail="Could not allocate a token, please retry")
+            await asyncio.sleep(0.01 * (2 ** attempt) * random.random())
+
+def _increment_user_appointments(user_id: int, count: int):
+    return update(User).where(User.id == user_id).values(
+        total_appointments=func.coalesce(User.total_appointments, 0) + count
     )
-    result = await db.execute(query)
-    max_token = result.scalar()
-    return (max_token or 0) + 1
 
 async def create_appointment(db: AsyncSession, appointment: AppointmentCreate, user_id: int):
     # Check if slot is available (simplified: just generate token for now)
     # Real availability check requires checking provider's schedule and existing appointments
     # For now, we just append to the queue (Token system context).
+    provider_result = await db.execute(select(Provider.id).where(
+        Provider.id == appointment.provider_id,
+        Provider.is_active == True
+    ))
+    if provider_result.scalar_one_or_none() is None:
+        raise HTTPException(status_code=404, detail="Provider not found")
     
-    token = await get_next_token(db, appointment.provider_id, appointment.date_time.date())
-    
-    db_appointment = Appointment(
-        user_id=user_id,
-        provider_id=appointment.provider_id,
-        service_name=appointment.service_name,
-        date_time=appointment.date_time,
-        token_number=token,
-        status=AppointmentStatus.SCHEDULED
-    )
-    db.add(db_appointment)
-    
-    # Update user's total appointments
-    user_result = await db.execute(select(User).where(User.id == user_id))
-    user = user_result.scalars().first()
-    if user:
-        user.total_appointments += 1
+    async def book():
+        service_date = appointment.date_time.date()
+        token = await get_next_token(db, appointment.provider_id, service_date)
+        
+        db_appointment = Appointment(
+            user_id=user_id,
+            provider_id=appointment.provider_id,
+            service_name=appointment.service_name,
+            date_time=appointment.date_time,
+            service_date=service_date,
+            token_number=token,
+            status=AppointmentStatus.SCHEDULED
+        )
+        db.add(db_appointment)
+        
+        # Update user's total appointments
+        await db.execute(_increment_user_appointments(user_id, 1))
+        return db_appointment
     
-    await db.commit()
+    db_appointment = await _commit_with_token_retries(db, book)
     await db.refresh(db_appointment)
+    queue_engine.apply(db_appointment)
+    await queue_engine.publish(db_appointment.provider_id, db_appointment.service_date)
     return db_appointment
 
-async def get_user_appointments(db: AsyncSession, user_id: int):
-    result = await db.execute(select(Appointment).where(Appointment.user_id == user_id))
-    return result.scalars().all()
+async def create_appointments_batch(db: AsyncSession, appointments: List[AppointmentCreate], user_id: int):
+    """
+    Book many slots in one transaction: one provider lookup, one token upsert
+    for every (provider, day) involved, one multi-row insert and one user
+    update. Returns one result per requested item, in request order.
+    """
+    results: List[dict] = [{"index": i, "appointment": None, "error": None} for i in range(len(appointments))]
+    
+    provider_ids = {a.provider_id for a in appointments}
+    provider_result = await db.execute(select(Provider.id).where(
+        Provider.id.in_(provider_ids),
+        Provider.is_active == True
+    ))
+    active_providers = set(provider_result.scalars().all())
+    
+    accepted = []
+    for i, appointment in enumerate(appointments):
+        if appointment.provider_id not in active_providers:
+            results[i]["error"] = "Provider not found"
+        else:
+            accepted.append(i)
+    
+    if not accepted:
+        return results
+    
+    async def book():
+        counts: Dict[Tuple[int, date], int] = {}
+        for i in accepted:
+            key = (appointments[i].provider_id, appointments[i].date_time.date())
+            counts[key] = counts.get(key, 0) + 1
+        last_tokens = await allocate_tokens(db, counts)
+        # Hand out each block in request order
+        next_tokens = {key: last_tokens[key] - count + 1 for key, count in counts.items()}
+        
+        rows = []
+        for i in accepted:
+            appointment = appointments[i]
+            key = (appointment.provider_id, appointment.date_time.date())
+            rows.append({
+                "user_id": user_id,
+                "provider_id": appointment.provider_id,
+                "service_name": appointment.service_name,
+                "date_time": appointment.date_time,
+                "service_date": key[1],
+                "token_number": next_tokens[key],
+                "status": AppointmentStatus.SCHEDULED
+            })
+            next_tokens[key] += 1
+        
+        inserted = await db.scalars(
+            insert(Appointment).returning(Appointment, sort_by_parameter_order=True), rows
+        )
+        booked = inserted.all()
+        await db.execute(_increment_user_appointments(user_id, len(booked)))
+        return booked
+    
+    booked = await _commit_with_token_retries(db, book)
+    for i, db_appointment in zip(accepted, booked):
+        queue_engine.apply(db_appointment)
+        results[i]["appointment"] = db_appointment
+    # One push per queue touched, not per booking
+    for provider_id, day in {(a.provider_id, a.service_date) for a in booked}:
+        await queue_engine.publish(provider_id, day)
+    return results
+
+def encode_cursor(appointment: Appointment) -> str:
+    raw = f"{appointment.date_time.isoformat()}|{appointment.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        date_time, appointment_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(date_time), int(appointment_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def _page_appointments(
+    db: AsyncSession,
+    owner_filter,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+):
+    """
+    Keyset page over (date_time, id), newest first. Returns the page and the
+    cursor for the next one (None on the last page), so the cost of a page
+    does not depend on how much history sits behind it.
+
+    Without a limit or a cursor the whole listing comes back in one page,
+    as it did before listings were paginated.
+    """
+    if limit is None and cursor:
+        limit = DEFAULT_PAGE_SIZE
+    query = select(Appointment).where(owner_filter)
+    if cursor:
+        query = query.where(tuple_(Appointment.date_time, Appointment.id) < decode_cursor(cursor))
+    if status:
+        query = query.where(Appointment.status == status)
+    if date_from:
+        query = query.where(Appointment.service_date >= date_from)
+    if date_to:
+        query = query.where(Appointment.service_date <= date_to)
+    
+    query = query.order_by(Appointment.date_time.desc(), Appointment.id.desc())
+    if limit is not None:
+        query = query.limit(limit + 1)
+    result = await db.execute(query)
+    appointments = result.scalars().all()
+    
+    next_cursor = None
+    if limit is not None and len(appointments) > limit:
+        appointments = appointments[:limit]
+        next_cursor = encode_cursor(appointments[-1])
+    return appointments, next_cursor
+
+async def get_user_appointments(db: AsyncSession, user_id: int, limit: Optional[int] = None, **filters):
+    return await _page_appointments(db, Appointment.user_id == user_id, limit, **filters)
 
-async def get_provider_appointments(db: AsyncSession, provider_id: int):
-    result = await db.execute(select(Appointment).where(Appointment.provider_id == provider_id))
-    return result.scalars().all()
+async def get_provider_appointments(db: AsyncSession, provider_id: int, limit: Optional[int] = None, **filters):
+    return await _page_appointments(db, Appointment.provider_id == provider_id, limit, **filters)
+
+EXPORT_COLUMNS = (
+    Appointment.id, Appointment.user_id, Appointment.provider_id, Appointment.service_name,
+    Appointment.date_time, Appointment.service_date, Appointment.token_number, Appointment.status,
+    Appointment.price, Appointment.actual_duration, Appointment.user_rating,
+    Appointment.created_at, Appointment.started_at, Appointment.completed_at
+)
+EXPORT_FIELDS = [column.key for column in EXPORT_COLUMNS]
+
+def _export_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+async def export_provider_appointments(
+    db: AsyncSession,
+    provider_id: int,
+    fmt: str = "ndjson",
+    batch_size: int = 1000,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+):
+    """
+    Yield a provider's full history as NDJSON or CSV text chunks, one chunk
+    per `batch_size` rows. Rows come from a server-side cursor as plain
+    tuples, so memory stays flat however long the history is.
+    """
+    query = select(*EXPORT_COLUMNS).where(Appointment.provider_id == provider_id)
+    if date_from:
+        query = query.where(Appointment.service_date >= date_from)
+    if date_to:
+        query = query.where(Appointment.service_date <= date_to)
+    query = query.order_by(Appointment.date_time, Appointment.id).execution_options(yield_per=batch_size)
+    
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+    
+    result = await db.stream(query)
+    async for rows in result.partitions():
+        if fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows([[_export_value(value) for value in row] for row in rows])
+            yield buffer.getvalue()
+        else:
+            yield "".join(
+                json.dumps({field: _export_value(value) for field, value in zip(EXPORT_FIELDS, row)}) + "\n"
+                for row in rows
+            )
 
 async def update_appointment_status(db: AsyncSession, appointment_id: int, status: str):
     result = await db.execute(select(Appointment).where(Appointment.id == appointment_id))
@@ -71,74 +345,152 @@ async def update_appointment_status(db: AsyncSession, appointment_id: int, statu
         appointment.completed_at = datetime.utcnow()
         # Calculate duration?
         
+    await db.commit()
     await db.refresh(appointment)
+    if status == AppointmentStatus.COMPLETED:
+        recommendation_engine.invalidate_user(appointment.user_id)
+    queue_engine.apply(appointment)
+    await queue_engine.publish(appointment.provider_id, appointment.service_date)
     return appointment
 
-async def call_next_customer(db: AsyncSession, provider_id: int):
-    # 1. Find currently serving appointment
-    today = datetime.now().date()
-    start_of_day = datetime.combine(today, datetime.min.time())
-    end_of_day = datetime.combine(today, datetime.max.time())
-    
+async def _get_if_status(db: AsyncSession, appointment_id, status: str):
+    # Primary-key lookup used to confirm what the queue engine says before writing
+    if appointment_id is None:
+        return None
+    appointment = await db.get(Appointment, appointment_id)
+    if appointment and appointment.status == status:
+        return appointment
+    return None
+
+async def _find_current_appointment(db: AsyncSession, provider_id: int, day: date):
     current_stmt = select(Appointment).where(
         Appointment.provider_id == provider_id,
-        Appointment.status == AppointmentStatus.IN_PROGRESS,
-        Appointment.date_time >= start_of_day,
-        Appointment.date_time <= end_of_day
+        Appointment.service_date == day,
+        Appointment.status == AppointmentStatus.IN_PROGRESS
     )
     result = await db.execute(current_stmt)
-    current_appt = result.scalars().first()
+    return result.scalars().first()
+
+async def _find_next_appointment(db: AsyncSession, provider_id: int, day: date):
+    next_stmt = select(Appointment).where(
+        Appointment.provider_id == provider_id,
+        Appointment.service_date == day,
+        Appointment.status == AppointmentStatus.SCHEDULED
+    ).order_by(Appointment.token_number.asc())
+    result = await db.execute(next_stmt)
+    return result.scalars().first()
+
+async def call_next_customer(db: AsyncSession, provider_id: int):
+    today = datetime.now().date()
+
+    await queue_engine.ensure_loaded(db)
+    queue = queue_engine.get_queue(provider_id, today)
+    
+    # 1. Find currently serving appointment (from the queue engine, verified by primary key)
+    current_appt = None
+    if queue is not None:
+        current_appt = await _get_if_status(db, queue.serving_id, AppointmentStatus.IN_PROGRESS)
+    if current_appt is None:
+        # Engine is stale or has nothing for this queue (another worker, a restart); ask the database
+        current_appt = await _find_current_appointment(db, provider_id, today)
     
     # 2. Complete current if exists
     if current_appt:
         current_appt.status = AppointmentStatus.COMPLETED
         current_appt.completed_at = datetime.utcnow()
         
-    # 3. Find next waiting appointment (ordered by time/token)
-    next_stmt = select(Appointment).where(
-        Appointment.provider_id == provider_id,
-        Appointment.status == AppointmentStatus.SCHEDULED,
-        Appointment.date_time >= start_of_day,
-        Appointment.date_time <= end_of_day
-    ).order_by(Appointment.token_number.asc())
-    
-    result = await db.execute(next_stmt)
-    next_appt = result.scalars().first()
+    # 3. Find next waiting appointment (lowest waiting token)
+    next_appt = None
+    head = queue.next_waiting() if queue is not None else None
+    if head is not None:
+        next_appt = await _get_if_status(db, head[1], AppointmentStatus.SCHEDULED)
+    if next_appt is None:
+        next_appt = await _find_next_appointment(db, provider_id, today)
     
     if next_appt:
         next_appt.status = AppointmentStatus.IN_PROGRESS
         next_appt.started_at = datetime.utcnow()
-        await db.commit()
-        await db.refresh(next_appt)
-        return next_appt
     
     await db.commit()
-    return None
+    if current_appt:
+        recommendation_engine.invalidate_user(current_appt.user_id)
+        queue_engine.apply(current_appt)
+    if next_appt:
+        await db.refresh(next_appt)
+        queue_engine.apply(next_appt)
+    if current_appt or next_appt:
+        await queue_engine.publish(provider_id, today)
+    return next_appt
 
 async def finish_current_appointment(db: AsyncSession, provider_id: int):
     today = datetime.now().date()
-    start_of_day = datetime.combine(today, datetime.min.time())
-    end_of_day = datetime.combine(today, datetime.max.time())
+
+    await queue_engine.ensure_loaded(db)
+    queue = queue_engine.get_queue(provider_id, today)
     
-    current_stmt = select(Appointment).where(
-        Appointment.provider_id == provider_id,
-        Appointment.status == AppointmentStatus.IN_PROGRESS,
-        Appointment.date_time >= start_of_day,
-        Appointment.date_time <= end_of_day
-    )
-    result = await db.execute(current_stmt)
-    current_appt = result.scalars().first()
+    current_appt = None
+    if queue is not None:
+        current_appt = await _get_if_status(db, queue.serving_id, AppointmentStatus.IN_PROGRESS)
+    if current_appt is None:
+        # Engine is stale or has nothing for this queue (another worker, a restart); ask the database
+        current_appt = await _find_current_appointment(db, provider_id, today)
     
     if current_appt:
         current_appt.status = AppointmentStatus.COMPLETED
         current_appt.completed_at = datetime.utcnow()
         await db.commit()
         await db.refresh(current_appt)
+        recommendation_engine.invalidate_user(current_appt.user_id)
+        queue_engine.apply(current_appt)
+        await queue_engine.publish(provider_id, today)
         return current_appt
         
     return None
 
+async def get_queue_entry(db: AsyncSession, appointment_id: int):
+    """
+    (provider_id, service_date, token, status) for a push subscription, or None.
+
+    status is None while the appointment is queued; those are answered from
+    the queue engine, only rows that left the queue need a query.
+    """
+    await queue_engine.ensure_loaded(db)
+    entry = queue_engine.active.get(appointment_id)
+    if entry is not None:
+        return (*entry, None)
+
+    result = await db.execute(select(
+        Appointment.provider_id, Appointment.service_date,
+        Appointment.token_number, Appointment.status
+    ).where(Appointment.id == appointment_id))
+    row = result.first()
+    if not row:
+        return None
+    provider_id, day, token, appointment_status = row
+    return (provider_id, day, token, AppointmentStatus(appointment_status))
+
+async def get_waiting_list(db: AsyncSession, provider_id: int) -> Tuple[int, List[Tuple[int, int]]]:
+    """(current token, [(token, appointment id), ...] in queue order) for today's queue."""
+    await queue_engine.ensure_loaded(db)
+    queue = queue_engine.get_queue(provider_id, datetime.now().date())
+    if queue is None:
+        return 0, []
+    return queue.current_token, [(token, queue.waiting_ids[token]) for token in queue.waiting]
+
+async def get_queue_version(db: AsyncSession, appointment_id: int) -> Optional[str]:
+    """Version of the queue an active appointment waits in; None for anything else."""
+    await queue_engine.ensure_loaded(db)
+    return queue_engine.queue_version(appointment_id)
+
 async def get_queue_position(db: AsyncSession, appointment_id: int):
+    # Active appointments are answered from the in-memory queue without SQL
+    await queue_engine.ensure_loaded(db)
+    position = queue_engine.queue_position(appointment_id)
+    if position is not None:
+        return position
+    return await get_queue_position_from_db(db, appointment_id)
+
+async def get_queue_position_from_db(db: AsyncSession, appointment_id: int):
     # Get the appointment
     stmt = select(Appointment).where(Appointment.id == appointment_id)
     result = await db.execute(stmt)
@@ -147,35 +499,22 @@ async def get_queue_position(db: AsyncSession, appointment_id: int):
     if not my_appt or my_appt.status != AppointmentStatus.SCHEDULED:
         return {"position": 0, "wait_time": 0, "current_token": 0, "your_token": 0}
         
-    # Get currently serving token
-    today = my_appt.date_time.date()
-    start_of_day = datetime.combine(today, datetime.min.time())
-    end_of_day = datetime.combine(today, datetime.max.time())
-    
-    current_stmt = select(Appointment).where(
+    # Serving token, last completed token and waiting tokens ahead in one pass
+    state_stmt = select(
+        func.max(case((Appointment.status == AppointmentStatus.IN_PROGRESS, Appointment.token_number))),
+        func.max(case((Appointment.status == AppointmentStatus.COMPLETED, Appointment.token_number))),
+        func.count(case((and_(
+            Appointment.status == AppointmentStatus.SCHEDULED,
+            Appointment.token_number < my_appt.token_number
+        ), 1)))
+    ).where(
         Appointment.provider_id == my_appt.provider_id,
-        Appointment.status == AppointmentStatus.IN_PROGRESS,
-        Appointment.date_time >= start_of_day,
-        Appointment.date_time <= end_of_day
+        Appointment.service_date == my_appt.service_date
     )
-    result = await db.execute(current_stmt)
-    current_appt = result.scalars().first()
+    serving_token, last_token, people_ahead = (await db.execute(state_stmt)).one()
     
-    current_token = current_appt.token_number if current_appt else 0
-    
-    # If no one is serving, find the last completed one to guess where we are
-    if current_token == 0:
-        last_stmt = select(func.max(Appointment.token_number)).where(
-             Appointment.provider_id == my_appt.provider_id,
-             Appointment.status == AppointmentStatus.COMPLETED,
-             Appointment.date_time >= start_of_day,
-             Appointment.date_time <= end_of_day
-        )
-        last_result = await db.execute(last_stmt)
-        last_token = last_result.scalar() or 0
-        current_token = last_token
-        
-    people_ahead = max(0, my_appt.token_number - current_token - 1)
+    # If no one is serving, the last completed one tells us where we are
+    current_token = serving_token or last_token or 0
     
     # Estimate wait time (e.g. 15 mins per person)
     wait_time = people_ahead * 15
@@ -186,3 +525,75 @@ async def get_queue_position(db: AsyncSession, appointment_id: int):
         "current_token": current_token, 
         "your_token": my_appt.token_number
     }
+
+async def get_queue_positions(db: AsyncSession, appointment_ids: List[int]) -> Dict[int, dict]:
+    await queue_engine.ensure_loaded(db)
+    positions = {}
+    misses = []
+    for appointment_id in appointment_ids:
+        position = queue_engine.queue_position(appointment_id)
+        if position is None:
+            misses.append(appointment_id)
+        else:
+            positions[appointment_id] = position
+    if misses:
+        positions.update(await get_queue_positions_from_db(db, misses))
+    return positions
+
+async def get_queue_positions_from_db(db: AsyncSession, appointment_ids: List[int]) -> Dict[int, dict]:
+    """
+    Resolve many queue positions in one round trip. For every provider-day
+    that holds a requested appointment, one window ranks the waiting tokens
+    and one grouped aggregate finds the serving and last completed tokens;
+    both read straight off ix_appointments_queue.
+    """
+    queue_key = (Appointment.provider_id, Appointment.service_date)
+    requested = select(*queue_key).where(Appointment.id.in_(appointment_ids)).distinct().subquery()
+    in_requested_queue = and_(
+        Appointment.provider_id == requested.c.provider_id,
+        Appointment.service_date == requested.c.service_date
+    )
+    
+    waiting = select(
+        Appointment.id,
+        func.row_number().over(partition_by=queue_key, order_by=Appointment.token_number).label("rank")
+    ).select_from(requested).join(Appointment, in_requested_queue).where(
+        Appointment.status == AppointmentStatus.SCHEDULED
+    ).subquery()
+    
+    tokens = select(
+        *queue_key,
+        func.max(case((Appointment.status == AppointmentStatus.IN_PROGRESS, Appointment.token_number))).label("serving_token"),
+        func.max(case((Appointment.status == AppointmentStatus.COMPLETED, Appointment.token_number))).label("last_token")
+    ).select_from(requested).join(Appointment, in_requested_queue).where(
+        Appointment.status.in_([AppointmentStatus.IN_PROGRESS, AppointmentStatus.COMPLETED])
+    ).group_by(*queue_key).subquery()
+    
+    stmt = select(
+        Appointment.id, Appointment.token_number, waiting.c.rank, tokens.c.serving_token, tokens.c.last_token
+    ).join(
+        waiting, waiting.c.id == Appointment.id
+    ).outerjoin(
+        tokens, and_(
+            tokens.c.provider_id == Appointment.provider_id,
+            tokens.c.service_date == Appointment.service_date
+        )
+    ).where(Appointment.id.in_(appointment_ids))
+    result = await db.execute(stmt)
+    
+    # Anything not waiting (served, finished, cancelled or unknown) has no position
+    positions = {
+        appointment_id: {"position": 0, "wait_time": 0, "current_token": 0, "your_token": 0}
+        for appointment_id in appointment_ids
+    }
+    for appointment_id, token, rank, serving_token, last_token in result.all():
+        people_ahead = rank - 1
+        positions[appointment_id] = {
+            "position": people_ahead,
+            # Estimate wait time (e.g. 15 mins per person)
+            "wait_time": people_ahead * 15,
+            # If no one is serving, the last completed one tells us where we are
+            "current_token": serving_token or last_token or 0,
+            "your_token": token
+        }
+    return positions
@@ -4,6 +4,7 @@ from fastapi import HTTPException, status
 from app.models import User, Provider
 from app.schemas.user import UserCreate
 from app.schemas.provider import ProviderCreate
+from app.services.provider_catalog import provider_catalog
 from app.utils.security import get_password_hash, verify_password
 
 async def get_user_by_username(db: AsyncSession, username: str):
@@ -52,6 +53,7 @@ async def create_provider(db: AsyncSession, provider: ProviderCreate):
     db.add(db_provider)
     await db.commit()
     await db.refresh(db_provider)
+    provider_catalog.invalidate()
     return db_provider
 
 async def authenticate_user_or_provider(db: AsyncSession, username: str, password: str):
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import uuid
+from typing import Awaitable, Callable, List, Optional, Sequence
+import redis.asyncio as redis
+from app.config import settings
+from app.services.queue_state import QueueSnapshot, QueueTransition, queue_engine
+
+SnapshotHandler = Callable[[QueueSnapshot], Awaitable[None]]
+TransitionHandler = Callable[[List[QueueTransition]], Awaitable[None]]
+
+QUEUE_CHANNEL = "queue-transitions"
+
+class InMemoryBroadcast:
+    """Default backend: snapshots only reach sockets held by this process."""
+
+    def __init__(self):
+        self.deliver: Optional[SnapshotHandler] = None
+
+    def attach(self, deliver: SnapshotHandler, receive_remote: TransitionHandler):
+        self.deliver = deliver
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, snapshot: QueueSnapshot, transitions: Sequence[QueueTransition] = ()):
+        await self.deliver(snapshot)
+
+class RedisBroadcast:
+    """
+    Fans queue transitions out to every worker through one Redis pub/sub channel.
+
+    Sockets on the publishing worker are served directly. Other workers replay
+    the transitions into their own queue engine and serve their sockets from
+    it, rather than adopting the publisher's whole queue, which would undo
+    changes they made concurrently. Each message carries the worker id so a
+    worker skips its own messages on the way back in.
+    """
+
+    def __init__(self, url: str, channel: str = QUEUE_CHANNEL):
+        self.url = url
+        self.channel = channel
+        self.worker_id = uuid.uuid4().hex
+        self.deliver: Optional[SnapshotHandler] = None
+        self.receive_remote: Optional[TransitionHandler] = None
+        self.client = None
+        self.pubsub = None
+        self.listener: Optional[asyncio.Task] = None
+
+    def attach(self, deliver: SnapshotHandler, receive_remote: TransitionHandler):
+        self.deliver = deliver
+        self.receive_remote = receive_remote
+
+    async def start(self):
+        self.client = redis.from_url(self.url)
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        # Subscribed before we return, so no transition published after startup is missed
+        await self.pubsub.subscribe(self.channel)
+        self.listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def publish(self, snapshot: QueueSnapshot, transitions: Sequence[QueueTransition] = ()):
+        await self.deliver(snapshot)
+        if self.client is None or not transitions:
+            return
+        message = json.dumps({"origin": self.worker_id, "transitions": [t.to_dict() for t in transitions]})
+        try:
+            await self.client.publish(self.channel, message)
+        except Exception as e:
+            print(f"Redis publish error: {e}")
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    await self._handle(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # redis-py reconnects and resubscribes on the next read; whatever was
+                # published meanwhile is lost, so the queue state is reread instead
+                print(f"Redis subscriber error: {e}")
+                queue_engine.invalidate()
+                await asyncio.sleep(1)
+
+    async def _handle(self, raw: bytes):
+        try:
+            data = json.loads(raw)
+            if data["origin"] == self.worker_id:
+                return
+            await self.receive_remote([QueueTransition.from_dict(t) for t in data["transitions"]])
+        except Exception as e:
+            print(f"Error handling queue transitions: {e}")
+
+def create_broadcast_backend():
+    if settings.broadcast_backend == "redis":
+        return RedisBroadcast(settings.redis_url)
+    return InMemoryBroadcast()
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models import Provider
+
+# Reload at least this often, to pick up changes made by other workers or scripts
+REFRESH_SECONDS = 60.0
+
+class ProviderCatalog:
+    """
+    Id, profession and rating of every active provider as parallel arrays,
+    best rated first, so recommendations can filter and backfill without
+    querying providers one at a time.
+
+    Writes through this process call `invalidate()` after committing.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        # Code from profession_codes, one per provider
+        self.professions = np.empty(0, dtype=np.int32)
+        self.ratings = np.empty(0, dtype=np.float32)
+        # Sorted ids and their positions in the catalog, for id lookups
+        self.sorted_ids = np.empty(0, dtype=np.int64)
+        self.by_id = np.empty(0, dtype=np.intp)
+        self.profession_codes: Dict[str, int] = {}
+        self.loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def reset(self):
+        self.loaded_at = None
+        # A fresh lock, since the old one may be bound to another event loop
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def is_fresh(self) -> bool:
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < REFRESH_SECONDS
+
+    async def ensure_loaded(self, db: AsyncSession):
+        if self.is_fresh():
+            return
+        async with self._lock:
+            if not self.is_fresh():
+                await self.load(db)
+
+    async def load(self, db: AsyncSession):
+        result = await db.execute(select(
+            Provider.id, Provider.profession, func.coalesce(Provider.avg_rating, 0.0)
+        ).where(Provider.is_active == True).order_by(func.coalesce(Provider.avg_rating, 0.0).desc(), Provider.id))
+        rows = result.all()
+
+        names = sorted({profession for _, profession, _ in rows})
+        codes = {name: code for code, name in enumerate(names)}
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        professions = np.fromiter((codes[row[1]] for row in rows), dtype=np.int32, count=len(rows))
+        ratings = np.fromiter((row[2] for row in rows), dtype=np.float32, count=len(rows))
+
+        self.ids, self.professions, self.ratings, self.profession_codes = ids, professions, ratings, codes
+        self.by_id = np.argsort(ids)
+        self.sorted_ids = ids[self.by_id]
+        self.loaded_at = time.monotonic()
+
+    def matches(self, profession: Optional[str]) -> np.ndarray:
+        """Mask over the catalog of providers in `profession` (all of them for None)."""
+        if not profession:
+            return np.ones(len(self.ids), dtype=bool)
+        code = self.profession_codes.get(profession)
+        if code is None:
+            return np.zeros(len(self.ids), dtype=bool)
+        return self.professions == code
+
+    def filter(self, provider_ids: Iterable[int], profession: Optional[str] = None) -> List[int]:
+        """The given ids, in their order, that are active providers in `profession`."""
+        provider_ids = np.asarray(list(provider_ids), dtype=np.int64)
+        if len(self.ids) == 0 or len(provider_ids) == 0:
+            return []
+        positions = np.minimum(np.searchsorted(self.sorted_ids, provider_ids), len(self.ids) - 1)
+        found = self.sorted_ids[positions] == provider_ids
+        keep = found & self.matches(profession)[self.by_id[positions]]
+        return provider_ids[keep].tolist()
+
+    def popular(self, profession: Optional[str], top_n: int, exclude: Iterable[int] = ()) -> List[int]:
+        """Best rated active providers in `profession`, skipping `exclude`."""
+        mask = self.matches(profession)
+        exclude = list(exclude)
+        if exclude:
+            mask &= ~np.isin(self.ids, exclude)
+        return self.ids[mask][:top_n].tolist()
+
+provider_catalog = ProviderCatalog()
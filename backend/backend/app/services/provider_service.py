@@ -28,3 +28,11 @@ async def get_providers(
 async def get_provider(db: AsyncSession, provider_id: int):
     result = await db.execute(select(Provider).where(Provider.id == provider_id))
     return result.scalars().first()
+
+async def get_providers_by_ids(db: AsyncSession, provider_ids: List[int]) -> List[Provider]:
+    # One IN (...) query; results come back in the order of provider_ids
+    if not provider_ids:
+        return []
+    result = await db.execute(select(Provider).where(Provider.id.in_(provider_ids)))
+    providers = {p.id: p for p in result.scalars().all()}
+    return [providers[pid] for pid in provider_ids if pid in providers]
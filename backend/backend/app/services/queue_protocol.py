@@ -0,0 +1,70 @@
+import json
+from typing import List, Optional, Union
+import msgpack
+
+# Opt-in WebSocket subprotocols. Both send a full "snapshot" first and then
+# "delta" messages with only the fields that changed, each with a sequence
+# number. A client that sees a gap sends {"type": "resync"} and gets a fresh
+# snapshot. Clients that offer neither keep the original full JSON updates.
+JSON_DELTA = "queue.delta.json"
+MSGPACK_DELTA = "queue.delta.msgpack"
+SUBPROTOCOLS = (MSGPACK_DELTA, JSON_DELTA)
+
+# Fields of a queue update tracked by deltas; the display row ("queue") is
+# derived from them client-side, so it is not sent
+STATE_FIELDS = ("appointment_id", "provider_id", "status", "position",
+                "wait_time", "current_token", "your_token")
+
+def negotiate(offered: List[str]) -> Optional[str]:
+    """First subprotocol the client offered that we speak, or None for plain JSON."""
+    for protocol in offered:
+        if protocol in SUBPROTOCOLS:
+            return protocol
+    return None
+
+def decode(protocol: Optional[str], message: dict) -> Optional[dict]:
+    """Parse an inbound ASGI websocket.receive message; None if it is not a command."""
+    try:
+        if message.get("bytes") is not None and protocol == MSGPACK_DELTA:
+            data = msgpack.unpackb(message["bytes"])
+        elif message.get("text") is not None:
+            data = json.loads(message["text"])
+        else:
+            return None
+    except ValueError:
+        # e.g. the plain "pong" heartbeat reply
+        return None
+    return data if isinstance(data, dict) else None
+
+class DeltaEncoder:
+    """Per-connection sequence and last-sent state for the delta subprotocols."""
+
+    __slots__ = ("binary", "seq", "last")
+
+    def __init__(self, protocol: str):
+        self.binary = protocol == MSGPACK_DELTA
+        self.seq = 0
+        self.last: Optional[dict] = None
+
+    def encode(self, message: dict) -> Union[bytes, str]:
+        if self.binary:
+            return msgpack.packb(message)
+        return json.dumps(message, separators=(",", ":"))
+
+    def encode_update(self, update: dict) -> Union[bytes, str, None]:
+        """Snapshot or delta for a rendered queue update; None when nothing changed."""
+        state = {field: update[field] for field in STATE_FIELDS}
+        if self.last is None:
+            message = {"type": "snapshot", **state}
+        else:
+            message = {key: value for key, value in state.items() if self.last[key] != value}
+            if not message:
+                return None
+            message["type"] = "delta"
+        self.seq += 1
+        message["seq"] = self.seq
+        self.last = state
+        return self.encode(message)
+
+    def resync(self):
+        self.last = None
@@ -0,0 +1,420 @@
+import asyncio
+import bisect
+import time
+import uuid
+from datetime import date, datetime
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy import func
+from app.models import Appointment, AppointmentStatus
+
+QueueKey = Tuple[int, date]
+
+# Estimate wait time (e.g. 15 mins per person)
+MINUTES_PER_PERSON = 15
+
+# Upper bound on how long a cached snapshot is reused; transitions drop it sooner
+SNAPSHOT_TTL_SECONDS = 5.0
+
+class QueueTransition(NamedTuple):
+    """One committed appointment change, as workers ship it to each other."""
+
+    id: int
+    provider_id: int
+    service_date: date
+    token_number: int
+    status: AppointmentStatus
+    # Wall-clock time the change was applied on the worker that committed it
+    changed_at: float
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "provider_id": self.provider_id,
+            "service_date": self.service_date.isoformat(),
+            "token_number": self.token_number,
+            "status": self.status.value,
+            "changed_at": self.changed_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QueueTransition":
+        return cls(data["id"], data["provider_id"], date.fromisoformat(data["service_date"]),
+                   data["token_number"], AppointmentStatus(data["status"]), data["changed_at"])
+
+class QueueSnapshot:
+    """Immutable view of one queue, shared by every subscriber of a broadcast."""
+
+    __slots__ = ("provider_id", "day", "waiting", "waiting_ids", "serving_token",
+                 "serving_id", "last_completed_token", "current_token", "finished", "version")
+
+    def __init__(self, queue: "ProviderDayQueue"):
+        self.provider_id = queue.provider_id
+        self.day = queue.day
+        self.waiting = tuple(queue.waiting)
+        self.waiting_ids = dict(queue.waiting_ids)
+        self.serving_token = queue.serving_token
+        self.serving_id = queue.serving_id
+        self.last_completed_token = queue.last_completed_token
+        self.current_token = queue.current_token
+        # Never mutated after this point, see ProviderDayQueue.finished
+        self.finished = queue.finished
+        self.version = queue.version
+
+    def update_for(self, appointment_id: int, token: int,
+                   status: Optional[AppointmentStatus] = None) -> dict:
+        """Personalized queue update for one appointment.
+
+        `status` is the fallback for appointments no longer in the queue that
+        this snapshot has no record of (e.g. finished before the last rebuild).
+        """
+        people_ahead = 0
+        if appointment_id == self.serving_id:
+            status = AppointmentStatus.IN_PROGRESS
+        else:
+            index = bisect.bisect_left(self.waiting, token)
+            if index < len(self.waiting) and self.waiting[index] == token:
+                status = AppointmentStatus.SCHEDULED
+                people_ahead = index
+            else:
+                status = self.finished.get(appointment_id, status or AppointmentStatus.COMPLETED)
+
+        wait_time = people_ahead * MINUTES_PER_PERSON
+        return {
+            "type": "update",
+            "appointment_id": appointment_id,
+            "provider_id": self.provider_id,
+            "status": status.value,
+            "position": people_ahead,
+            "wait_time": wait_time,
+            "current_token": self.current_token,
+            "your_token": token,
+            "queue": [
+                {
+                    "position": people_ahead + 1,
+                    "name": "You",
+                    "status": status.value,
+                    "eta": f"{wait_time} min",
+                    "highlight": True
+                }
+            ]
+        }
+
+class ProviderDayQueue:
+    """Queue state for one provider on one day."""
+
+    __slots__ = ("provider_id", "day", "waiting", "waiting_ids", "serving_token", "serving_id",
+                 "last_completed_token", "finished", "changed_at", "version")
+
+    def __init__(self, provider_id: int, day: date):
+        self.provider_id = provider_id
+        self.day = day
+        # Sorted waiting tokens plus token -> appointment id
+        self.waiting: List[int] = []
+        self.waiting_ids: Dict[int, int] = {}
+        self.serving_token: int = 0
+        self.serving_id: Optional[int] = None
+        self.last_completed_token: int = 0
+        # appointment id -> COMPLETED / CANCELLED for rows that left the queue;
+        # replaced rather than mutated, since snapshots share it
+        self.finished: Dict[int, AppointmentStatus] = {}
+        # appointment id -> changed_at of the last transition applied for it
+        self.changed_at: Dict[int, float] = {}
+        # (engine that made the last change, change counter); see QueueStateEngine.bump
+        self.version: Tuple[str, int] = ("", 0)
+
+    def add_waiting(self, token: int, appointment_id: int):
+        if token not in self.waiting_ids:
+            bisect.insort(self.waiting, token)
+        self.waiting_ids[token] = appointment_id
+
+    def remove_waiting(self, token: int):
+        if self.waiting_ids.pop(token, None) is not None:
+            index = bisect.bisect_left(self.waiting, token)
+            del self.waiting[index]
+
+    def people_ahead(self, token: int) -> int:
+        return bisect.bisect_left(self.waiting, token)
+
+    def next_waiting(self) -> Optional[Tuple[int, int]]:
+        if not self.waiting:
+            return None
+        token = self.waiting[0]
+        return token, self.waiting_ids[token]
+
+    @property
+    def current_token(self) -> int:
+        # Same rule as the SQL path: serving token, else the last one completed
+        return self.serving_token or self.last_completed_token
+
+    def snapshot(self) -> QueueSnapshot:
+        return QueueSnapshot(self)
+
+class QueueStateEngine:
+    """
+    In-process mirror of every active (provider_id, day) queue.
+
+    The database stays the source of truth: services commit first and then
+    call `apply()` with the refreshed row, so reads (queue position, who is
+    being served, who is next) never have to touch the appointments table.
+    """
+
+    def __init__(self):
+        self.queues: Dict[QueueKey, ProviderDayQueue] = {}
+        # appointment id -> (provider_id, day, token) for SCHEDULED / IN_PROGRESS rows
+        self.active: Dict[int, Tuple[int, date, int]] = {}
+        self.is_loaded = False
+        # Wall-clock start of the last rebuild; anything committed before it was read then
+        self.loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        # Called with a QueueSnapshot and the transitions behind it after every committed change
+        self.listeners: List[Callable[[QueueSnapshot, List[QueueTransition]], Awaitable[None]]] = []
+        # (provider_id, day) -> (expires at, snapshot); dropped whenever that queue changes
+        self.snapshots: Dict[QueueKey, Tuple[float, QueueSnapshot]] = {}
+        # Transitions applied here but not yet handed to the listeners, per queue
+        self.pending: Dict[QueueKey, List[QueueTransition]] = {}
+        # Day the live queues belong to; older ones are evicted when it changes
+        self.today: Optional[date] = None
+        # Identifies this engine's queue versions; new on every rebuild so counters never repeat
+        self.instance_id = uuid.uuid4().hex[:12]
+        # Transitions seen while a rebuild is reading the database; None when none is running
+        self.rebuild_buffer: Optional[List[QueueTransition]] = None
+
+    def reset(self):
+        self.queues = {}
+        self.active = {}
+        self.snapshots = {}
+        self.pending = {}
+        self.today = None
+        self.instance_id = uuid.uuid4().hex[:12]
+        self.is_loaded = False
+        self.rebuild_buffer = None
+        # A fresh lock, since the old one may be bound to another event loop
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        """Rebuild from the database on next use, e.g. after missing other workers' transitions."""
+        self.is_loaded = False
+
+    async def ensure_loaded(self, db: AsyncSession):
+        if self.is_loaded:
+            self.evict_past_days()
+            return
+        async with self._lock:
+            if not self.is_loaded:
+                await self.rebuild(db)
+
+    async def rebuild(self, db: AsyncSession):
+        # Only today and later matter for live queues; older days use the SQL path
+        today = datetime.now().date()
+        loaded_at = time.time()
+        # The queues below replace self.queues, so anything applied meanwhile is kept aside
+        self.rebuild_buffer = buffered = []
+        try:
+            active_result = await db.execute(select(
+                Appointment.id, Appointment.provider_id, Appointment.service_date,
+                Appointment.token_number, Appointment.status
+            ).where(
+                Appointment.status.in_([AppointmentStatus.SCHEDULED, AppointmentStatus.IN_PROGRESS]),
+                Appointment.service_date >= today
+            ))
+
+            completed_result = await db.execute(select(
+                Appointment.provider_id, Appointment.service_date, func.max(Appointment.token_number)
+            ).where(
+                Appointment.status == AppointmentStatus.COMPLETED,
+                Appointment.service_date >= today
+            ).group_by(Appointment.provider_id, Appointment.service_date))
+        finally:
+            self.rebuild_buffer = None
+
+        queues: Dict[QueueKey, ProviderDayQueue] = {}
+        active: Dict[int, Tuple[int, date, int]] = {}
+        self.instance_id = uuid.uuid4().hex[:12]
+
+        for provider_id, day, last_token in completed_result.all():
+            key = (provider_id, day)
+            queues[key] = ProviderDayQueue(*key)
+            queues[key].last_completed_token = last_token or 0
+
+        for appointment_id, provider_id, day, token, status in active_result.all():
+            key = (provider_id, day)
+            queue = queues.get(key)
+            if queue is None:
+                queue = queues[key] = ProviderDayQueue(*key)
+            if status == AppointmentStatus.IN_PROGRESS:
+                queue.serving_token = token
+                queue.serving_id = appointment_id
+            else:
+                queue.add_waiting(token, appointment_id)
+            active[appointment_id] = (provider_id, key[1], token)
+
+        for queue in queues.values():
+            queue.version = (self.instance_id, 0)
+
+        self.queues = queues
+        self.active = active
+        self.snapshots = {}
+        self.today = today
+        self.loaded_at = loaded_at
+        self.is_loaded = True
+        # Committed before loaded_at means the SELECTs saw it; later ones may have been missed
+        for transition in buffered:
+            if transition.changed_at >= loaded_at:
+                self._merge(transition)
+        print(f"Queue state rebuilt: {len(queues)} queues, {len(active)} active appointments.")
+
+    def get_queue(self, provider_id: int, day: date) -> Optional[ProviderDayQueue]:
+        return self.queues.get((provider_id, day))
+
+    def apply(self, appointment: Appointment):
+        """Mirror a committed appointment row into its queue."""
+        transition = QueueTransition(
+            appointment.id, appointment.provider_id, appointment.service_date,
+            appointment.token_number, AppointmentStatus(appointment.status), time.time()
+        )
+        self._apply(transition)
+        self.pending.setdefault((transition.provider_id, transition.service_date), []).append(transition)
+        if self.rebuild_buffer is not None:
+            self.rebuild_buffer.append(transition)
+
+    def replay(self, transition: QueueTransition) -> bool:
+        """
+        Apply a transition committed by another worker; False when it is ignored.
+
+        Transitions of different appointments commute, so concurrent changes
+        on two workers end in the same state on both. One that is older than
+        what this engine already has for the appointment (a delayed or
+        reordered message) is dropped instead of rolling it back.
+        """
+        if self.rebuild_buffer is not None:
+            # Merged into the rebuilt queues if the database read may have missed it
+            self.rebuild_buffer.append(transition)
+            return False
+        if not self.is_loaded or transition.changed_at < self.loaded_at:
+            # The (next) rebuild reads the database, which is already newer
+            return False
+        return self._merge(transition)
+
+    def _merge(self, transition: QueueTransition) -> bool:
+        queue = self.queues.get((transition.provider_id, transition.service_date))
+        if queue is not None and queue.changed_at.get(transition.id, transition.changed_at) > transition.changed_at:
+            return False
+        self._apply(transition)
+        return True
+
+    def _apply(self, transition: QueueTransition):
+        key = (transition.provider_id, transition.service_date)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = ProviderDayQueue(*key)
+        self.bump(queue)
+        queue.changed_at[transition.id] = transition.changed_at
+
+        token = transition.token_number
+        queue.remove_waiting(token)
+        if transition.id in queue.finished:
+            queue.finished = {k: v for k, v in queue.finished.items() if k != transition.id}
+        if queue.serving_id == transition.id:
+            queue.serving_token = 0
+            queue.serving_id = None
+
+        if transition.status == AppointmentStatus.SCHEDULED:
+            queue.add_waiting(token, transition.id)
+            self.active[transition.id] = (key[0], key[1], token)
+        elif transition.status == AppointmentStatus.IN_PROGRESS:
+            queue.serving_token = token
+            queue.serving_id = transition.id
+            self.active[transition.id] = (key[0], key[1], token)
+        else:
+            if transition.status == AppointmentStatus.COMPLETED:
+                queue.last_completed_token = max(queue.last_completed_token, token)
+            queue.finished = {**queue.finished, transition.id: transition.status}
+            self.active.pop(transition.id, None)
+
+    def evict_past_days(self):
+        """Drop queues of days that are over; live queues only ever cover today and later."""
+        today = datetime.now().date()
+        if today == self.today:
+            return
+        for key in [key for key in self.queues if key[1] < today]:
+            queue = self.queues.pop(key)
+            for appointment_id in queue.waiting_ids.values():
+                self.active.pop(appointment_id, None)
+            self.active.pop(queue.serving_id, None)
+            self.snapshots.pop(key, None)
+            self.pending.pop(key, None)
+        self.today = today
+
+    def bump(self, queue: ProviderDayQueue):
+        """
+        Mark a queue as changed: new version, cached snapshot dropped.
+
+        Versions are (instance id, counter). The counter only grows and the
+        instance id keeps two engines (or one engine before and after a
+        restart) from ever issuing the same version for different states.
+        """
+        queue.version = (self.instance_id, queue.version[1] + 1)
+        self.snapshots.pop((queue.provider_id, queue.day), None)
+
+    def queue_version(self, appointment_id: int) -> Optional[str]:
+        """Version of the queue an active appointment is in, for ETags."""
+        entry = self.active.get(appointment_id)
+        if entry is None:
+            return None
+        instance_id, counter = self.queues[(entry[0], entry[1])].version
+        return f"{instance_id}.{counter}"
+
+    def cached_snapshot(self, provider_id: int, day: date) -> QueueSnapshot:
+        """Snapshot of one queue, shared by every reader until the queue changes."""
+        key = (provider_id, day)
+        now = time.monotonic()
+        cached = self.snapshots.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        queue = self.queues.get(key)
+        if queue is None:
+            # Days with no live queue (e.g. past days) get an empty snapshot, not cached
+            return ProviderDayQueue(*key).snapshot()
+        snapshot = queue.snapshot()
+        self.snapshots[key] = (now + SNAPSHOT_TTL_SECONDS, snapshot)
+        return snapshot
+
+    def add_listener(self, listener: Callable[[QueueSnapshot, List[QueueTransition]], Awaitable[None]]):
+        self.listeners.append(listener)
+
+    async def publish(self, provider_id: int, day: date):
+        """Push one snapshot of a queue, and the transitions since the last push, to every listener."""
+        transitions = self.pending.pop((provider_id, day), [])
+        if self.get_queue(provider_id, day) is None:
+            return
+        # Also warms the cache for the reconnects that usually follow a push
+        snapshot = self.cached_snapshot(provider_id, day)
+        for listener in self.listeners:
+            try:
+                await listener(snapshot, transitions)
+            except Exception as e:
+                print(f"Queue listener error: {e}")
+
+    def queue_position(self, appointment_id: int) -> Optional[dict]:
+        """Position for an active appointment, or None when it is not tracked here."""
+        entry = self.active.get(appointment_id)
+        if entry is None:
+            return None
+        provider_id, day, token = entry
+        queue = self.queues[(provider_id, day)]
+
+        if token not in queue.waiting_ids:
+            # Being served right now
+            return {"position": 0, "wait_time": 0, "current_token": 0, "your_token": 0}
+
+        people_ahead = queue.people_ahead(token)
+        return {
+            "position": people_ahead,
+            "wait_time": people_ahead * MINUTES_PER_PERSON,
+            "current_token": queue.current_token,
+            "your_token": token
+        }
+
+queue_engine = QueueStateEngine()
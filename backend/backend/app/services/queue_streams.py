@@ -0,0 +1,116 @@
+import asyncio
+import json
+from datetime import date
+from typing import AsyncIterator, Dict, Optional, Set
+from app.models import AppointmentStatus
+from app.services.queue_state import QueueKey, QueueSnapshot, queue_engine
+
+# Comment line sent when nothing changed for a while, so proxies keep the stream open
+KEEPALIVE_SECONDS = 15.0
+# Reconnect delay suggested to EventSource clients
+RETRY_MILLISECONDS = 3000
+
+TERMINAL_STATUSES = (AppointmentStatus.COMPLETED, AppointmentStatus.CANCELLED)
+
+def event_id(update: dict) -> str:
+    # Derived from the payload itself, so it means the same thing on every worker
+    return f"{update['status']}.{update['position']}.{update['current_token']}"
+
+def format_event(update: dict) -> str:
+    data = {
+        "appointment_id": update["appointment_id"],
+        "status": update["status"],
+        "position": update["position"],
+        "wait_time": update["wait_time"],
+        "current_token": update["current_token"],
+        "your_token": update["your_token"],
+    }
+    return f"id: {event_id(update)}\nevent: position\ndata: {json.dumps(data)}\n\n"
+
+class QueueStream:
+    """One SSE client following one appointment; holds only the latest snapshot."""
+
+    __slots__ = ("appointment_id", "key", "token", "status", "snapshot", "waiter")
+
+    def __init__(self, appointment_id: int, provider_id: int, day: date, token: int,
+                 status: Optional[AppointmentStatus]):
+        self.appointment_id = appointment_id
+        self.key = (provider_id, day)
+        self.token = token
+        # Fallback status for an appointment that already left the queue
+        self.status = status
+        self.snapshot: Optional[QueueSnapshot] = None
+        self.waiter: Optional[asyncio.Future] = None
+
+    def put(self, snapshot: QueueSnapshot):
+        self.snapshot = snapshot
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def next_snapshot(self, timeout: float) -> Optional[QueueSnapshot]:
+        if self.snapshot is None:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiter = None
+        snapshot, self.snapshot = self.snapshot, None
+        return snapshot
+
+    def update_for(self, snapshot: QueueSnapshot) -> dict:
+        return snapshot.update_for(self.appointment_id, self.token, self.status)
+
+class QueueStreamHub:
+    """Routes every queue snapshot this worker sees to the SSE streams of that queue."""
+
+    def __init__(self):
+        self.streams: Dict[QueueKey, Set[QueueStream]] = {}
+
+    def open(self, appointment_id: int, provider_id: int, day: date, token: int,
+             status: Optional[AppointmentStatus]) -> QueueStream:
+        stream = QueueStream(appointment_id, provider_id, day, token, status)
+        self.streams.setdefault(stream.key, set()).add(stream)
+        return stream
+
+    def close(self, stream: QueueStream):
+        streams = self.streams.get(stream.key)
+        if streams is not None:
+            streams.discard(stream)
+            if not streams:
+                del self.streams[stream.key]
+
+    def deliver(self, snapshot: QueueSnapshot):
+        for stream in self.streams.get((snapshot.provider_id, snapshot.day), ()):
+            stream.put(snapshot)
+
+    async def events(self, appointment_id: int, provider_id: int, day: date, token: int,
+                     status: Optional[AppointmentStatus], last_event_id: Optional[str]) -> AsyncIterator[str]:
+        """
+        SSE body for one appointment: its current position, then one event per change.
+
+        A client resuming with the id of the state it already has gets no
+        initial event. The stream ends once the appointment leaves the queue.
+        """
+        # Opened here, not by the caller, so a body that never starts leaves nothing behind
+        stream = self.open(appointment_id, provider_id, day, token, status)
+        try:
+            yield f"retry: {RETRY_MILLISECONDS}\n\n"
+            snapshot = queue_engine.cached_snapshot(provider_id, day)
+            while True:
+                if snapshot is None:
+                    yield ": keepalive\n\n"
+                else:
+                    update = stream.update_for(snapshot)
+                    current_id = event_id(update)
+                    if current_id != last_event_id:
+                        last_event_id = current_id
+                        yield format_event(update)
+                    if AppointmentStatus(update["status"]) in TERMINAL_STATUSES:
+                        return
+                snapshot = await stream.next_snapshot(KEEPALIVE_SECONDS)
+        finally:
+            self.close(stream)
+
+queue_streams = QueueStreamHub()
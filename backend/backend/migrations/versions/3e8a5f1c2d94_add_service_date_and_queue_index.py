@@ -0,0 +1,36 @@
+"""Add service_date and queue index
+
+Revision ID: 3e8a5f1c2d94
+Revises: 9c41d2e7a8b3
+Create Date: 2026-10-18 11:03:27.904512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3e8a5f1c2d94'
+down_revision: Union[str, Sequence[str], None] = '9c41d2e7a8b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('appointments', sa.Column('service_date', sa.Date(), nullable=True))
+    # Backfill from date_time; date() exists on both SQLite and PostgreSQL
+    op.execute("UPDATE appointments SET service_date = date(date_time)")
+    with op.batch_alter_table('appointments') as batch_op:
+        batch_op.alter_column('service_date', existing_type=sa.Date(), nullable=False)
+    op.create_index('ix_appointments_queue', 'appointments',
+                    ['provider_id', 'service_date', 'status', 'token_number'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_appointments_queue', table_name='appointments')
+    with op.batch_alter_table('appointments') as batch_op:
+        batch_op.drop_column('service_date')
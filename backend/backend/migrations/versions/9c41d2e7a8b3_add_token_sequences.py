@@ -0,0 +1,40 @@
+"""Add token sequences
+
+Revision ID: 9c41d2e7a8b3
+Revises: f2b5c6b77fe5
+Create Date: 2026-10-18 10:12:44.318201
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c41d2e7a8b3'
+down_revision: Union[str, Sequence[str], None] = 'f2b5c6b77fe5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('token_sequences',
+    sa.Column('provider_id', sa.Integer(), nullable=False),
+    sa.Column('service_date', sa.Date(), nullable=False),
+    sa.Column('last_token', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['provider_id'], ['providers.id'], ),
+    sa.PrimaryKeyConstraint('provider_id', 'service_date')
+    )
+    # Continue numbering from the tokens already handed out
+    op.execute(
+        "INSERT INTO token_sequences (provider_id, service_date, last_token) "
+        "SELECT provider_id, date(date_time), MAX(token_number) FROM appointments "
+        "GROUP BY provider_id, date(date_time)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('token_sequences')
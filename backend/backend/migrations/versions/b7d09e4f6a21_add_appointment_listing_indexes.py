@@ -0,0 +1,32 @@
+"""Add appointment listing indexes
+
+Revision ID: b7d09e4f6a21
+Revises: 3e8a5f1c2d94
+Create Date: 2026-10-18 12:41:09.552873
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d09e4f6a21'
+down_revision: Union[str, Sequence[str], None] = '3e8a5f1c2d94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_appointments_user_listing', 'appointments',
+                    ['user_id', 'date_time', 'id'], unique=False)
+    op.create_index('ix_appointments_provider_listing', 'appointments',
+                    ['provider_id', 'date_time', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_appointments_provider_listing', table_name='appointments')
+    op.drop_index('ix_appointments_user_listing', table_name='appointments')
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.future import select
+from sqlalchemy import insert
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.database.db import Base
+from app.ml import features
+from app.models import User, Provider, Appointment, AppointmentStatus
+
+# Training-data extraction throughput: the column-only chunked loader against
+# the ORM-entity + list-of-dicts loop it replaced (run on a prefix, it is slow).
+# Also reports the longest event-loop stall and the peak traced memory of one
+# extraction, both of which should stay flat as history grows.
+# Usage: python scripts/bench_feature_extraction.py --rows 5000000
+
+async def seed(session: AsyncSession, rows: int, users: int, providers: int):
+    await session.execute(insert(User), [
+        {"username": f"bench_u{i}", "email": f"bench{i}@example.com", "password_hash": "x"}
+        for i in range(users)
+    ])
+    await session.execute(insert(Provider), [
+        {"username": f"bench_p{i}", "name": f"Bench Provider {i}", "profession": "Doctor", "password_hash": "x"}
+        for i in range(providers)
+    ])
+    rng = np.random.default_rng(0)
+    start = datetime(2022, 1, 1, 8, 0)
+    batch = 100_000
+    for offset in range(0, rows, batch):
+        n = min(batch, rows - offset)
+        minutes = rng.integers(0, 4 * 365 * 24 * 60, n)
+        user_ids = rng.integers(1, users + 1, n)
+        provider_ids = rng.integers(1, providers + 1, n)
+        tokens = rng.integers(1, 40, n)
+        durations = rng.normal(15, 4, n)
+        ratings = rng.integers(1, 6, n)
+        await session.execute(insert(Appointment), [
+            {
+                "user_id": int(user_ids[i]), "provider_id": int(provider_ids[i]), "service_name": "Consultation",
+                "date_time": start + timedelta(minutes=int(minutes[i])), "token_number": int(tokens[i]),
+                "status": AppointmentStatus.COMPLETED, "actual_duration": float(durations[i]),
+                "started_at": start, "user_rating": int(ratings[i])
+            }
+            for i in range(n)
+        ])
+        print(f"  {offset + n} rows", end="\r", flush=True)
+    await session.commit()
+    print()
+
+async def orm_loop(session: AsyncSession, limit: int) -> pd.DataFrame:
+    # The previous WaitTimePredictor.train body
+    result = await session.execute(select(Appointment).where(
+        Appointment.status == "COMPLETED",
+        Appointment.actual_duration.isnot(None),
+        Appointment.started_at.isnot(None)
+    ).limit(limit))
+    data = []
+    for apt in result.scalars().all():
+        data.append({
+            "hour": apt.date_time.hour,
+            "day_of_week": apt.date_time.weekday(),
+            "tokens_ahead": apt.token_number - 1,
+            "actual_duration": apt.actual_duration
+        })
+    return pd.DataFrame(data)
+
+async def stalls_and_peak(session: AsyncSession):
+    # A ticker that should get a turn at least every millisecond
+    longest = 0.0
+    async def ticker():
+        nonlocal longest
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            longest, last = max(longest, now - last), now
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    tracemalloc.start()
+    try:
+        X, y = await features.wait_time_training_data(session)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        task.cancel()
+    return longest, peak, X.nbytes + y.nbytes
+
+async def main(rows: int, legacy_rows: int, users: int, providers: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench_features.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with SessionLocal() as session:
+        print(f"Seeding {rows} completed appointments...")
+        await seed(session, rows, users, providers)
+
+    async with SessionLocal() as session:
+        start = time.perf_counter()
+        X, y = await features.wait_time_training_data(session)
+        elapsed = time.perf_counter() - start
+        print(f"Wait-time features, chunked arrays: {len(y)} rows in {elapsed:6.2f} s, "
+              f"{len(y) / elapsed:10,.0f} rows/s, {X.nbytes / 2**20:.0f} MB")
+
+        start = time.perf_counter()
+        users_, providers_, ratings = await features.rating_data(session)
+        elapsed = time.perf_counter() - start
+        print(f"Rating triples, chunked arrays:     {len(ratings)} rows in {elapsed:6.2f} s, "
+              f"{len(ratings) / elapsed:10,.0f} rows/s")
+
+        stall, peak, result = await stalls_and_peak(session)
+        print(f"Longest event-loop stall {stall * 1000:.0f} ms; peak traced memory "
+              f"{peak / 2**20:.0f} MB for {result / 2**20:.0f} MB of arrays")
+
+    async with SessionLocal() as session:
+        start = time.perf_counter()
+        df = await orm_loop(session, legacy_rows)
+        elapsed = time.perf_counter() - start
+        print(f"Wait-time features, ORM + dicts:    {len(df)} rows in {elapsed:6.2f} s, "
+              f"{len(df) / elapsed:10,.0f} rows/s")
+
+    await engine.dispose()
+    os.remove(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--legacy-rows", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--providers", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.legacy_rows, args.users, args.providers))
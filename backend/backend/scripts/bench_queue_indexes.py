@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import insert, text
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.database.db import Base
+from app.models import User, Provider, Appointment, AppointmentStatus
+
+# Seeds a large appointments table and compares the queue queries before
+# (date_time ranges, single-column indexes) and after (service_date equality,
+# ix_appointments_queue). Runs on SQLite by default; pass --postgres-url to
+# repeat it on PostgreSQL, e.g. postgresql+asyncpg://postgres@/postgres?host=/tmp/pgdata
+#
+# Usage: python scripts/bench_queue_indexes.py --rows 1000000 [--postgres-url URL]
+
+PROVIDERS = 200
+TOKENS_PER_DAY = 25
+
+# Appointment indexes of the initial migration; the "before" phase runs with these alone
+BASELINE_INDEXES = {"ix_appointments_id", "ix_appointments_provider_id", "ix_appointments_user_id"}
+
+def added_indexes():
+    # Everything later migrations put on appointments (queue, listings, ...)
+    return [index for index in Appointment.__table__.indexes if index.name not in BASELINE_INDEXES]
+
+BEFORE_QUERIES = {
+    "serving": """
+        SELECT id FROM appointments
+        WHERE provider_id = :provider_id AND status = 'IN_PROGRESS'
+          AND date_time >= :start_of_day AND date_time <= :end_of_day
+        LIMIT 1""",
+    "next waiting": """
+        SELECT id FROM appointments
+        WHERE provider_id = :provider_id AND status = 'SCHEDULED'
+          AND date_time >= :start_of_day AND date_time <= :end_of_day
+        ORDER BY token_number LIMIT 1""",
+    "last completed": """
+        SELECT max(token_number) FROM appointments
+        WHERE provider_id = :provider_id AND status = 'COMPLETED'
+          AND date_time >= :start_of_day AND date_time <= :end_of_day""",
+}
+
+AFTER_QUERIES = {
+    "serving": """
+        SELECT id FROM appointments
+        WHERE provider_id = :provider_id AND service_date = :day AND status = 'IN_PROGRESS'
+        LIMIT 1""",
+    "next waiting": """
+        SELECT id FROM appointments
+        WHERE provider_id = :provider_id AND service_date = :day AND status = 'SCHEDULED'
+        ORDER BY token_number LIMIT 1""",
+    "last completed": """
+        SELECT max(token_number) FROM appointments
+        WHERE provider_id = :provider_id AND service_date = :day AND status = 'COMPLETED'""",
+}
+
+async def seed(conn, rows: int):
+    await conn.execute(insert(User), [
+        {"username": "bench_user", "email": "bench@example.com", "password_hash": "x"}
+    ])
+    await conn.execute(insert(Provider), [
+        {"username": f"bench_p{i}", "name": f"Bench Provider {i}", "profession": "Doctor", "password_hash": "x"}
+        for i in range(PROVIDERS)
+    ])
+
+    days = max(1, rows // (PROVIDERS * TOKENS_PER_DAY))
+    today = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+    batch = []
+    for day in range(days):
+        day_start = today - timedelta(days=day)
+        for provider_id in range(1, PROVIDERS + 1):
+            for token in range(1, TOKENS_PER_DAY + 1):
+                status = AppointmentStatus.COMPLETED
+                if day == 0:
+                    status = AppointmentStatus.SCHEDULED if token > 10 else status
+                    status = AppointmentStatus.IN_PROGRESS if token == 10 else status
+                date_time = day_start + timedelta(minutes=15 * token)
+                batch.append({
+                    "user_id": 1, "provider_id": provider_id, "service_name": "Consultation",
+                    "date_time": date_time, "service_date": date_time.date(),
+                    "token_number": token, "status": status
+                })
+        if len(batch) >= 50000:
+            await conn.execute(insert(Appointment), batch)
+            batch = []
+    if batch:
+        await conn.execute(insert(Appointment), batch)
+    return days * PROVIDERS * TOKENS_PER_DAY
+
+def params_for(provider_id: int):
+    today = datetime.now().date()
+    return {
+        "provider_id": provider_id,
+        "day": today,
+        "start_of_day": datetime.combine(today, datetime.min.time()),
+        "end_of_day": datetime.combine(today, datetime.max.time()),
+    }
+
+async def explain(conn, dialect: str, sql: str):
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    result = await conn.execute(text(prefix + sql), params_for(1))
+    if dialect == "sqlite":
+        return [row[-1] for row in result.all()]
+    return [row[0] for row in result.all()]
+
+async def run_queries(conn, dialect: str, queries: dict, runs: int):
+    for name, sql in queries.items():
+        plan = await explain(conn, dialect, sql)
+        # Warm the page cache so both phases are measured hot
+        for provider_id in range(1, PROVIDERS + 1):
+            await conn.execute(text(sql), params_for(provider_id))
+        start = time.perf_counter()
+        for _ in range(runs):
+            await conn.execute(text(sql), params_for(random.randint(1, PROVIDERS)))
+        elapsed_us = (time.perf_counter() - start) / runs * 1e6
+        print(f"  {name:<15} {elapsed_us:10.1f} us/query")
+        for line in plan:
+            print(f"      {line}")
+
+async def bench(url: str, rows: int, runs: int):
+    engine = create_async_engine(url)
+    dialect = engine.dialect.name
+    print(f"\n=== {dialect} ===")
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        # Start from the pre-migration index set
+        for index in added_indexes():
+            await conn.execute(text(f"DROP INDEX {index.name}"))
+
+    async with engine.begin() as conn:
+        start = time.perf_counter()
+        seeded = await seed(conn, rows)
+        print(f"Seeded {seeded} appointments in {time.perf_counter() - start:.1f}s")
+
+    async with engine.begin() as conn:
+        await conn.execute(text("ANALYZE"))
+        print("Before (date_time ranges, single-column indexes):")
+        await run_queries(conn, dialect, BEFORE_QUERIES, runs)
+
+    async with engine.begin() as conn:
+        start = time.perf_counter()
+        await conn.run_sync(lambda sync_conn: [index.create(sync_conn) for index in added_indexes()])
+        await conn.execute(text("ANALYZE"))
+        names = ", ".join(index.name for index in added_indexes())
+        print(f"Built {names} in {time.perf_counter() - start:.1f}s")
+
+    async with engine.begin() as conn:
+        print("After (service_date equality, current index set):")
+        await run_queries(conn, dialect, AFTER_QUERIES, runs)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+
+async def main(rows: int, runs: int, postgres_url: str):
+    path = os.path.join(tempfile.mkdtemp(), "bench_queue_indexes.db")
+    await bench(f"sqlite+aiosqlite:///{path}", rows, runs)
+    if postgres_url:
+        await bench(postgres_url, rows, runs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--postgres-url", default=os.environ.get("BENCH_POSTGRES_URL"))
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.runs, args.postgres_url))
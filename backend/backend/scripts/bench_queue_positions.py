@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.database.db import Base
+from app.services import appointment_service
+from app.services.queue_state import queue_engine
+from bench_queue_state import seed
+
+# Compares resolving N queue positions with N single lookups against one bulk
+# lookup. Usage: python scripts/bench_queue_positions.py --batch 50
+
+async def timed(label: str, runs: int, batch: int, fn):
+    start = time.perf_counter()
+    for _ in range(runs):
+        await fn()
+    elapsed_ms = (time.perf_counter() - start) / runs * 1000
+    print(f"{label:<32} {elapsed_ms:9.2f} ms per {batch} positions")
+    return elapsed_ms
+
+async def main(providers: int, waiting: int, batch: int, runs: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench_queue_positions.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with SessionLocal() as session:
+        await seed(session, providers, waiting, history_days=5)
+        await queue_engine.rebuild(session)
+        active_ids = list(queue_engine.active)
+
+        # A kiosk screen shows appointments spread across a few providers
+        ids = random.sample(active_ids, batch)
+
+        async def individual_db():
+            for appointment_id in ids:
+                await appointment_service.get_queue_position_from_db(session, appointment_id)
+
+        async def bulk_db():
+            await appointment_service.get_queue_positions_from_db(session, ids)
+
+        async def bulk_engine():
+            await appointment_service.get_queue_positions(session, ids)
+
+        single = await timed("N individual SQL lookups", runs, batch, individual_db)
+        bulk = await timed("1 bulk SQL lookup", runs, batch, bulk_db)
+        cached = await timed("1 bulk lookup (queue engine)", runs, batch, bulk_engine)
+
+    print(f"Bulk SQL speedup:    {single / bulk:8.1f}x")
+    print(f"Bulk engine speedup: {single / cached:8.1f}x")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--providers", type=int, default=20)
+    parser.add_argument("--waiting", type=int, default=300)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.providers, args.waiting, args.batch, args.runs))
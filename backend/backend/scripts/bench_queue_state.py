@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import insert
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.database.db import Base
+from app.models import User, Provider, Appointment, AppointmentStatus
+from app.services import appointment_service
+from app.services.queue_state import queue_engine
+
+# Compares queue-position reads served by the in-memory queue engine with the
+# SQL path they replace. Usage: python scripts/bench_queue_state.py --providers 50 --waiting 300
+
+async def seed(session: AsyncSession, providers: int, waiting: int, history_days: int):
+    await session.execute(insert(User), [
+        {"username": "bench_user", "email": "bench@example.com", "password_hash": "x"}
+    ])
+    await session.execute(insert(Provider), [
+        {"username": f"bench_p{i}", "name": f"Bench Provider {i}", "profession": "Doctor", "password_hash": "x"}
+        for i in range(providers)
+    ])
+
+    today = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+    rows = []
+    for provider_id in range(1, providers + 1):
+        # Older days pad the table the way a real history would
+        for day in range(1, history_days + 1):
+            for token in range(1, waiting + 1):
+                rows.append({
+                    "user_id": 1, "provider_id": provider_id, "service_name": "Consultation",
+                    "date_time": today - timedelta(days=day), "token_number": token,
+                    "status": AppointmentStatus.COMPLETED
+                })
+        for token in range(1, waiting + 1):
+            status = AppointmentStatus.COMPLETED if token < 5 else AppointmentStatus.SCHEDULED
+            if token == 5:
+                status = AppointmentStatus.IN_PROGRESS
+            rows.append({
+                "user_id": 1, "provider_id": provider_id, "service_name": "Consultation",
+                "date_time": today, "token_number": token, "status": status
+            })
+        if len(rows) > 50000:
+            await session.execute(insert(Appointment), rows)
+            rows = []
+    if rows:
+        await session.execute(insert(Appointment), rows)
+    await session.commit()
+
+async def time_reads(session: AsyncSession, appointment_ids, read):
+    start = time.perf_counter()
+    for appointment_id in appointment_ids:
+        await read(session, appointment_id)
+    elapsed = time.perf_counter() - start
+    return elapsed / len(appointment_ids) * 1e6
+
+async def main(providers: int, waiting: int, history_days: int, reads: int):
+    path = os.path.join(tempfile.mkdtemp(), "bench_queue_state.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with SessionLocal() as session:
+        print(f"Seeding {providers} providers x {waiting} tokens ({history_days} days of history)...")
+        await seed(session, providers, waiting, history_days)
+
+        start = time.perf_counter()
+        await queue_engine.rebuild(session)
+        print(f"Rebuild from DB: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        waiting_ids = list(queue_engine.active)[:reads]
+        sql_us = await time_reads(session, waiting_ids, appointment_service.get_queue_position_from_db)
+        engine_us = await time_reads(session, waiting_ids, appointment_service.get_queue_position)
+
+    print(f"SQL path:    {sql_us:10.1f} us/read")
+    print(f"Queue state: {engine_us:10.1f} us/read")
+    print(f"Speedup:     {sql_us / engine_us:10.1f}x")
+
+    await engine.dispose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--providers", type=int, default=50)
+    parser.add_argument("--waiting", type=int, default=300)
+    parser.add_argument("--history-days", type=int, default=5)
+    parser.add_argument("--reads", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.providers, args.waiting, args.history_days, args.reads))
@@ -0,0 +1,94 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import cosine_similarity
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.ml.recommendation_engine import rating_matrix, neighbour_index
+
+# Memory, build time and per-request latency of the sparse rating matrix and
+# its item-item neighbour index at 1M synthetic users, against the dense pivot
+# + cosine_similarity it replaced (measured on a subset, since the full dense
+# frame would not fit in memory).
+# Usage: python scripts/bench_recommendations.py --users 1000000 --providers 20000
+
+def synthetic_visits(users: int, providers: int, visits_per_user: float, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    visits = int(users * visits_per_user)
+    # A few providers are far more popular than the rest
+    popularity = 1 / np.arange(1, providers + 1) ** 0.8
+    provider_ids = rng.choice(providers, visits, p=popularity / popularity.sum()) + 1
+    user_ids = rng.integers(1, users + 1, visits)
+    ratings = rng.integers(1, 6, visits).astype(float)
+    return user_ids, provider_ids, ratings
+
+def latencies(fn, user_ids) -> list:
+    result = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        fn(int(user_id))
+        result.append((time.perf_counter() - start) * 1000)
+    return sorted(result)
+
+def report(label: str, times: list):
+    p99 = times[int(len(times) * 0.99) - 1]
+    print(f"{label}: p50 {statistics.median(times):8.2f} ms, p99 {p99:8.2f} ms")
+
+def dense_baseline(users, providers, ratings, sample):
+    # The previous engine: pivot to a dense frame, cosine against every user per call
+    frame = pd.DataFrame({"user_id": users, "provider_id": providers, "rating": ratings})
+    matrix = frame.pivot_table(index="user_id", columns="provider_id", values="rating").fillna(0)
+
+    def recommend(user_id):
+        user_vector = matrix.loc[user_id].values.reshape(1, -1)
+        similar = cosine_similarity(matrix, user_vector).flatten().argsort()[::-1][1:6]
+        return matrix.iloc[similar].mean(axis=0).sort_values(ascending=False).index.tolist()
+
+    return matrix, latencies(recommend, sample)
+
+def main(users: int, providers: int, visits_per_user: float, requests: int, dense_users: int):
+    user_ids, provider_ids, ratings = synthetic_visits(users, providers, visits_per_user)
+    print(f"{users} users, {providers} providers, {len(ratings)} rated visits")
+
+    start = time.perf_counter()
+    matrix = rating_matrix(user_ids, provider_ids, ratings)
+    print(f"Sparse build, matrix + index: {time.perf_counter() - start:.1f} s")
+    for workers in sorted({1, os.cpu_count()}):
+        start = time.perf_counter()
+        neighbour_index(matrix.ratings, workers=workers)
+        print(f"  neighbour index alone, {workers} thread(s): {time.perf_counter() - start:.1f} s")
+
+    sparse_bytes = sum(a.nbytes for a in matrix.to_arrays().values())
+    dense_bytes = len(matrix.user_ids) * len(matrix.provider_ids) * 8
+    index_bytes = matrix.neighbours.nbytes + matrix.similarities.nbytes
+    print(f"Sparse matrix + index: {sparse_bytes / 2**20:10.1f} MB ({matrix.ratings.nnz} nonzeros, "
+          f"index {index_bytes / 2**20:.1f} MB)")
+    print(f"Dense float64 frame:   {dense_bytes / 2**20:10.1f} MB (not built)")
+
+    rng = np.random.default_rng(1)
+    sample = rng.choice(matrix.user_ids, requests)
+    report(f"Sparse recommend(), {users} users", latencies(matrix.recommend, sample))
+
+    # Same data shape, cut down to a size the dense frame can hold
+    subset = user_ids <= dense_users
+    frame, times = dense_baseline(user_ids[subset], provider_ids[subset], ratings[subset],
+                                  rng.choice(np.unique(user_ids[subset]), min(requests, 200)))
+    report(f"Dense recommend(),  {len(frame)} users", times)
+    small = rating_matrix(user_ids[subset], provider_ids[subset], ratings[subset])
+    report(f"Sparse recommend(), {len(frame)} users", latencies(small.recommend, rng.choice(small.user_ids, requests)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--providers", type=int, default=20_000)
+    parser.add_argument("--visits-per-user", type=float, default=8)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--dense-users", type=int, default=5_000)
+    args = parser.parse_args()
+    main(args.users, args.providers, args.visits_per_user, args.requests, args.dense_users)
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.ml.wait_time_predictor import WaitTimePredictor
+
+# ETAs for a whole waiting room: one predict() per person (one forest traversal
+# each) against a single predict_batch() call, first on the forest and then on
+# the precomputed lookup table that training now builds.
+# Usage: python scripts/bench_wait_time_batch.py --queue 200
+
+def train(samples: int) -> WaitTimePredictor:
+    rng = np.random.default_rng(0)
+    X = np.column_stack([
+        rng.integers(9, 17, samples),
+        rng.integers(0, 7, samples),
+        rng.integers(0, 40, samples),
+    ]).astype(float)
+    y = 10 + X[:, 0] * 0.5 + rng.normal(0, 2, samples)
+    predictor = WaitTimePredictor()
+    predictor.model.fit(X, y)
+    predictor.is_trained = True
+    return predictor
+
+def timed(fn, runs: int) -> float:
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs * 1000
+
+def main(queue: int, samples: int, runs: int):
+    predictor = train(samples)
+    now = pd.Timestamp.now()
+    ahead = np.arange(queue)
+    print(f"{queue} waiting, model trained on {samples} samples")
+
+    per_token = timed(lambda: [predictor.predict(0, int(k), now) for k in ahead], runs)
+    batch = timed(lambda: predictor.predict_batch(ahead, now), runs)
+    print(f"Forest, per-token predict(): {per_token:10.3f} ms per queue")
+    print(f"Forest, predict_batch():     {batch:10.3f} ms per queue")
+
+    start = time.perf_counter()
+    predictor.build_table(int(ahead.max()))
+    print(f"Table built in {(time.perf_counter() - start) * 1000:.0f} ms, {predictor.table.nbytes / 1024:.0f} KB")
+
+    table_single = timed(lambda: predictor.predict(0, 10, now), runs * 1000)
+    table_per_token = timed(lambda: [predictor.predict(0, int(k), now) for k in ahead], runs)
+    table_batch = timed(lambda: predictor.predict_batch(ahead, now), runs * 100)
+    print(f"Table, single predict():     {table_single * 1000:10.1f} us")
+    print(f"Table, per-token predict():  {table_per_token:10.3f} ms per queue")
+    print(f"Table, predict_batch():      {table_batch:10.3f} ms per queue")
+    print(f"Batch speedup, table vs forest: {batch / table_batch:8.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queue", type=int, default=200)
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    main(args.queue, args.samples, args.runs)
@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+# Add parent directory to path to import app modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.services.queue_protocol import DeltaEncoder, JSON_DELTA, MSGPACK_DELTA
+from app.services.queue_state import ProviderDayQueue
+
+# Bytes on the wire and encode time per broadcast for one busy waiting room:
+# legacy full JSON (what send_json emits) against the delta subprotocols.
+# Every broadcast is one "call next" transition seen by every subscriber.
+# Usage: python scripts/bench_ws_protocol.py --subscribers 200 --transitions 50
+
+def legacy_json(update: dict) -> str:
+    # Same encoding Starlette's send_json uses
+    return json.dumps(update, separators=(",", ":"), ensure_ascii=False)
+
+def run(label: str, subscribers: int, transitions: int, make_encoder):
+    queue = ProviderDayQueue(1, datetime.now().date())
+    for token in range(1, subscribers + 1):
+        queue.add_waiting(token, token)
+    encoders = {token: make_encoder() for token in range(1, subscribers + 1)}
+
+    total_bytes = 0
+    encode_seconds = 0.0
+    broadcasts = 0
+    for _ in range(transitions + 1):
+        snapshot = queue.snapshot()
+        updates = [snapshot.update_for(token, token) for token in encoders]
+        start = time.perf_counter()
+        for token, update in zip(encoders, updates):
+            frame = encoders[token](update)
+            if frame is not None:
+                total_bytes += len(frame)
+        encode_seconds += time.perf_counter() - start
+        broadcasts += 1
+
+        # Call next: the first waiting token moves to the counter
+        next_token = queue.next_waiting()
+        if next_token is None:
+            break
+        queue.remove_waiting(next_token[0])
+        queue.serving_token, queue.serving_id = next_token
+
+    print(f"{label:<22} {total_bytes / broadcasts:12.0f} B/broadcast "
+          f"{encode_seconds / broadcasts * 1e6:10.0f} us/broadcast")
+    return total_bytes
+
+def main(subscribers: int, transitions: int):
+    print(f"{subscribers} subscribers, {transitions} transitions (first broadcast is a full snapshot)")
+    legacy = run("JSON full (default)", subscribers, transitions, lambda: legacy_json)
+    json_delta = run("JSON delta", subscribers, transitions, lambda: DeltaEncoder(JSON_DELTA).encode_update)
+    msgpack_delta = run("MessagePack delta", subscribers, transitions, lambda: DeltaEncoder(MSGPACK_DELTA).encode_update)
+    print(f"JSON delta saves        {1 - json_delta / legacy:8.1%} of bytes")
+    print(f"MessagePack delta saves {1 - msgpack_delta / legacy:8.1%} of bytes")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=200)
+    parser.add_argument("--transitions", type=int, default=50)
+    args = parser.parse_args()
+    main(args.subscribers, args.transitions)
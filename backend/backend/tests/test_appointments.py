@@ -1,8 +1,10 @@
+import json
 import pytest
 from httpx import AsyncClient, ASGITransport
 from datetime import datetime, timedelta
 from app.main import app
 from app.database.db import get_db, Base, engine
+from app.services import appointment_service
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
@@ -59,3 +61,154 @@ async def test_book_appointment():
     assert book_res.status_code == 200
     assert book_res.json()["token_number"] == 1
     assert book_res.json()["status"] == "SCHEDULED"
+
+@pytest.mark.asyncio
+async def test_book_appointments_batch():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        await ac.post("/auth/register/user", json={
+            "username": "corporate",
+            "password": "password",
+            "email": "corp@example.com"
+        })
+        login_res = await ac.post("/auth/login", data={"username": "corporate", "password": "password"})
+        headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+        
+        provider_ids = []
+        for i in range(2):
+            provider_res = await ac.post("/auth/register/provider", json={
+                "username": f"batchdoc{i}",
+                "password": "password",
+                "name": f"Dr. Batch {i}",
+                "profession": "Doctor"
+            })
+            provider_ids.append(provider_res.json()["id"])
+        
+        tomorrow = datetime.utcnow() + timedelta(days=1)
+        items = [
+            {"provider_id": provider_ids[0], "service_name": "Checkup", "date_time": tomorrow.isoformat()},
+            {"provider_id": provider_ids[1], "service_name": "Checkup", "date_time": tomorrow.isoformat()},
+            {"provider_id": 9999, "service_name": "Checkup", "date_time": tomorrow.isoformat()},
+            {"provider_id": provider_ids[0], "service_name": "Checkup", "date_time": tomorrow.isoformat()},
+            {"provider_id": provider_ids[0], "service_name": "Checkup", "date_time": (tomorrow + timedelta(days=1)).isoformat()},
+        ]
+        batch_res = await ac.post("/appointments/book/batch", json={"appointments": items}, headers=headers)
+        
+        # A single booking afterwards continues the same sequence
+        single_res = await ac.post("/appointments/book", json=items[0], headers=headers)
+        
+    assert batch_res.status_code == 200
+    body = batch_res.json()
+    assert body["booked"] == 4
+    assert body["failed"] == 1
+    assert [r["index"] for r in body["results"]] == [0, 1, 2, 3, 4]
+    assert body["results"][2]["error"] == "Provider not found"
+    tokens = [r["appointment"]["token_number"] if r["appointment"] else None for r in body["results"]]
+    assert tokens == [1, 1, None, 2, 1]
+    assert single_res.json()["token_number"] == 3
+
+@pytest.mark.asyncio
+async def test_appointment_listing_is_keyset_paginated():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        await ac.post("/auth/register/user", json={
+            "username": "regular",
+            "password": "password",
+            "email": "regular@example.com"
+        })
+        login_res = await ac.post("/auth/login", data={"username": "regular", "password": "password"})
+        headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+        provider_res = await ac.post("/auth/register/provider", json={
+            "username": "pagedoc",
+            "password": "password",
+            "name": "Dr. Page",
+            "profession": "Doctor"
+        })
+        provider_id = provider_res.json()["id"]
+        
+        start = datetime.utcnow() + timedelta(days=1)
+        items = [
+            {"provider_id": provider_id, "service_name": "Checkup", "date_time": (start + timedelta(days=i)).isoformat()}
+            for i in range(5)
+        ]
+        await ac.post("/appointments/book/batch", json={"appointments": items}, headers=headers)
+        
+        pages = []
+        cursor = None
+        while True:
+            params = {"limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            page_res = await ac.get("/appointments/user/me", params=params, headers=headers)
+            pages.append(page_res.json())
+            cursor = page_res.headers.get("x-next-cursor")
+            if len(pages) == 1:
+                first_cursor = cursor
+            if not cursor:
+                break
+        
+        filtered_res = await ac.get("/appointments/user/me", params={
+            "date_from": (start + timedelta(days=1)).date().isoformat(),
+            "date_to": (start + timedelta(days=2)).date().isoformat()
+        }, headers=headers)
+        cancelled_res = await ac.get("/appointments/user/me", params={"status": "CANCELLED"}, headers=headers)
+        bad_cursor_res = await ac.get("/appointments/user/me", params={"cursor": "bogus"}, headers=headers)
+        
+        # Clients that predate pagination still get everything
+        full_res = await ac.get("/appointments/user/me", headers=headers)
+        appointment_service.DEFAULT_PAGE_SIZE, previous = 2, appointment_service.DEFAULT_PAGE_SIZE
+        try:
+            cursor_only_res = await ac.get("/appointments/user/me", params={"cursor": first_cursor}, headers=headers)
+        finally:
+            appointment_service.DEFAULT_PAGE_SIZE = previous
+        
+    assert [len(page) for page in pages] == [2, 2, 1]
+    date_times = [a["date_time"] for page in pages for a in page]
+    assert date_times == sorted(date_times, reverse=True)
+    assert len({a["id"] for page in pages for a in page}) == 5
+    assert len(filtered_res.json()) == 2
+    assert cancelled_res.json() == []
+    assert bad_cursor_res.status_code == 400
+    assert [a["id"] for a in full_res.json()] == [a["id"] for page in pages for a in page]
+    assert "x-next-cursor" not in full_res.headers
+    assert cursor_only_res.json() == pages[1]
+
+@pytest.mark.asyncio
+async def test_export_provider_history():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        await ac.post("/auth/register/user", json={
+            "username": "exporter",
+            "password": "password",
+            "email": "exporter@example.com"
+        })
+        login_res = await ac.post("/auth/login", data={"username": "exporter", "password": "password"})
+        headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+        provider_res = await ac.post("/auth/register/provider", json={
+            "username": "exportdoc",
+            "password": "password",
+            "name": "Dr. Export",
+            "profession": "Accountant"
+        })
+        provider_id = provider_res.json()["id"]
+        provider_login = await ac.post("/auth/login", data={"username": "exportdoc", "password": "password"})
+        provider_headers = {"Authorization": f"Bearer {provider_login.json()['access_token']}"}
+        
+        start = datetime.utcnow() + timedelta(days=1)
+        items = [
+            {"provider_id": provider_id, "service_name": "Audit", "date_time": (start + timedelta(hours=i)).isoformat()}
+            for i in range(3)
+        ]
+        await ac.post("/appointments/book/batch", json={"appointments": items}, headers=headers)
+        
+        ndjson_res = await ac.get("/appointments/provider/me/export", headers=provider_headers)
+        csv_res = await ac.get("/appointments/provider/me/export", params={"format": "csv"}, headers=provider_headers)
+        
+    assert ndjson_res.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in ndjson_res.text.splitlines()]
+    assert [row["token_number"] for row in rows] == [1, 2, 3]
+    assert rows[0]["service_name"] == "Audit"
+    
+    lines = csv_res.text.splitlines()
+    assert lines[0].startswith("id,user_id,provider_id")
+    assert len(lines) == 4
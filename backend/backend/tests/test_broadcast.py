@@ -0,0 +1,353 @@
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import msgpack
+import pytest
+from datetime import datetime
+from fakeredis import TcpFakeServer
+from app.models import AppointmentStatus
+from app.routes.websockets import manager
+from app.services import queue_protocol
+from app.services.broadcast import RedisBroadcast
+from app.services.queue_state import queue_engine, ProviderDayQueue, QueueStateEngine, QueueTransition
+
+PUSHES = 200
+
+# Second worker: one socket subscribed to provider 1's queue as token 5.
+# Prints every pushed message with its receive time.
+WORKER = """
+import asyncio, json, sys, time
+from datetime import datetime
+from app.routes.websockets import manager
+from app.services.broadcast import RedisBroadcast
+from app.services.queue_state import queue_engine
+
+class PrintingWebSocket:
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_json(self, message):
+        print(json.dumps({"received_at": time.time(), "message": message}), flush=True)
+
+async def main():
+    # Nothing to rebuild from: the queue is built from the transitions alone
+    queue_engine.is_loaded = True
+    manager.use_backend(RedisBroadcast(sys.argv[1]))
+    await manager.backend.start()
+    websocket = PrintingWebSocket()
+    await manager.connect(websocket, "50")
+    manager.subscribe(websocket, 50, 1, datetime.now().date(), 5)
+    print("ready", flush=True)
+    await asyncio.Event().wait()
+
+asyncio.run(main())
+"""
+
+@pytest.fixture
+def redis_url():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"redis://127.0.0.1:{port}"
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def queue():
+    queue_engine.reset()
+    queue_engine.is_loaded = True
+    queue = ProviderDayQueue(1, datetime.now().date())
+    queue_engine.queues[(1, queue.day)] = queue
+    yield queue
+    queue_engine.reset()
+
+async def publish(queue):
+    # These tests edit the queue in place rather than through apply()
+    queue_engine.snapshots.clear()
+    await queue_engine.publish(queue.provider_id, queue.day)
+
+def queue_state(engine, day):
+    queue = engine.get_queue(1, day)
+    return tuple(queue.waiting), queue.serving_id, queue.last_completed_token, dict(queue.finished)
+
+def test_concurrent_transitions_converge_across_workers():
+    day = datetime.now().date()
+    first, second = QueueStateEngine(), QueueStateEngine()
+    for engine in (first, second):
+        engine.is_loaded = True
+        # Same starting queue on both: tokens 1 and 2 waiting
+        for appointment_id, token in [(10, 1), (20, 2)]:
+            engine.replay(QueueTransition(appointment_id, 1, day, token, AppointmentStatus.SCHEDULED, 1.0))
+
+    # At the same time, one worker books token 3 and the other calls token 1 in
+    first.apply(QueueTransition(30, 1, day, 3, AppointmentStatus.SCHEDULED, 0.0))
+    second.apply(QueueTransition(10, 1, day, 1, AppointmentStatus.IN_PROGRESS, 0.0))
+    second.apply(QueueTransition(20, 1, day, 2, AppointmentStatus.CANCELLED, 0.0))
+    from_first, from_second = first.pending.pop((1, day)), second.pending.pop((1, day))
+
+    # Each replays the other's changes, as shipped over the wire
+    for engine, transitions in [(first, from_second), (second, from_first)]:
+        for transition in transitions:
+            assert engine.replay(QueueTransition.from_dict(json.loads(json.dumps(transition.to_dict()))))
+    assert queue_state(first, day) == queue_state(second, day) == (
+        (3,), 10, 0, {20: AppointmentStatus.CANCELLED}
+    )
+    assert first.queue_position(30) == second.queue_position(30) == {
+        "position": 0, "wait_time": 0, "current_token": 1, "your_token": 3
+    }
+
+    # A delayed message does not roll a later change back
+    second.apply(QueueTransition(10, 1, day, 1, AppointmentStatus.COMPLETED, 0.0))
+    completed = second.pending.pop((1, day))[0]
+    assert first.replay(completed)
+    assert not first.replay(from_second[0])
+    assert queue_state(first, day) == queue_state(second, day) == (
+        (3,), None, 1, {10: AppointmentStatus.COMPLETED, 20: AppointmentStatus.CANCELLED}
+    )
+
+    # Neither does one committed before this engine last read the database
+    first.loaded_at = completed.changed_at + 1
+    assert not first.replay(from_first[0]._replace(status=AppointmentStatus.CANCELLED))
+
+@pytest.mark.asyncio
+async def test_redis_backend_pushes_to_other_worker(redis_url, queue):
+    worker = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", WORKER, redis_url, stdout=asyncio.subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    backend = RedisBroadcast(redis_url)
+    previous = manager.backend
+    manager.use_backend(backend)
+    try:
+        assert (await asyncio.wait_for(worker.stdout.readline(), 30)).strip() == b"ready"
+        await backend.start()
+
+        latencies = []
+        for i in range(PUSHES):
+            # Alternate between 0 and 1 people ahead of token 5
+            if i == 0:
+                queue_engine.apply(QueueTransition(50, 1, queue.day, 5, AppointmentStatus.SCHEDULED, 0.0))
+            elif i % 2:
+                queue_engine.apply(QueueTransition(100 + i, 1, queue.day, 3, AppointmentStatus.SCHEDULED, 0.0))
+            else:
+                queue_engine.apply(QueueTransition(99 + i, 1, queue.day, 3, AppointmentStatus.CANCELLED, 0.0))
+
+            sent_at = time.time()
+            await queue_engine.publish(queue.provider_id, queue.day)
+            line = json.loads(await asyncio.wait_for(worker.stdout.readline(), 5))
+            latencies.append((line["received_at"] - sent_at) * 1000)
+
+            assert line["message"]["appointment_id"] == 50
+            assert line["message"]["position"] == i % 2
+    finally:
+        worker.kill()
+        await worker.wait()
+        await backend.stop()
+        manager.use_backend(previous)
+
+    latencies.sort()
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"\nCross-worker push latency over {PUSHES} pushes: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+    assert p99 < 1000
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.received = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_json(self, message):
+        self.received.append((time.perf_counter(), message))
+
+    async def close(self, code=1000):
+        pass
+
+class StalledWebSocket(RecordingWebSocket):
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.closed_with = None
+
+    async def send_json(self, message):
+        await self.release.wait()
+        await super().send_json(message)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+async def connect_subscriber(websocket, appointment_id, token, day):
+    await manager.connect(websocket, str(appointment_id))
+    manager.subscribe(websocket, appointment_id, 1, day, token)
+
+@pytest.mark.asyncio
+async def test_slow_reader_gets_latest_snapshot_only(queue):
+    slow = StalledWebSocket()
+    await connect_subscriber(slow, 50, 5, queue.day)
+    queue.add_waiting(5, 50)
+    try:
+        # First send stalls; the three after it collapse into the newest
+        for ahead in range(4):
+            queue.add_waiting(ahead + 1, ahead + 10)
+            await publish(queue)
+            await asyncio.sleep(0)
+        slow.release.set()
+        await manager.flush()
+        assert [m["position"] for _, m in slow.received] == [1, 4]
+        assert manager.outboxes[slow].coalesced == 2
+    finally:
+        manager.disconnect(slow, "50")
+
+@pytest.mark.asyncio
+async def test_fan_out_latency_with_slow_readers(queue):
+    sockets, slow_sockets = 10_000, 5
+    previous_timeout = manager.send_timeout
+    manager.send_timeout = 2.0
+    fast = [RecordingWebSocket() for _ in range(sockets - slow_sockets)]
+    slow = [StalledWebSocket() for _ in range(slow_sockets)]
+    for i, websocket in enumerate(fast + slow):
+        queue.add_waiting(i + 1, i + 1)
+        await connect_subscriber(websocket, i + 1, i + 1, queue.day)
+
+    try:
+        latencies = []
+        for _ in range(10):
+            published_at = time.perf_counter()
+            await publish(queue)
+            drained = [manager.outboxes[w].wait_drained() for w in fast]
+            await asyncio.wait_for(asyncio.gather(*(f for f in drained if f is not None)), 10)
+            latencies.extend((w.received[-1][0] - published_at) * 1000 for w in fast)
+
+        # Stalled readers are closed and dropped instead of holding anyone up
+        await asyncio.sleep(manager.send_timeout * 2)
+        assert all(w.closed_with == 1013 and w not in manager.outboxes for w in slow)
+        assert manager.evictions == set()
+        assert all(len(w.received) == 10 for w in fast)
+
+        latencies.sort()
+        p50 = statistics.median(latencies)
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"\nFan-out to {sockets} sockets ({slow_sockets} stalled): p50 {p50:.1f} ms, p99 {p99:.1f} ms")
+        # Nobody waited on the stalled readers' send timeout
+        assert p99 < manager.send_timeout * 1000
+    finally:
+        for i, websocket in enumerate(fast + slow):
+            manager.disconnect(websocket, str(i + 1))
+        manager.send_timeout = previous_timeout
+    assert manager.queue_subscribers == {}
+
+@pytest.mark.asyncio
+async def test_heartbeats_reap_silent_connections(queue):
+    manager.heartbeat_interval, manager.idle_timeout = 0.05, 0.2
+    alive, silent = RecordingWebSocket(), StalledWebSocket()
+    silent.release.set()
+    await connect_subscriber(alive, 1, 1, queue.day)
+    await connect_subscriber(silent, 2, 2, queue.day)
+    try:
+        for _ in range(20):
+            await asyncio.sleep(0.025)
+            # Only one client answers the pings
+            if any(m == {"type": "ping"} for _, m in alive.received):
+                manager.touch(alive)
+
+        assert silent.closed_with == 1001
+        assert manager.evictions == set()
+        assert silent not in manager.outboxes
+        assert any(m == {"type": "ping"} for _, m in silent.received)
+        assert alive in manager.outboxes
+        assert manager.stats()["reaped_idle"] >= 1
+    finally:
+        manager.disconnect(alive, "1")
+        manager.disconnect(silent, "2")
+        manager.heartbeat_interval, manager.idle_timeout = 20.0, 60.0
+
+@pytest.mark.asyncio
+async def test_registry_memory_per_connection(queue):
+    import tracemalloc
+    sockets = 50_000
+    websockets = [RecordingWebSocket() for _ in range(sockets)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i, websocket in enumerate(websockets):
+        await connect_subscriber(websocket, i + 1, i + 1, queue.day)
+    await asyncio.sleep(0)
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / sockets
+    tracemalloc.stop()
+
+    try:
+        stats = manager.stats()
+        assert stats["connections"] == stats["queue_subscribers"] == sockets
+        assert stats["queues"] == 1
+        print(f"\nRegistry memory: {per_connection:.0f} bytes per connection at {sockets} connections")
+        assert per_connection < 4096
+        # The estimate stats() reports is calibrated against this measurement
+        assert abs(stats["registry_bytes_estimate"] - per_connection * sockets) < 0.25 * per_connection * sockets
+    finally:
+        for i, websocket in enumerate(websockets):
+            manager.disconnect(websocket, str(i + 1))
+    assert manager.stats()["connections"] == 0
+
+class BinaryWebSocket(RecordingWebSocket):
+    async def send_bytes(self, data):
+        self.received.append((time.perf_counter(), msgpack.unpackb(data)))
+        self.frames.append(data)
+
+    async def send_text(self, data):
+        self.received.append((time.perf_counter(), json.loads(data)))
+        self.frames.append(data)
+
+def test_subprotocol_negotiation():
+    assert queue_protocol.negotiate([]) is None
+    assert queue_protocol.negotiate(["graphql-ws", "queue.delta.json"]) == "queue.delta.json"
+    assert queue_protocol.negotiate(["queue.delta.msgpack", "queue.delta.json"]) == "queue.delta.msgpack"
+
+    resync = {"type": "resync"}
+    assert queue_protocol.decode("queue.delta.msgpack", {"bytes": msgpack.packb(resync)}) == resync
+    assert queue_protocol.decode("queue.delta.json", {"text": '{"type": "resync"}'}) == resync
+    assert queue_protocol.decode(None, {"text": "pong"}) is None
+
+@pytest.mark.asyncio
+async def test_msgpack_deltas_with_resync(queue):
+    websocket = BinaryWebSocket()
+    websocket.frames = []
+    await manager.connect(websocket, "50", queue_protocol.MSGPACK_DELTA)
+    manager.subscribe(websocket, 50, 1, queue.day, 5)
+    queue.add_waiting(3, 30)
+    queue.add_waiting(5, 50)
+    try:
+        await publish(queue)
+        await manager.flush()
+        queue.remove_waiting(3)
+        queue.serving_token, queue.serving_id = 3, 30
+        await publish(queue)
+        await manager.flush()
+        # Nothing changed for this subscriber, so nothing is sent
+        await publish(queue)
+        await manager.flush()
+        manager.resync(websocket)
+        await manager.flush()
+    finally:
+        manager.disconnect(websocket, "50")
+
+    messages = [m for _, m in websocket.received]
+    assert messages[0] == {
+        "type": "snapshot", "seq": 1, "appointment_id": 50, "provider_id": 1, "status": "SCHEDULED",
+        "position": 1, "wait_time": 15, "current_token": 0, "your_token": 5
+    }
+    assert messages[1] == {"type": "delta", "seq": 2, "position": 0, "wait_time": 0, "current_token": 3}
+    assert messages[2]["type"] == "snapshot" and messages[2]["seq"] == 3
+    assert len(messages) == 3
+    assert all(isinstance(frame, bytes) for frame in websocket.frames)
+    # The delta is a fraction of the legacy full JSON update
+    full = json.dumps(queue.snapshot().update_for(50, 5), separators=(",", ":"))
+    assert len(websocket.frames[1]) * 4 < len(full)
@@ -0,0 +1,526 @@
+import asyncio
+import time
+import pytest
+from httpx import AsyncClient, ASGITransport
+from starlette.requests import Request
+from datetime import datetime, timedelta
+from app.main import app
+from app.database.db import get_db, Base
+from app.ml.wait_time_predictor import wait_time_predictor
+from app.services import appointment_service
+from app.services.queue_state import queue_engine, QueueTransition
+from app.services.queue_streams import queue_streams
+from app.routes import appointments, websockets
+from app.routes.websockets import manager
+from sqlalchemy import event, select
+from app.models import Appointment, AppointmentStatus
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///./test_appointment_system.db"
+
+test_engine = create_async_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(test_engine, class_=AsyncSession, expire_on_commit=False, autocommit=False, autoflush=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as session:
+        yield session
+
+app.dependency_overrides[get_db] = override_get_db
+
+@pytest.fixture(autouse=True)
+async def setup_db():
+    queue_engine.reset()
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    queue_engine.reset()
+
+async def login(ac, username):
+    res = await ac.post("/auth/login", data={"username": username, "password": "password"})
+    return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+async def setup_queue(ac, patients=3):
+    provider_res = await ac.post("/auth/register/provider", json={
+        "username": "queuedoc",
+        "password": "password",
+        "name": "Dr. Queue",
+        "profession": "Doctor"
+    })
+    provider_id = provider_res.json()["id"]
+
+    appointment_ids = []
+    for i in range(patients):
+        await ac.post("/auth/register/user", json={
+            "username": f"patient{i}",
+            "password": "password",
+            "email": f"patient{i}@example.com"
+        })
+        headers = await login(ac, f"patient{i}")
+        book_res = await ac.post("/appointments/book", json={
+            "provider_id": provider_id,
+            "service_name": "Consultation",
+            "date_time": datetime.now().isoformat()
+        }, headers=headers)
+        appointment_ids.append(book_res.json()["id"])
+
+    return provider_id, appointment_ids
+
+@pytest.mark.asyncio
+async def test_queue_position_follows_transitions():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+
+        res = await ac.get(f"/appointments/{ids[2]}/queue-position")
+        assert res.json() == {"position": 2, "wait_time": 30, "current_token": 0, "your_token": 3}
+
+        provider_headers = await login(ac, "queuedoc")
+        next_res = await ac.post("/appointments/queue/next", headers=provider_headers)
+        assert next_res.json()["token_number"] == 1
+
+        res = await ac.get(f"/appointments/{ids[2]}/queue-position")
+        assert res.json()["position"] == 1
+        assert res.json()["current_token"] == 1
+
+        finish_res = await ac.post("/appointments/queue/finish", headers=provider_headers)
+        assert finish_res.json()["status"] == "COMPLETED"
+
+        # Nobody is being served, so the last completed token is reported
+        res = await ac.get(f"/appointments/{ids[2]}/queue-position")
+        assert res.json()["current_token"] == 1
+
+        next_res = await ac.post("/appointments/queue/next", headers=provider_headers)
+        assert next_res.json()["token_number"] == 2
+
+@pytest.mark.asyncio
+async def test_rebuild_matches_sql_path():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac, patients=4)
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        await ac.patch(f"/appointments/{ids[2]}/status", json={"status": "CANCELLED"}, headers=provider_headers)
+
+    async with TestingSessionLocal() as db:
+        await queue_engine.rebuild(db)
+        for appointment_id in ids:
+            in_memory = queue_engine.queue_position(appointment_id)
+            from_db = await appointment_service.get_queue_position_from_db(db, appointment_id)
+            if in_memory is not None:
+                assert in_memory == from_db
+
+    queue = queue_engine.get_queue(provider_id, datetime.now().date())
+    assert queue.serving_token == 1
+    assert queue.waiting == [2, 4]
+
+class PausedSession:
+    """Holds a session's results back until released, so a rebuild stays in flight."""
+    def __init__(self, db):
+        self.db = db
+        self.read = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def execute(self, *args, **kwargs):
+        result = await self.db.execute(*args, **kwargs)
+        self.read.set()
+        await self.release.wait()
+        return result
+
+@pytest.mark.asyncio
+async def test_transitions_during_rebuild_survive_the_swap():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac, patients=3)
+
+    async with TestingSessionLocal() as db:
+        queue_engine.reset()
+        paused = PausedSession(db)
+        rebuild = asyncio.create_task(queue_engine.ensure_loaded(paused))
+        await paused.read.wait()
+
+        # Committed after the rebuild's SELECTs ran: a booking here, a cancellation from another worker
+        today = datetime.now().date()
+        queue_engine.apply(Appointment(
+            id=999, provider_id=provider_id, service_date=today, token_number=4, status=AppointmentStatus.SCHEDULED
+        ))
+        cancelled = QueueTransition(ids[1], provider_id, today, 2, AppointmentStatus.CANCELLED, time.time())
+        assert not queue_engine.replay(cancelled)
+
+        paused.release.set()
+        await rebuild
+
+    queue = queue_engine.get_queue(provider_id, today)
+    assert queue.waiting == [1, 3, 4]
+    assert queue_engine.queue_position(999)["position"] == 2
+    assert queue_engine.queue_position(ids[1]) is None
+    # Still handed to the listeners on the next publish
+    assert [t.id for t in queue_engine.pending[(provider_id, today)]] == [999]
+
+@pytest.mark.asyncio
+async def test_snapshots_do_not_change_after_the_fact():
+    today = datetime.now().date()
+    queue_engine.is_loaded = True
+    for appointment_id, status in ((1, AppointmentStatus.SCHEDULED), (2, AppointmentStatus.CANCELLED)):
+        queue_engine.apply(Appointment(
+            id=appointment_id, provider_id=7, service_date=today, token_number=appointment_id, status=status
+        ))
+    snapshot = queue_engine.cached_snapshot(7, today)
+
+    queue_engine.apply(Appointment(id=1, provider_id=7, service_date=today, token_number=1, status=AppointmentStatus.COMPLETED))
+    queue_engine.apply(Appointment(id=2, provider_id=7, service_date=today, token_number=2, status=AppointmentStatus.SCHEDULED))
+
+    assert snapshot.finished == {2: AppointmentStatus.CANCELLED}
+    assert snapshot.update_for(2, 2)["status"] == "CANCELLED"
+    assert queue_engine.get_queue(7, today).finished == {1: AppointmentStatus.COMPLETED}
+
+@pytest.mark.asyncio
+async def test_next_and_finish_fall_back_to_database_when_engine_is_empty():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+
+        # As on a worker that never saw these transitions
+        queue_engine.reset()
+        queue_engine.is_loaded = True
+        finish_res = await ac.post("/appointments/queue/finish", headers=provider_headers)
+        assert finish_res.status_code == 200
+        assert finish_res.json()["id"] == ids[0]
+
+        queue_engine.reset()
+        queue_engine.is_loaded = True
+        next_res = await ac.post("/appointments/queue/next", headers=provider_headers)
+        assert next_res.json()["id"] == ids[1]
+        queue_engine.reset()
+        queue_engine.is_loaded = True
+        next_res = await ac.post("/appointments/queue/next", headers=provider_headers)
+        assert next_res.json()["id"] == ids[2]
+
+        async with TestingSessionLocal() as db:
+            result = await db.execute(select(Appointment.id, Appointment.status).order_by(Appointment.id))
+            assert [status for _, status in result.all()] == ["COMPLETED", "COMPLETED", "IN_PROGRESS"]
+
+@pytest.mark.asyncio
+async def test_past_days_are_evicted_from_queue_state():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+        await ac.get(f"/appointments/{ids[0]}/queue-position")
+        today = datetime.now().date()
+        assert queue_engine.get_queue(provider_id, today) is not None
+
+        # The worker runs past midnight
+        queue_engine.today = today - timedelta(days=1)
+        queue_engine.queues[(provider_id, queue_engine.today)] = queue_engine.queues.pop((provider_id, today))
+        queue_engine.cached_snapshot(provider_id, queue_engine.today)
+        await ac.get(f"/appointments/{ids[0]}/queue-position")
+
+        assert queue_engine.queues == {} and queue_engine.active == {} and queue_engine.snapshots == {}
+        assert queue_engine.today == today
+        # Days without a live queue are answered without being cached
+        queue_engine.cached_snapshot(provider_id, today - timedelta(days=2))
+        assert queue_engine.snapshots == {}
+
+@pytest.mark.asyncio
+async def test_bulk_queue_positions_match_single_lookups():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac, patients=4)
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        await ac.patch(f"/appointments/{ids[1]}/status", json={"status": "CANCELLED"}, headers=provider_headers)
+
+        requested = ids + [9999]
+        bulk_res = await ac.get("/appointments/queue-positions", params={"ids": requested})
+        singles = [(await ac.get(f"/appointments/{i}/queue-position")).json() for i in requested]
+
+    assert bulk_res.status_code == 200
+    bulk = bulk_res.json()
+    assert [p["appointment_id"] for p in bulk] == requested
+    for position, single in zip(bulk, singles):
+        assert {k: v for k, v in position.items() if k != "appointment_id"} == single
+
+    # The SQL path agrees with the in-memory answers
+    async with TestingSessionLocal() as db:
+        from_db = await appointment_service.get_queue_positions_from_db(db, requested)
+    for position in bulk:
+        assert from_db[position["appointment_id"]] == {k: v for k, v in position.items() if k != "appointment_id"}
+    assert from_db[ids[3]]["position"] == 1
+
+class FakeWebSocket:
+    scope = {"subprotocols": []}
+
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+@pytest.mark.asyncio
+async def test_queue_transitions_fan_out_to_subscribers():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+
+        sockets = {}
+        async with TestingSessionLocal() as db:
+            for appointment_id in ids:
+                sockets[appointment_id] = FakeWebSocket()
+                await manager.connect(sockets[appointment_id], str(appointment_id))
+                appointment = await db.get(Appointment, appointment_id)
+                manager.subscribe(sockets[appointment_id], appointment_id, provider_id,
+                                  appointment.service_date, appointment.token_number)
+
+        try:
+            provider_headers = await login(ac, "queuedoc")
+            await ac.post("/appointments/queue/next", headers=provider_headers)
+            await manager.flush()
+
+            # One transition, one personalized message per subscriber
+            first, second, third = (sockets[i].sent for i in ids)
+            assert len(first) == len(second) == len(third) == 1
+            assert first[0]["status"] == "IN_PROGRESS"
+            assert second[0]["position"] == 0
+            assert third[0]["position"] == 1
+            assert third[0]["wait_time"] == 15
+            assert third[0]["current_token"] == 1
+
+            await ac.post("/appointments/queue/finish", headers=provider_headers)
+            await manager.flush()
+            assert first[-1]["status"] == "COMPLETED"
+            assert third[-1]["position"] == 1
+        finally:
+            for appointment_id, websocket in sockets.items():
+                manager.disconnect(websocket, str(appointment_id))
+
+    assert manager.queue_subscribers == {}
+
+class ConnectingWebSocket(FakeWebSocket):
+    """Stays connected until the initial message has been sent."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent_event = asyncio.Event()
+
+    async def send_json(self, message):
+        await super().send_json(message)
+        self.sent_event.set()
+
+    async def receive(self):
+        await self.sent_event.wait()
+        return {"type": "websocket.disconnect", "code": 1000}
+
+def count_appointment_lookups():
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "WHERE appointments.id =" in statement:
+            statements.append(statement)
+    event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+    return statements, lambda: event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+
+async def connect_all(appointment_ids):
+    sockets = [ConnectingWebSocket() for _ in appointment_ids]
+    await asyncio.gather(*(
+        websockets.websocket_endpoint(ws, str(i)) for ws, i in zip(sockets, appointment_ids)
+    ))
+    return [ws.sent[0] for ws in sockets]
+
+@pytest.mark.asyncio
+async def test_connect_snapshot_served_from_queue_state(monkeypatch):
+    monkeypatch.setattr(websockets, "get_db", override_get_db)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+
+    queue_engine.reset()
+    lookups, stop = count_appointment_lookups()
+    try:
+        # A waiting room reconnecting at once: one rebuild, no per-socket queries
+        first = await connect_all(ids * 3)
+        again = await connect_all(ids)
+    finally:
+        stop()
+
+    assert lookups == []
+    assert [m["position"] for m in first[:3]] == [0, 1, 2]
+    assert [m["queue"][0]["eta"] for m in first[:3]] == ["0 min", "15 min", "30 min"]
+    assert first[:3] == first[3:6] == again
+    assert manager.outboxes == {}
+
+@pytest.mark.asyncio
+async def test_connect_lookups_for_finished_appointments_coalesce(monkeypatch):
+    monkeypatch.setattr(websockets, "get_db", override_get_db)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        await ac.post("/appointments/queue/finish", headers=provider_headers)
+        await ac.patch(f"/appointments/{ids[2]}/status", json={"status": "CANCELLED"}, headers=provider_headers)
+
+    queue_engine.reset()
+    lookups, stop = count_appointment_lookups()
+    try:
+        messages = await connect_all([ids[0]] * 5 + [ids[2]] * 5)
+    finally:
+        stop()
+
+    # Rows that left the queue need the database, but only once per appointment
+    assert len(lookups) == 2
+    assert {m["status"] for m in messages[:5]} == {"COMPLETED"}
+    assert {m["status"] for m in messages[5:]} == {"CANCELLED"}
+    assert messages[0]["current_token"] == 1
+
+@pytest.mark.asyncio
+async def test_connect_lookup_survives_cancelled_leader(monkeypatch):
+    started = asyncio.Event()
+    async def slow_entry(db, appointment_id):
+        started.set()
+        await asyncio.sleep(0.05)
+        return (1, datetime.now().date(), appointment_id, None)
+    monkeypatch.setattr(websockets, "get_db", override_get_db)
+    monkeypatch.setattr(appointment_service, "get_queue_entry", slow_entry)
+
+    leader = asyncio.create_task(websockets._lookup_appointment(7))
+    await started.wait()
+    joiner = asyncio.create_task(websockets._lookup_appointment(7))
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    # The joiner redoes the lookup instead of waiting forever
+    assert (await asyncio.wait_for(joiner, 5))[2] == 7
+    assert leader.cancelled()
+    assert websockets._pending_lookups == {}
+
+@pytest.mark.asyncio
+async def test_sse_stream_follows_transitions_and_resumes():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+        provider_headers = await login(ac, "queuedoc")
+        day = datetime.now().date()
+
+        events = queue_streams.events(ids[2], provider_id, day, 3, None, None)
+        assert (await anext(events)).startswith("retry:")
+        first = await anext(events)
+        assert '"position": 2' in first and first.startswith("id: SCHEDULED.2.0\n")
+
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        second = await anext(events)
+        assert second.startswith("id: SCHEDULED.1.1\n")
+        assert '"wait_time": 15' in second
+        await events.aclose()
+
+        # Resuming with the current id sends nothing until the next change
+        resumed = queue_streams.events(ids[2], provider_id, day, 3, None, "SCHEDULED.1.1")
+        await anext(resumed)
+        pending = asyncio.ensure_future(anext(resumed))
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        await ac.post("/appointments/queue/finish", headers=provider_headers)
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        assert (await pending).startswith("id: SCHEDULED.0.2\n")
+        await resumed.aclose()
+
+    assert queue_streams.streams == {}
+
+@pytest.mark.asyncio
+async def test_sse_stream_does_not_hold_a_connection():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+
+    async with TestingSessionLocal() as db:
+        request = Request({"type": "http", "method": "GET", "path": "/", "headers": []})
+        response = await appointments.stream_queue_position(ids[2], request, db)
+        try:
+            assert await anext(response.body_iterator)
+            assert test_engine.pool.checkedout() == 0
+        finally:
+            await response.body_iterator.aclose()
+
+@pytest.mark.asyncio
+async def test_sse_stream_ends_for_finished_appointment():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        await ac.post("/appointments/queue/finish", headers=provider_headers)
+
+        res = await ac.get(f"/appointments/{ids[0]}/queue-position/stream")
+        assert res.status_code == 200
+        assert res.headers["content-type"].startswith("text/event-stream")
+        assert "id: COMPLETED.0.1\n" in res.text
+
+        # Reconnecting with the final state's id tells EventSource to stop
+        res = await ac.get(f"/appointments/{ids[0]}/queue-position/stream",
+                           headers={"Last-Event-ID": "COMPLETED.0.1"})
+        assert res.status_code == 204
+
+        res = await ac.get("/appointments/9999/queue-position/stream")
+        assert res.status_code == 404
+
+@pytest.mark.asyncio
+async def test_queue_position_etag_tracks_queue_version():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac)
+        url = f"/appointments/{ids[2]}/queue-position"
+
+        first = await ac.get(url)
+        etag = first.headers["ETag"]
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+        try:
+            cached = await ac.get(url, headers={"If-None-Match": etag})
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+        assert cached.status_code == 304
+        assert cached.headers["ETag"] == etag
+        assert cached.content == b""
+        assert statements == []
+
+        # Calling the next patient is a new queue version
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+        changed = await ac.get(url, headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.json()["position"] == 1
+        assert changed.headers["ETag"] != etag
+        assert (await ac.get(url, headers={"If-None-Match": f'W/{changed.headers["ETag"]}'})).status_code == 304
+
+        # Appointments that left the queue fall back to the SQL path, untagged
+        await ac.post("/appointments/queue/finish", headers=provider_headers)
+        finished = await ac.get(f"/appointments/{ids[0]}/queue-position")
+        assert "ETag" not in finished.headers
+
+@pytest.mark.asyncio
+async def test_whole_queue_wait_time_predictions():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        provider_id, ids = await setup_queue(ac, patients=4)
+        provider_headers = await login(ac, "queuedoc")
+        await ac.post("/appointments/queue/next", headers=provider_headers)
+
+        res = await ac.get("/analytics/wait-time/queue", params={"provider_id": provider_id})
+        # The request only started training; let it finish before the tables go
+        await wait_time_predictor.training
+
+    assert res.status_code == 200
+    body = res.json()
+    assert body["current_token"] == 1
+    assert [p["appointment_id"] for p in body["predictions"]] == ids[1:]
+    assert [p["people_ahead"] for p in body["predictions"]] == [0, 1, 2]
+    # Too little history to train, so the 15 min/person heuristic applies
+    assert [p["estimated_wait_minutes"] for p in body["predictions"]] == [0.0, 15.0, 30.0]
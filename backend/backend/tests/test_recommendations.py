@@ -0,0 +1,231 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from httpx import AsyncClient, ASGITransport
+from sklearn.metrics.pairwise import cosine_similarity
+from sqlalchemy import event, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from app.main import app
+from app.database.db import get_db, Base
+from app.config import settings
+from app.ml.recommendation_engine import rating_matrix, neighbour_index, NEIGHBOURS, ResultCache
+from app.ml import recommendation_engine
+from app.models import Provider
+from app.services.provider_catalog import provider_catalog
+from app.services.queue_state import queue_engine
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///./test_appointment_system.db"
+
+test_engine = create_async_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(test_engine, class_=AsyncSession, expire_on_commit=False, autocommit=False, autoflush=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as session:
+        yield session
+
+@pytest.fixture
+async def setup_db():
+    app.dependency_overrides[get_db] = override_get_db
+    provider_catalog.reset()
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    provider_catalog.reset()
+
+def synthetic_ratings(users=300, providers=40, visits=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1, users + 1, visits) * 7
+    provider_ids = rng.integers(1, providers + 1, visits) * 3
+    ratings = rng.integers(1, 6, visits).astype(float)
+    ratings[rng.random(visits) < 0.1] = np.nan
+    return user_ids, provider_ids, ratings
+
+def test_neighbour_index_matches_dense_cosine(monkeypatch):
+    users, providers, ratings = synthetic_ratings(providers=600, visits=20000)
+    # Several chunks, built on several threads
+    monkeypatch.setattr(recommendation_engine, "CHUNK", 64)
+    matrix = rating_matrix(users, providers, ratings)
+    assert matrix.ratings.dtype == np.float32
+    assert matrix.neighbours.shape == (600, NEIGHBOURS) and matrix.neighbours.dtype == np.int32
+
+    dense = cosine_similarity(matrix.ratings.T.toarray().astype(float))
+    np.fill_diagonal(dense, 0)
+    expected = -np.sort(-dense, axis=1)[:, :NEIGHBOURS]
+    np.testing.assert_allclose(matrix.similarities, expected, rtol=1e-5)
+    # Every stored neighbour really has the stored similarity
+    rows = np.arange(600)[:, None]
+    np.testing.assert_allclose(dense[rows, matrix.neighbours], matrix.similarities, rtol=1e-5)
+
+def test_recommend_is_weighted_sum_over_index_rows():
+    users, providers, ratings = synthetic_ratings()
+    matrix = rating_matrix(users, providers, ratings)
+    for user_id in matrix.user_ids[:100]:
+        row = matrix.ratings[matrix.row(user_id)].toarray().ravel()
+        scores = np.zeros(len(matrix.provider_ids))
+        for col in np.flatnonzero(row):
+            for neighbour, similarity in zip(matrix.neighbours[col], matrix.similarities[col]):
+                if neighbour >= 0:
+                    scores[neighbour] += similarity * row[col]
+        candidates = np.flatnonzero(scores)
+        expected = candidates[np.lexsort((candidates, -scores[candidates]))]
+        assert matrix.recommend(int(user_id)) == matrix.provider_ids[expected].tolist()
+
+    assert matrix.recommend(1) is None
+
+def test_rating_matrix_averages_repeat_visits():
+    matrix = rating_matrix(
+        np.array([10, 10, 10, 20, 30]), np.array([5, 5, 6, 6, 6]), np.array([4.0, 2.0, np.nan, 5.0, np.nan])
+    )
+    # User 30 never rated anyone, so has no row
+    assert matrix.user_ids.tolist() == [10, 20]
+    assert matrix.provider_ids.tolist() == [5, 6]
+    assert matrix.ratings.toarray().tolist() == [[3.0, 0.0], [0.0, 5.0]]
+    # No user rated both providers, so neither is a neighbour of the other
+    assert matrix.neighbours.tolist() == [[-1], [-1]]
+    assert matrix.recommend(10) == []
+
+def test_neighbour_index_pads_missing_neighbours():
+    from scipy import sparse
+    ratings = sparse.csr_matrix(np.array([[5, 4, 0], [1, 0, 0]], dtype=np.float32))
+    neighbours, similarities = neighbour_index(ratings, k=2)
+    assert neighbours.tolist() == [[1, -1], [0, -1], [-1, -1]]
+    assert similarities[0, 0] > 0 and similarities[0, 1] == 0
+
+def count_provider_queries():
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if "FROM providers" in statement:
+            statements.append(statement)
+    event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+    return statements, lambda: event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+
+async def register_provider(ac, name, profession):
+    res = await ac.post("/auth/register/provider", json={
+        "username": name.lower(), "password": "password", "name": name, "profession": profession
+    })
+    return res.json()["id"]
+
+@pytest.mark.asyncio
+async def test_recommendations_use_provider_catalog(setup_db):
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        ratings = {}
+        for i, (profession, rating) in enumerate([("Doctor", 3.0), ("Dentist", 5.0), ("Doctor", 4.5),
+                                                   ("Doctor", 4.0), ("Dentist", 4.8), ("Doctor", 1.0)]):
+            ratings[await register_provider(ac, f"Provider{i}", profession)] = rating
+        async with TestingSessionLocal() as db:
+            for provider_id, rating in ratings.items():
+                await db.execute(update(Provider).where(Provider.id == provider_id).values(avg_rating=rating))
+            await db.commit()
+
+        statements, stop = count_provider_queries()
+        try:
+            first = await ac.get("/recommendations/providers", params={"user_id": 1, "profession": "Doctor", "top_n": 3})
+            loaded = len(statements)
+            second = await ac.get("/recommendations/providers", params={"user_id": 1, "top_n": 2})
+            repeat = len(statements) - loaded
+        finally:
+            stop()
+            # The request started a training run; let it end before the tables go
+            await recommendation_engine.recommendation_engine.training
+
+        # Untrained, so popularity: best rated active providers of the profession
+        assert [p["name"] for p in first.json()] == ["Provider2", "Provider3", "Provider0"]
+        assert [p["name"] for p in second.json()] == ["Provider1", "Provider4"]
+        # Catalog load plus one IN (...) hydration, then hydration alone
+        assert loaded == 2 and repeat == 1
+        assert "IN (" in statements[-1]
+
+        # A new provider is picked up without waiting for the refresh interval
+        newcomer = await register_provider(ac, "Provider6", "Doctor")
+        async with TestingSessionLocal() as db:
+            await db.execute(update(Provider).where(Provider.id == newcomer).values(avg_rating=4.9))
+            await db.commit()
+        third = await ac.get("/recommendations/providers", params={"user_id": 1, "profession": "Doctor", "top_n": 1})
+        assert [p["name"] for p in third.json()] == ["Provider6"]
+        await recommendation_engine.recommendation_engine.training
+
+def test_catalog_filter_keeps_order_and_drops_unknown_ids():
+    provider_catalog.ids = np.array([7, 3, 9], dtype=np.int64)
+    provider_catalog.professions = np.array([0, 1, 0], dtype=np.int32)
+    provider_catalog.profession_codes = {"Dentist": 0, "Doctor": 1}
+    provider_catalog.by_id = np.argsort(provider_catalog.ids)
+    provider_catalog.sorted_ids = provider_catalog.ids[provider_catalog.by_id]
+    try:
+        assert provider_catalog.filter([9, 4, 3, 7, 100]) == [9, 3, 7]
+        assert provider_catalog.filter([9, 4, 3, 7], "Dentist") == [9, 7]
+        assert provider_catalog.filter([9, 3], "Plumber") == []
+        assert provider_catalog.popular("Dentist", 5, exclude=[7]) == [9]
+    finally:
+        provider_catalog.__init__()
+
+def test_result_cache_is_bounded_and_expires(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(recommendation_engine.time, "monotonic", lambda: now[0])
+    cache = ResultCache(size=2, ttl=10)
+
+    cache.put((1, None, 5), [3, 4])
+    cache.put((2, None, 5), [4])
+    assert cache.get((1, None, 5)) == [3, 4]
+    # Least recently used goes first
+    cache.put((1, "Doctor", 5), [3])
+    assert cache.get((2, None, 5)) is None
+    assert cache.keys_by_user == {1: {(1, None, 5), (1, "Doctor", 5)}}
+
+    now[0] = 11
+    assert cache.get((1, None, 5)) is None
+    cache.invalidate_user(1)
+    assert not cache.entries and not cache.keys_by_user
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evicted"], stats["expired"], stats["invalidated"]) == (1, 2, 1, 1, 1)
+    assert stats["hit_rate"] == 0.3333
+
+@pytest.mark.asyncio
+async def test_cached_results_are_dropped_on_completion_and_retrain(setup_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "ml_models_path", str(tmp_path / "ml_models"))
+    engine = recommendation_engine.recommendation_engine
+    queue_engine.reset()
+    transport = ASGITransport(app=app)
+    try:
+        async with AsyncClient(transport=transport, base_url="http://test") as ac:
+            provider_id = await register_provider(ac, "Queuedoc", "Doctor")
+            user = await ac.post("/auth/register/user", json={
+                "username": "patient", "password": "password", "email": "patient@example.com"
+            })
+            user_id = user.json()["id"]
+            res = await ac.post("/auth/login", data={"username": "patient", "password": "password"})
+            await ac.post("/appointments/book", json={
+                "provider_id": provider_id, "service_name": "Consultation", "date_time": datetime.now().isoformat()
+            }, headers={"Authorization": f"Bearer {res.json()['access_token']}"})
+
+            # A model that does not know this user yet
+            engine.matrix = rating_matrix(np.array([999]), np.array([provider_id]), np.array([5.0]))
+            engine.is_trained = True
+            params = {"user_id": user_id, "top_n": 3}
+            first = await ac.get("/recommendations/providers", params=params)
+            second = await ac.get("/recommendations/providers", params=params)
+            assert first.json() == second.json()
+            stats = (await ac.get("/recommendations/stats")).json()
+            assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+            res = await ac.post("/auth/login", data={"username": "queuedoc", "password": "password"})
+            provider_headers = {"Authorization": f"Bearer {res.json()['access_token']}"}
+            await ac.post("/appointments/queue/next", headers=provider_headers)
+            assert engine.cache.entries
+            await ac.post("/appointments/queue/finish", headers=provider_headers)
+            stats = (await ac.get("/recommendations/stats")).json()
+            assert (stats["entries"], stats["invalidated"]) == (0, 1)
+
+            await ac.get("/recommendations/providers", params=params)
+            assert engine.cache.entries
+            async with TestingSessionLocal() as db:
+                await engine.train(db)
+            assert engine.metadata["completed"] == 1
+            assert not engine.cache.entries
+    finally:
+        engine.__init__()
+        queue_engine.reset()
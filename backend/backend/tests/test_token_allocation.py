@@ -0,0 +1,109 @@
+import asyncio
+import time
+import pytest
+from datetime import datetime, timedelta
+from app.database.db import Base
+from app.models import User, Provider
+from app.schemas.appointment import AppointmentCreate
+from app.services import appointment_service
+from app.services.queue_state import queue_engine
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+TEST_DATABASE_URL = "sqlite+aiosqlite:///./test_appointment_system.db"
+
+test_engine = create_async_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(test_engine, class_=AsyncSession, expire_on_commit=False, autocommit=False, autoflush=False)
+
+CONCURRENT_BOOKINGS = 300
+
+@pytest.fixture(autouse=True)
+async def setup_db():
+    queue_engine.reset()
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    # The pool's wait queue belongs to this test's event loop
+    await test_engine.dispose()
+    queue_engine.reset()
+
+async def create_user_and_provider():
+    async with TestingSessionLocal() as db:
+        user = User(username="stress", email="stress@example.com", password_hash="x", total_appointments=0)
+        provider = Provider(username="busydoc", name="Dr. Busy", profession="Doctor", password_hash="x")
+        db.add_all([user, provider])
+        await db.commit()
+        return user.id, provider.id
+
+async def book(user_id: int, provider_id: int, when: datetime):
+    async with TestingSessionLocal() as db:
+        appointment = await appointment_service.create_appointment(db, AppointmentCreate(
+            provider_id=provider_id, service_name="Consultation", date_time=when
+        ), user_id)
+        return appointment.token_number
+
+@pytest.mark.asyncio
+async def test_concurrent_bookings_get_unique_gapless_tokens():
+    user_id, provider_id = await create_user_and_provider()
+    when = datetime.now() + timedelta(days=1)
+
+    start = time.perf_counter()
+    tokens = await asyncio.gather(*[book(user_id, provider_id, when) for _ in range(CONCURRENT_BOOKINGS)])
+    elapsed = time.perf_counter() - start
+    print(f"\n{CONCURRENT_BOOKINGS} concurrent bookings in {elapsed:.2f}s ({CONCURRENT_BOOKINGS / elapsed:.0f} bookings/s)")
+
+    assert sorted(tokens) == list(range(1, CONCURRENT_BOOKINGS + 1))
+
+    async with TestingSessionLocal() as db:
+        user = await db.get(User, user_id)
+        assert user.total_appointments == CONCURRENT_BOOKINGS
+
+@pytest.mark.asyncio
+async def test_sequences_are_per_provider_day():
+    user_id, provider_id = await create_user_and_provider()
+    today = datetime.now()
+    tomorrow = today + timedelta(days=1)
+
+    assert await book(user_id, provider_id, today) == 1
+    assert await book(user_id, provider_id, tomorrow) == 1
+    assert await book(user_id, provider_id, today) == 2
+
+@pytest.mark.asyncio
+async def test_locking_fallback_for_dialects_without_upsert(monkeypatch):
+    monkeypatch.setattr(appointment_service, "_sequence_insert", lambda db: None)
+    user_id, provider_id = await create_user_and_provider()
+    today = datetime.now()
+    tomorrow = today + timedelta(days=1)
+
+    tokens = await asyncio.gather(*[book(user_id, provider_id, tomorrow) for _ in range(20)])
+    assert sorted(tokens) == list(range(1, 21))
+    assert await book(user_id, provider_id, today) == 1
+    assert await book(user_id, provider_id, tomorrow) == 21
+
+@pytest.mark.asyncio
+async def test_only_lost_races_are_retried():
+    user_id, provider_id = await create_user_and_provider()
+    with pytest.raises(HTTPException) as missing:
+        await book(user_id, provider_id + 1, datetime.now())
+    assert missing.value.status_code == 404
+
+    attempts = []
+    async def violate(error):
+        attempts.append(error)
+        raise IntegrityError("INSERT", None, Exception(error))
+
+    async with TestingSessionLocal() as db:
+        with pytest.raises(HTTPException) as rejected:
+            await appointment_service._commit_with_token_retries(db, lambda: violate("FOREIGN KEY constraint failed"))
+        assert rejected.value.status_code == 400
+        assert len(attempts) == 1
+
+        attempts.clear()
+        with pytest.raises(HTTPException) as exhausted:
+            await appointment_service._commit_with_token_retries(db, lambda: violate("UNIQUE constraint failed"))
+        assert exhausted.value.status_code == 503
+        assert len(attempts) == appointment_service.TOKEN_ALLOCATION_RETRIES
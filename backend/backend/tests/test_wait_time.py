@@ -0,0 +1,331 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+import pandas as pd
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from app.config import settings
+from app.database.db import Base
+from app.ml import artifacts, features, training
+from app.ml.scheduler import RetrainScheduler
+from app.ml import wait_time_predictor as predictor_module
+from app.ml.recommendation_engine import RecommendationEngine
+from app.ml.wait_time_predictor import WaitTimePredictor
+from app.models import Appointment, AppointmentStatus, User, Provider
+
+@pytest.fixture(autouse=True)
+def models_path(tmp_path, monkeypatch):
+    # Trained models are saved; keep them out of the working tree
+    path = tmp_path / "ml_models"
+    monkeypatch.setattr(settings, "ml_models_path", str(path))
+    return path
+
+def trained_predictor(samples=500, seed=0):
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([
+        rng.integers(9, 17, samples),
+        rng.integers(0, 7, samples),
+        rng.integers(0, 40, samples),
+    ]).astype(float)
+    y = 10 + X[:, 0] * 0.5 + rng.normal(0, 2, samples)
+    predictor = WaitTimePredictor()
+    predictor.model.set_params(n_estimators=20, random_state=seed)
+    predictor.model.fit(X, y)
+    predictor.is_trained = True
+    return predictor
+
+def test_predict_batch_matches_per_token_predictions():
+    predictor = trained_predictor()
+    now = pd.Timestamp("2026-03-02 11:30")
+    ahead = np.arange(200)
+
+    batch = predictor.predict_batch(ahead, now)
+    single = [predictor.predict(0, int(k), now) for k in ahead]
+
+    assert batch.shape == (200,)
+    np.testing.assert_allclose(batch, single)
+    assert batch[0] == 0
+
+def test_predict_batch_falls_back_to_heuristic_when_untrained():
+    predictor = WaitTimePredictor()
+    estimates = predictor.predict_batch(np.array([0, 1, 4, -2]), pd.Timestamp("2026-03-02 11:30"))
+    assert estimates.tolist() == [0.0, 15.0, 60.0, 0.0]
+    assert predictor.predict(3, 5, pd.Timestamp("2026-03-02 11:30")) == 30.0
+
+def test_lookup_table_matches_forest():
+    predictor = trained_predictor()
+    forest = predictor.predict_batch(np.arange(300), pd.Timestamp("2026-03-02 11:30"))
+
+    predictor.build_table(39)
+    assert predictor.table.shape == (24, 7, 101)
+    hours, days, ahead = np.meshgrid(np.arange(24), np.arange(7), np.arange(101), indexing="ij")
+    grid = np.column_stack([hours.ravel(), days.ravel(), ahead.ravel()]).astype(float)
+    np.testing.assert_allclose(predictor.table.ravel(), predictor.model.predict(grid))
+
+    # Including tokens_ahead past the end of the table
+    table = predictor.predict_batch(np.arange(300), pd.Timestamp("2026-03-02 11:30"))
+    np.testing.assert_allclose(table, forest)
+    assert predictor.predict(0, 250, pd.Timestamp("2026-03-07 16:05")) == pytest.approx(
+        predictor.model.predict(np.array([[16, 5, 250]], dtype=float))[0] * 250)
+
+def history(count=60):
+    start = datetime(2026, 3, 1, 8, 15)
+    rows = []
+    for i in range(count):
+        rows.append({
+            "user_id": i % 4 + 1, "provider_id": i % 3 + 1, "service_name": "Consultation",
+            "date_time": start + timedelta(days=i % 9, hours=i % 10), "token_number": i % 12 + 1,
+            "status": AppointmentStatus.COMPLETED if i % 5 else AppointmentStatus.CANCELLED,
+            "actual_duration": None if i % 7 == 0 else 5.0 + i,
+            "started_at": start if i % 11 else None,
+            "user_rating": None if i % 6 == 0 else i % 5 + 1,
+        })
+    return rows
+
+async def seeded_db(tmp_path, rows):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'features.db'}")
+    SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with SessionLocal() as db:
+        await db.execute(insert(User), [
+            {"username": f"u{i}", "email": f"u{i}@example.com", "password_hash": "x"} for i in range(4)
+        ])
+        await db.execute(insert(Provider), [
+            {"username": f"p{i}", "name": f"P{i}", "profession": "Doctor", "password_hash": "x"} for i in range(3)
+        ])
+        await db.execute(insert(Appointment), rows)
+        await db.commit()
+    return engine, SessionLocal
+
+@pytest.mark.asyncio
+async def test_training_data_extraction_streams_chunks(tmp_path, monkeypatch):
+    import aiosqlite
+    engine, SessionLocal = await seeded_db(tmp_path, history(400))
+    calls = []
+    for name in ("fetchmany", "fetchall"):
+        original = getattr(aiosqlite.Cursor, name)
+        async def record(self, *args, _name=name, _original=original, **kwargs):
+            calls.append(_name)
+            return await _original(self, *args, **kwargs)
+        monkeypatch.setattr(aiosqlite.Cursor, name, record)
+    try:
+        async with SessionLocal() as db:
+            data = await features.load_columns(db, select(Appointment.id, Appointment.token_number), chunk_size=10)
+    finally:
+        await engine.dispose()
+    assert data.shape == (400, 2)
+    # The row count, then one awaited driver fetch per chunk; never the whole result at once
+    assert calls == ["fetchall"] + ["fetchmany"] * 40
+
+@pytest.mark.asyncio
+async def test_training_data_extraction_matches_row_by_row(tmp_path):
+    rows = history()
+    engine, SessionLocal = await seeded_db(tmp_path, rows)
+    async with SessionLocal() as db:
+        # Small chunks, so the result is stitched together from several partitions
+        features.CHUNK_SIZE, previous = 7, features.CHUNK_SIZE
+        try:
+            X, y = await features.wait_time_training_data(db)
+            users, providers, ratings = await features.rating_data(db)
+            engine_under_test = RecommendationEngine()
+            await engine_under_test.train(db)
+        finally:
+            features.CHUNK_SIZE = previous
+    await engine.dispose()
+
+    completed = [r for r in rows if r["status"] == AppointmentStatus.COMPLETED]
+    trained = [r for r in completed if r["actual_duration"] is not None and r["started_at"] is not None]
+    np.testing.assert_array_equal(X, [
+        [r["date_time"].hour, r["date_time"].weekday(), r["token_number"] - 1] for r in trained
+    ])
+    np.testing.assert_array_equal(y, [r["actual_duration"] for r in trained])
+
+    assert users.tolist() == [r["user_id"] for r in completed]
+    assert providers.tolist() == [r["provider_id"] for r in completed]
+    np.testing.assert_array_equal(ratings, [np.nan if r["user_rating"] is None else r["user_rating"] for r in completed])
+
+    # Same matrix the pandas pivot used to produce
+    expected = pd.DataFrame(
+        [(r["user_id"], r["provider_id"], r["user_rating"]) for r in completed],
+        columns=["user_id", "provider_id", "rating"]
+    ).pivot_table(index="user_id", columns="provider_id", values="rating").fillna(0)
+    matrix = engine_under_test.matrix
+    np.testing.assert_allclose(matrix.ratings.toarray(), expected.to_numpy(), rtol=1e-6)
+    assert matrix.user_ids.tolist() == expected.index.tolist()
+    assert matrix.provider_ids.tolist() == expected.columns.tolist()
+
+@pytest.mark.asyncio
+async def test_training_coalesces_and_runs_off_the_event_loop(tmp_path, monkeypatch):
+    engine, SessionLocal = await seeded_db(tmp_path, history(400))
+    fits = []
+    run_in_pool = predictor_module.run_in_pool
+
+    async def counting_run_in_pool(fn, *args):
+        fits.append(fn.__name__)
+        return await run_in_pool(fn, *args)
+
+    monkeypatch.setattr(predictor_module, "run_in_pool", counting_run_in_pool)
+
+    lags = []
+
+    async def ticker():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    predictor = WaitTimePredictor()
+    now = pd.Timestamp("2026-03-02 11:30")
+    tick = asyncio.create_task(ticker())
+    try:
+        async with SessionLocal() as db:
+            runs = [predictor.start_training(db) for _ in range(5)]
+            assert all(run is runs[0] for run in runs)
+            # The heuristic keeps answering while the forest is fitted elsewhere
+            assert predictor.predict(0, 2, now) == 30.0
+            await asyncio.gather(*(predictor.train(db) for _ in range(3)))
+    finally:
+        tick.cancel()
+        training.shutdown_pool()
+        await engine.dispose()
+
+    assert fits == ["fit_model"]
+    assert predictor.is_trained and predictor.table is not None
+    assert predictor.predict(0, 2, now) != 30.0
+    # Spawning the process and fitting took seconds; the loop never stalled for it
+    assert max(lags) < 0.25
+
+def is_mapped(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+@pytest.mark.asyncio
+async def test_trained_models_are_saved_and_loaded_memory_mapped(tmp_path, models_path):
+    rows = history(400)
+    engine, SessionLocal = await seeded_db(tmp_path, rows)
+    predictor, recommender = WaitTimePredictor(), RecommendationEngine()
+    try:
+        async with SessionLocal() as db:
+            await predictor.train(db)
+            await recommender.train(db)
+    finally:
+        training.shutdown_pool()
+        await engine.dispose()
+
+    _, metadata = artifacts.load("wait_time")
+    assert metadata["version"] == predictor.version
+    assert metadata["samples"] == sum(
+        r["status"] == AppointmentStatus.COMPLETED and r["actual_duration"] is not None and r["started_at"] is not None
+        for r in rows
+    )
+    assert metadata["arrays"]["table"]["shape"] == list(predictor.table.shape)
+    assert (models_path / "wait_time" / "CURRENT").read_text() == predictor.version
+
+    # A fresh worker serves the same predictions straight from the mapped files
+    worker_predictor, worker_recommender = WaitTimePredictor(), RecommendationEngine()
+    assert worker_predictor.load() and worker_recommender.load()
+    assert is_mapped(worker_predictor.table)
+    assert worker_predictor.version == predictor.version
+    now = pd.Timestamp("2026-03-02 11:30")
+    np.testing.assert_array_equal(
+        worker_predictor.predict_batch(np.arange(50), now), predictor.predict_batch(np.arange(50), now)
+    )
+    assert is_mapped(worker_recommender.matrix.ratings.data) and is_mapped(worker_recommender.matrix.neighbours)
+    assert (worker_recommender.matrix.ratings != recommender.matrix.ratings).nnz == 0
+    assert [worker_recommender.matrix.recommend(u) for u in range(1, 5)] == \
+        [recommender.matrix.recommend(u) for u in range(1, 5)]
+
+def test_artifact_versions_are_pruned_and_unknown_formats_ignored(models_path):
+    assert artifacts.load("wait_time") is None
+    versions = [artifacts.save("wait_time", {"table": np.full((2, 2), i)}, {"samples": i})["version"]
+                for i in range(artifacts.KEEP_VERSIONS + 2)]
+    assert sorted(p.name for p in (models_path / "wait_time").iterdir() if p.is_dir()) == \
+        sorted(versions[-artifacts.KEEP_VERSIONS:])
+    arrays, metadata = artifacts.load("wait_time")
+    assert metadata["version"] == versions[-1] and arrays["table"][0, 0] == len(versions) - 1
+
+    artifacts.ARTIFACT_FORMAT, previous = artifacts.ARTIFACT_FORMAT + 1, artifacts.ARTIFACT_FORMAT
+    try:
+        assert artifacts.load("wait_time") is None
+    finally:
+        artifacts.ARTIFACT_FORMAT = previous
+
+@pytest.mark.asyncio
+async def test_scheduler_reports_insufficient_data_apart_from_failures(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "min_training_samples", 1)
+    # Four completed visits: enough ratings to recommend from, too few durations to fit on
+    engine, SessionLocal = await seeded_db(tmp_path, history(5))
+    scheduler = RetrainScheduler()
+    scheduler.models = {"wait_time": WaitTimePredictor(), "recommendations": RecommendationEngine()}
+    try:
+        await scheduler.check(engine)
+        assert scheduler.last_result == {"wait_time": "insufficient_data", "recommendations": "trained"}
+
+        async def broken(db):
+            raise RuntimeError("database went away")
+        monkeypatch.setattr(predictor_module, "wait_time_training_data", broken)
+        await scheduler.check(engine)
+        assert scheduler.last_result["wait_time"] == "failed"
+    finally:
+        training.shutdown_pool()
+        await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_scheduler_retrains_only_after_enough_new_visits(tmp_path, monkeypatch):
+    from httpx import AsyncClient, ASGITransport
+    from app.main import app
+    from app.routes import analytics
+
+    monkeypatch.setattr(settings, "min_training_samples", 50)
+    rows = history(400)
+    engine, SessionLocal = await seeded_db(tmp_path, rows)
+    scheduler = RetrainScheduler()
+    scheduler.models = {"wait_time": WaitTimePredictor(), "recommendations": RecommendationEngine()}
+    try:
+        await scheduler.check(engine)
+        assert scheduler.last_result == {"wait_time": "trained", "recommendations": "trained"}
+        first = {name: model.version for name, model in scheduler.models.items()}
+
+        await scheduler.check(engine)
+        assert scheduler.last_result == {"wait_time": "skipped", "recommendations": "skipped"}
+
+        # A second worker picks up the saved models instead of training its own
+        other = RetrainScheduler()
+        other.models = {"wait_time": WaitTimePredictor(), "recommendations": RecommendationEngine()}
+        await other.check(engine)
+        assert other.last_result == {"wait_time": "skipped", "recommendations": "skipped"}
+        assert {name: model.version for name, model in other.models.items()} == first
+
+        async with SessionLocal() as db:
+            await db.execute(insert(Appointment), [
+                {**row, "status": AppointmentStatus.COMPLETED, "actual_duration": 20.0, "started_at": datetime(2026, 3, 1)}
+                for row in history(60)
+            ])
+            await db.commit()
+        await scheduler.check(engine)
+        assert scheduler.last_result == {"wait_time": "trained", "recommendations": "trained"}
+
+        monkeypatch.setattr(analytics, "retrain_scheduler", scheduler)
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            status = (await ac.get("/analytics/models")).json()
+    finally:
+        training.shutdown_pool()
+        await engine.dispose()
+
+    completed = sum(r["status"] == AppointmentStatus.COMPLETED for r in rows) + 60
+    wait_time = status["models"]["wait_time"]
+    assert status["min_training_samples"] == 50
+    assert wait_time["is_trained"] and not wait_time["training"]
+    assert wait_time["version"] != first["wait_time"]
+    assert wait_time["completed_appointments"] == completed
+    assert wait_time["samples"] < completed and wait_time["duration_seconds"] > 0
+    assert status["models"]["recommendations"]["samples"] == completed
+    assert status["last_check"] is not None
@@ -821,7 +821,9 @@ const AppointmentSystem = () => {
     const fetchCockpitData = async () => {
       setLoading(true);
       try {
-        const apps = await appointmentsAPI.getProviderAppointments();
+        // Only today's queue; older history stays on the server
+        const today = new Date().toLocaleDateString('en-CA');
+        const apps = await appointmentsAPI.getProviderAppointments({ dateFrom: today, dateTo: today });
         // Filter appointments for Today
         // Backend typically returns all or filtered. Let's assume list.
         // Sort by token/time
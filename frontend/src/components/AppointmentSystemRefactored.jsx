@@ -492,7 +492,9 @@ const ProviderDashboard = ({ user }) => {
     const fetchCockpitData = async () => {
         setLoading(true);
         try {
-            const apps = await appointmentsAPI.getProviderAppointments();
+            // Only today's queue; older history stays on the server
+            const today = new Date().toLocaleDateString('en-CA');
+            const apps = await appointmentsAPI.getProviderAppointments({ dateFrom: today, dateTo: today });
             const now = new Date();
             const active = apps.filter(a => ['SCHEDULED', 'IN_PROGRESS'].includes(a.status));
 
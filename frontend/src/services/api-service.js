@@ -33,6 +33,36 @@ async function apiRequest(endpoint, options = {}) {
   }
 }
 
+// Page size for listings; the backend caps it at 200
+const PAGE_SIZE = 200;
+
+// Fetch every page of a keyset-paginated listing, following X-Next-Cursor
+async function apiRequestAllPages(endpoint, params = {}) {
+  const items = [];
+  let cursor = null;
+  do {
+    const query = new URLSearchParams({ ...params, limit: PAGE_SIZE });
+    if (cursor) query.set('cursor', cursor);
+    const token = localStorage.getItem('authToken');
+    const response = await fetch(`${API_BASE_URL}${endpoint}?${query}`, {
+      headers: {
+        'Content-Type': 'application/json',
+        ...(token && { 'Authorization': `Bearer ${token}` }),
+      },
+    });
+
+    if (!response.ok) {
+      const error = await response.json();
+      console.error('API Error:', error);
+      throw new Error(error.detail || 'API request failed');
+    }
+
+    items.push(...(await response.json()));
+    cursor = response.headers.get('X-Next-Cursor');
+  } while (cursor);
+  return items;
+}
+
 // Authentication API
 export const authAPI = {
   // Register new user
@@ -200,9 +230,13 @@ export const appointmentsAPI = {
     return apiRequest(endpoint);
   },
 
-  // Get provider appointments (for cockpit)
-  getProviderAppointments: async () => {
-    return apiRequest('/appointments/provider/me');
+  // Get provider appointments (for cockpit), optionally for a YYYY-MM-DD date range
+  getProviderAppointments: async ({ dateFrom, dateTo } = {}) => {
+    const params = {
+      ...(dateFrom && { date_from: dateFrom }),
+      ...(dateTo && { date_to: dateTo }),
+    };
+    return apiRequestAllPages('/appointments/provider/me', params);
   },
 
   // Get appointment by ID
@@ -364,6 +398,11 @@ export class QueueWebSocket {
 
     this.ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
+      // Server heartbeat: answer so the connection is not reaped as idle
+      if (data.type === 'ping') {
+        this.ws.send('pong');
+        return;
+      }
       if (this.callbacks.onUpdate) this.callbacks.onUpdate(data);
     };
 